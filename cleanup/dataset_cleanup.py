@@ -2,6 +2,7 @@
 
 import sys
 import json
+import multiprocessing
 from datetime import datetime as dt
 
 import pandas as pd
@@ -15,6 +16,8 @@ import mongo_utils
 from schema import schema_analysis
 from schema import type_utils
 
+from cleanup import normalization
+
 
 #
 #
@@ -82,6 +85,157 @@ def normalizeToList(nFlat, pathList, valTypes, defValues, target):
 
 
 
+#
+# Split the documents of `srcColl` matching `srcQuery` into at most `partCount`
+# contiguous `_id` ranges of roughly equal size.  Each range is returned as a
+# query that selects only the documents in that range.
+#
+# The range boundaries are found by walking the `_id` index, skipping the
+# documents of one range at a time, so that no aggregation has to group the
+# whole collection in memory.
+#
+def computeIdPartitions(srcColl, srcQuery, partCount):
+
+    partQueries = []
+
+    if partCount <= 1:
+        partQueries.append(srcQuery)
+        return partQueries
+
+    docCount = srcColl.count_documents(srcQuery)
+    partSize = -(-docCount // partCount)
+
+    idBounds = []
+    while partSize > 0 and len(idBounds) < partCount - 1:
+        boundQuery = dict(srcQuery)
+        if len(idBounds) > 0:
+            boundQuery['_id'] = dict(srcQuery.get('_id', {}))
+            boundQuery['_id']['$gte'] = idBounds[-1]
+        boundDocs = list(srcColl.find(boundQuery, { '_id': 1 }).sort('_id', pymongo.ASCENDING).skip(partSize).limit(1))
+        if 0 == len(boundDocs):
+            break
+        idBounds.append(boundDocs[0]['_id'])
+
+    # The lower bound of a range is inclusive and its upper bound exclusive,
+    # the first and last ranges are bounded by `srcQuery` only.
+    rangeStarts = [None] + idBounds
+    rangeEnds   = idBounds + [None]
+    for idStart, idEnd in zip(rangeStarts, rangeEnds):
+        partQuery = dict(srcQuery)
+        idQuery   = dict(srcQuery.get('_id', {}))
+        if None != idStart:
+            idQuery['$gte'] = idStart
+        if None != idEnd:
+            idQuery['$lt'] = idEnd
+        if len(idQuery) > 0:
+            partQuery['_id'] = idQuery
+        partQueries.append(partQuery)
+
+    return partQueries
+
+
+
+#
+# Label each of the cleaned documents in `normDocs` with the fold and holdout
+# assignment of its `_id` in `idValues`.  `foldArgs` holds the random seed,
+# number of folds and holdout fraction of the estimator.
+#
+def setFoldLabels(normDocs, idValues, foldArgs):
+
+    randSeed, foldCount, holdoutFrac = foldArgs
+    folds, holdout = normalization.assignFolds(idValues, randSeed, foldCount, holdoutFrac)
+
+    for normDoc, fold, isHoldout in zip(normDocs, folds.tolist(), holdout.tolist()):
+        normDoc[type_utils.CLEANED_FOLD]     = fold
+        normDoc[type_utils.CLEANED_HOLDOUT]  = isHoldout
+
+
+
+#
+# Upsert the kept rows of `nBatch` into `destColl`, one document per distinct
+# normalized value vector.  The `_id` of the document is the hash of the
+# vector and the `CLEANED_COUNT` field holds the number of raw documents that
+# normalized to it.  Duplicates within the batch are combined before writing.
+#
+def upsertDistinct(destColl, nBatch, keepStrings, foldArgs):
+
+    distinctDocs = {}
+    for rowHash, normDoc in zip(nBatch.getRowHashes(), nBatch.getDocs(withStrings=keepStrings)):
+        entry = distinctDocs.get(rowHash)
+        if None == entry:
+            distinctDocs[rowHash] = [normDoc, 1]
+        else:
+            entry[1] += 1
+
+    setFoldLabels([entry[0] for entry in distinctDocs.values()], list(distinctDocs.keys()), foldArgs)
+
+    updates = []
+    for rowHash, (normDoc, count) in distinctDocs.items():
+        updates.append(pymongo.UpdateOne({ '_id': rowHash }, { '$setOnInsert': normDoc, '$inc': { type_utils.CLEANED_COUNT: count } }, upsert=True))
+
+    try:
+        destColl.bulk_write(updates, ordered=False)
+    except pymongo.errors.BulkWriteError as bwE:
+        # Another worker may insert the same `_id` concurrently, failing the
+        # upsert with a duplicate key error.  The document exists now, so the
+        # failed updates only need to be retried.
+        writeErrors = bwE.details.get('writeErrors', [])
+        retries = [updates[wErr['index']] for wErr in writeErrors if 11000 == wErr.get('code')]
+        if len(retries) != len(writeErrors):
+            raise
+        destColl.bulk_write(retries, ordered=False)
+
+
+
+#
+# Clean the raw documents in one `_id` partition and insert the results into
+# the cleaned collection.  Runs in a worker process, so it opens its own
+# MongoDB clients from the URIs rather than sharing those of the parent.
+#
+# With `dedupDistinct` set, identical normalized rows are stored once with
+# their count, see upsertDistinct().  Every cleaned document is labeled with
+# its fold and holdout assignment, see setFoldLabels().
+#
+# Returns the number of documents kept and rejected in the partition and the
+# number of outlier values found per attribute path.
+#
+def cleanupPartition(partArgs):
+
+    raw_uri, cleaned_uri, collName, partQuery, nPlan, keepStrings, dedupDistinct, foldArgs = partArgs
+
+    mUtils          = mongo_utils.MongoUtils()
+    rawClient       = mUtils.getMongoClient(raw_uri)
+    cleanedClient   = mUtils.getMongoClient(cleaned_uri)
+
+    keptCount       = 0
+    rejCount        = 0
+    outlierCounts   = {}
+
+    try:
+        srcColl  = pymongo.collection.Collection( rawClient.get_default_database(), collName )
+        destColl = pymongo.collection.Collection( cleanedClient.get_default_database(), collName )
+
+        for docBatch in normalization.iterBatches(srcColl.find( partQuery )):
+
+            nBatch = nPlan.apply_batch(docBatch)
+            if nBatch.getKeptCount() > 0:
+                if dedupDistinct:
+                    upsertDistinct(destColl, nBatch, keepStrings, foldArgs)
+                else:
+                    normDocs = nBatch.getDocs(withIds=True, withStrings=keepStrings)
+                    setFoldLabels(normDocs, [normDoc['_id'] for normDoc in normDocs], foldArgs)
+                    destColl.insert_many(normDocs, ordered=False)
+            keptCount += nBatch.getKeptCount()
+            rejCount  += nBatch.getRejectedCount()
+            normalization.addOutlierCounts(outlierCounts, nBatch.getOutlierCounts())
+    finally:
+        rawClient.close()
+        cleanedClient.close()
+
+    return keptCount, rejCount, outlierCounts
+
+
+
 
 class CleanupStage(object):
     """ The Ahnung cleanup stage pulls flattened instances (in documents,
@@ -118,6 +272,12 @@ class CleanupStage(object):
     TYPES_SUFFIX    = type_utils.TYPES_SUFFIX
     DEFAULTS_SUFFIX = type_utils.DEFAULTS_SUFFIX
 
+    #
+    # Number of `_id` partitions created per worker process, so that workers
+    # finishing early can pick up remaining partitions.
+    #
+    PARTITIONS_PER_WORKER = 4
+
     #
     #
     #
@@ -129,20 +289,36 @@ class CleanupStage(object):
 
     #
     # Cleanup the dataset of the documents/rows in `collName`.
-    # 
+    #
+    # The raw collection is split into `_id` ranges that are cleaned by a pool
+    # of worker processes sized by the estimator's allowed CPUs.  Each cleaned
+    # document keeps the `_id` of its raw document, so the cleaned collection
+    # holds the same documents regardless of the number of workers.
+    #
+    # Categorical attributes (including a classification target) are stored
+    # as the integer codes of the vehicle's encoders.  The original strings
+    # are kept in a side field when `keep_category_strings` is enabled.
+    #
+    # When `dedup_mode` is "distinct" or "bounded", identical normalized rows
+    # are stored once together with the number of raw documents they stand
+    # for, and the model stage expands or weights them.
+    #
+    # Numeric attributes are checked against the outlier bounds of their
+    # policy and the number of outliers per attribute is recorded in the
+    # vehicle stats.
+    #
+    # Each cleaned document is given a fold number and a holdout flag from a
+    # hash of its `_id` and the estimator's random seed, so that the model
+    # stage can query the training or holdout portion alone.
     #
     def cleanupEst(self, rawClientDB, vehicle, cleanedClientDB, target, collName):
 
         print('\nCleanup for dataset ' + collName + ' ...\n')
 
         valTypes   = vehicle.getAttrDatatypes()
-        defValues  = vehicle.getAttrDefaults()
-        
-        pathList = valTypes.keys()
+        nPlan      = vehicle.getNormalizationPlan()
         
-        destColl = pymongo.collection.Collection( cleanedClientDB, collName )
-        destColl.drop()
-
+        destColl  = pymongo.collection.Collection( cleanedClientDB, collName )
         srcColl   = pymongo.collection.Collection( rawClientDB, collName )
         srcQuery  = {  target : { "$exists": True }}
 
@@ -150,19 +326,140 @@ class CleanupStage(object):
         print('Types:')
         print(str(valTypes))
 
-        dsList = []
-        
-        for nFlat in srcColl.find( srcQuery ):
+        raw_uri      = self.aConfig.getRawDocsURI()
+        cleaned_uri  = self.aConfig.getCleanedURI()
+        keepStrings  = vehicle.getKeepCategoryStrings()
+        dedupMode    = vehicle.getDedupMode()
+        dedupDistinct = dedupMode in [self.aConfig.DEDUP_DISTINCT, self.aConfig.DEDUP_BOUNDED]
+        foldArgs     = (vehicle.getRandomSeed(), vehicle.getNumFolds(), vehicle.getHoldoutFraction())
+
+        # Everything that shapes the cleaned documents goes into the
+        # fingerprint.  Documents cleaned under another fingerprint can not be
+        # mixed with new ones, so a changed fingerprint forces a full rebuild.
+        fingerprint  = vehicle.getCleanupFingerprint()
+
+        lastDocs     = list(srcColl.find(srcQuery, { '_id': 1 }).sort('_id', pymongo.DESCENDING).limit(1))
+        if 0 == len(lastDocs):
+            print('No raw documents with target ' + target + ' found.')
+            return
+        newMark      = lastDocs[0]['_id']
+
+        cState       = vehicle.getCleanupState()
+        fullRebuild  = self.needsFullRebuild(vehicle, cState, fingerprint, srcColl, srcQuery, destColl)
+        oldMark      = cState.get(type_utils.CLEANUP_WATERMARK)
+
+        if fullRebuild:
+            print('Full rebuild of the cleaned documents.')
+            destColl.drop()
+            srcQuery['_id'] = { '$lte': newMark }
+        elif oldMark == newMark:
+            print('No new raw documents since _id ' + str(oldMark) + ', the cleaned documents are current.')
+            return
+        else:
+            print('Appending the raw documents after _id ' + str(oldMark) + '.')
+            srcQuery['_id'] = { '$gt': oldMark, '$lte': newMark }
 
-            normDoc, valList = normalizeToList(nFlat, pathList, valTypes, defValues, target)
-            if None != normDoc and None != valList:
-                destColl.insert(normDoc)
-                dsList.append(valList)
-            
-        dsFrame = pd.DataFrame(dsList, columns=pathList)
+        workerCount  = max(1, vehicle.getAllowedCPUs())
+        partCount    = 1 if 1 == workerCount else workerCount * self.PARTITIONS_PER_WORKER
+        partQueries  = computeIdPartitions(srcColl, srcQuery, partCount)
 
-        print('DataFrame:')
-        print(str(dsFrame))
+        partArgs     = [(raw_uri, cleaned_uri, collName, partQuery, nPlan, keepStrings, dedupDistinct, foldArgs) for partQuery in partQueries]
+
+        print('Cleaning ' + str(len(partQueries)) + ' _id partition(s) with ' + str(workerCount) + ' worker process(es).')
+
+        if 1 == workerCount:
+            partResults = [cleanupPartition(nArgs) for nArgs in partArgs]
+        else:
+            with multiprocessing.Pool(processes=workerCount) as pool:
+                partResults = pool.map(cleanupPartition, partArgs, chunksize=1)
+
+        keptCount     = 0
+        rejCount      = 0
+        outlierCounts = {}
+        for partKept, partRej, partOutliers in partResults:
+            keptCount += partKept
+            rejCount  += partRej
+            normalization.addOutlierCounts(outlierCounts, partOutliers)
+
+        print('Cleaned ' + str(keptCount) + ' documents, rejected ' + str(rejCount) + '.')
+        if not fullRebuild:
+            normalization.addOutlierCounts(outlierCounts, self.loadOutlierCounts(vehicle))
+        self.saveOutlierCounts(vehicle, nPlan, outlierCounts)
+        if dedupDistinct:
+            print('Stored ' + str(destColl.count_documents({})) + ' distinct documents (dedup mode ' + dedupMode + ').')
+
+        rawCount = srcColl.count_documents({ target: { "$exists": True }, '_id': { '$lte': newMark } })
+        vehicle.setCleanupState({
+            type_utils.CLEANUP_WATERMARK:    newMark,
+            type_utils.CLEANUP_FINGERPRINT:  fingerprint,
+            type_utils.CLEANUP_RAW_COUNT:    rawCount
+        }, True)
+
+
+
+    #
+    # Return True when the cleaned collection must be rebuilt from all of the
+    # raw documents, rather than extended with those after the watermark of
+    # the previous cleanup in `cState`.  The raw document count below the
+    # watermark detects raw collections that were reloaded by the schema
+    # stage since then.
+    #
+    def needsFullRebuild(self, vehicle, cState, fingerprint, srcColl, srcQuery, destColl):
+
+        if not vehicle.getIncrementalCleanup():
+            return True
+
+        oldMark = cState.get(type_utils.CLEANUP_WATERMARK)
+        if None == oldMark:
+            return True
+
+        if fingerprint != cState.get(type_utils.CLEANUP_FINGERPRINT):
+            print('The normalization settings changed since the last cleanup.')
+            return True
+
+        if 0 == destColl.estimated_document_count():
+            return True
+
+        markQuery = dict(srcQuery)
+        markQuery['_id'] = { '$lte': oldMark }
+        if srcColl.count_documents(markQuery) != cState.get(type_utils.CLEANUP_RAW_COUNT):
+            print('The raw documents changed since the last cleanup.')
+            return True
+
+        return False
+
+
+
+    #
+    # Return the outlier counts of the previous cleanup as a dict of counts
+    # by attribute path.
+    #
+    def loadOutlierCounts(self, vehicle):
+
+        outlierCounts = {}
+        for path, policy, count in vehicle.getAttrStats().get(type_utils.STATS_OUTLIER_COUNTS, []):
+            outlierCounts[path] = count
+
+        return outlierCounts
+
+
+
+    #
+    # Record the number of outlier values found per attribute in the vehicle
+    # stats, as a list of [path, policy, count] entries.
+    #
+    def saveOutlierCounts(self, vehicle, nPlan, outlierCounts):
+
+        countList = []
+        for path, pathBounds in nPlan.getOutlierBounds().items():
+            policy, lowBound, highBound = pathBounds
+            count = outlierCounts.get(path, 0)
+            countList.append([path, policy, count])
+            print('Outliers of ' + path + ' outside [' + str(lowBound) + ', ' + str(highBound) + '] (' + policy + '): ' + str(count))
+
+        allStats = vehicle.getAttrStats()
+        allStats[type_utils.STATS_OUTLIER_COUNTS] = countList
+        vehicle.setAttrStats(allStats)
 
 
 
@@ -0,0 +1,1132 @@
+#!/usr/bin/env python3
+
+import sys
+import math
+import hashlib
+from fractions import Fraction
+from collections import defaultdict
+
+import numpy
+import pandas as pd
+
+from schema import type_utils
+
+
+#
+# Number of documents normalized together when reading from a cursor.
+#
+BATCH_SIZE      = 10000
+
+#
+# Per-value type codes used to classify a whole attribute column at once.
+# Values of these exact Python types are classified without calling
+# type_utils.ahnungTypeAndValue(), which returns them unchanged.  Any other
+# type falls back to ahnungTypeAndValue() one value at a time.
+#
+CODE_MISSING    = 0
+CODE_INT        = 1
+CODE_FLOAT      = 2
+CODE_STRING     = 3
+CODE_OTHER      = 4
+
+_typeCodes = defaultdict(lambda: CODE_OTHER, {
+    type(None) : CODE_MISSING,
+    bool       : CODE_INT,
+    int        : CODE_INT,
+    float      : CODE_FLOAT,
+    str        : CODE_STRING,
+})
+
+_requiredCodes = {
+    type_utils.TYPE_INT    : CODE_INT,
+    type_utils.TYPE_FLOAT  : CODE_FLOAT,
+    type_utils.TYPE_STRING : CODE_STRING,
+}
+
+_converters = {
+    type_utils.TYPE_INT    : type_utils.convert_int,
+    type_utils.TYPE_FLOAT  : type_utils.convert_float,
+    type_utils.TYPE_DATE   : type_utils.convert_date,
+    type_utils.TYPE_STRING : type_utils.convert_string,
+}
+
+#
+# Outlier policies of numeric attributes.  "clip" clamps values to the Tukey
+# fences computed from the quartiles, "winsorize" clamps values to the
+# WINSOR_QUANTILES and "drop" rejects instances with values outside of the
+# Tukey fences.
+#
+OUTLIER_NONE        = 'none'
+OUTLIER_CLIP        = 'clip'
+OUTLIER_WINSORIZE   = 'winsorize'
+OUTLIER_DROP        = 'drop'
+
+OUTLIER_FENCE_FACTOR = 1.5
+WINSOR_QUANTILES     = (0.01, 0.99)
+
+#
+# Missing value strategies of attributes.  "default" fills in the default
+# value selected by the schema stage, "mean", "median" and "mode" fill in
+# that statistic of the values seen by the schema stage, "alwaysInstance"
+# rejects instances missing the attribute and "alwaysFeature" drops the
+# attribute when it is missing from any instance (see the schema stage).
+#
+MISSING_DEFAULT          = 'default'
+MISSING_MEAN             = 'mean'
+MISSING_MEDIAN           = 'median'
+MISSING_MODE             = 'mode'
+MISSING_ALWAYS_INSTANCE  = 'alwaysInstance'
+MISSING_ALWAYS_FEATURE   = 'alwaysFeature'
+
+#
+# Fraction of the attributes of an instance that may be filled in before the
+# instance is rejected, unless configured otherwise.
+#
+DEF_ALLOW_FRACTION       = '0.1'
+
+#
+# Integer dtypes considered for compact columns, narrowest first.
+#
+COMPACT_INT_DTYPES = (numpy.int8, numpy.int16, numpy.int32, numpy.int64)
+
+
+#
+# Number of default values allowed in a single instance/document before the
+# instance is rejected, for the fraction `allowFraction` of the attributes.
+# The fraction is applied exactly, so "0.1" allows 1 + len(pathList) // 10.
+#
+def getDefaultAllowance(pathList, allowFraction=DEF_ALLOW_FRACTION):
+    return 1 + int(Fraction(str(allowFraction)) * len(pathList))
+
+
+#
+# Group the documents returned by `docIter` into lists of at most `batchSize`.
+#
+def iterBatches(docIter, batchSize=BATCH_SIZE):
+
+    docBatch = []
+    for nDoc in docIter:
+        docBatch.append(nDoc)
+        if len(docBatch) >= batchSize:
+            yield docBatch
+            docBatch = []
+
+    if len(docBatch) > 0:
+        yield docBatch
+
+
+#
+# Assign each document `_id` in `idValues` to one of `foldCount` folds and,
+# with probability `holdoutFraction`, to the holdout.  The labels come from a
+# hash of the `_id` keyed by `seed`, so a document keeps its labels however
+# and whenever the collection is loaded.
+#
+# Returns numpy arrays of the fold numbers and of the holdout flags.
+#
+def assignFolds(idValues, seed, foldCount, holdoutFraction):
+
+    seedKey  = str(seed).encode('utf-8')
+    idHashes = numpy.fromiter(
+                   (int.from_bytes(hashlib.blake2b(str(idValue).encode('utf-8'), digest_size=8, key=seedKey).digest(), 'little') for idValue in idValues),
+                   dtype=numpy.uint64, count=len(idValues))
+
+    # The top 53 bits give a uniform fraction in [0, 1) for the holdout and
+    # the remainder modulo `foldCount` selects the fold.
+    holdout  = (idHashes >> numpy.uint64(11)).astype(numpy.float64) / float(2 ** 53) < holdoutFraction
+    folds    = (idHashes % numpy.uint64(foldCount)).astype(numpy.int64)
+
+    return folds, holdout
+
+
+#
+# Classify every value in `values` with one of the CODE_* constants.
+#
+def classifyValues(values):
+    return numpy.fromiter(map(_typeCodes.__getitem__, map(type, values)), dtype=numpy.int8, count=len(values))
+
+
+
+#
+# -- NormalizedBatch
+#
+# Result of normalizing a batch of flattened documents.  Holds one object
+# column per attribute path (in `pathList` order) containing exactly the
+# values normalizeToList() would produce, plus the per-row default counts
+# and the mask of rows that were kept.  Rejected rows remain in the columns
+# so that callers can line results up with their input documents.
+#
+class NormalizedBatch(object):
+    """ Column oriented result of normalizeBatch().
+    """
+
+    #
+    #
+    #
+    def __init__(self, pathList, columns, keepMask, defCounts, idColumn=None, stringColumns=None, outlierCounts=None):
+
+        self.pathList       = pathList
+        self.columns        = columns
+        self.keepMask       = keepMask
+        self.defCounts      = defCounts
+        self.idColumn       = idColumn
+        self.stringColumns  = stringColumns
+        self.outlierCounts  = outlierCounts if None != outlierCounts else {}
+
+
+    #
+    #
+    #
+    def getRowCount(self):
+        return len(self.keepMask)
+
+
+    #
+    #
+    #
+    def getKeptCount(self):
+        return int(numpy.count_nonzero(self.keepMask))
+
+
+    #
+    #
+    #
+    def getRejectedCount(self):
+        return self.getRowCount() - self.getKeptCount()
+
+
+    #
+    # Return the column for `path` restricted to the kept rows.
+    #
+    def getColumn(self, path):
+        return self.columns[path][self.keepMask]
+
+
+    #
+    # Return the kept rows as a list of normalized documents, one dict per row,
+    # equal to the `normDoc` results of normalizeToList().  With `withIds` the
+    # `_id` of each input document is carried over to its normalized document.
+    # With `withStrings` the original strings of the dictionary encoded
+    # categorical attributes are added in a type_utils.CLEANED_STRINGS field.
+    #
+    def getDocs(self, withIds=False, withStrings=False):
+        keptPaths = self.pathList
+        keptCols  = [self.getColumn(path) for path in self.pathList]
+        if withIds and self.idColumn is not None:
+            keptPaths = ['_id'] + keptPaths
+            keptCols  = [self.idColumn[self.keepMask]] + keptCols
+        resultDocs = [dict(zip(keptPaths, row)) for row in zip(*keptCols)]
+
+        if withStrings and None != self.stringColumns and len(self.stringColumns) > 0:
+            strPaths = list(self.stringColumns.keys())
+            strCols  = [self.stringColumns[path][self.keepMask] for path in strPaths]
+            for normDoc, strRow in zip(resultDocs, zip(*strCols)):
+                normDoc[type_utils.CLEANED_STRINGS] = dict(zip(strPaths, strRow))
+
+        return resultDocs
+
+
+    #
+    # Return the number of rows with an outlier value, keyed by attribute path.
+    #
+    def getOutlierCounts(self):
+        return self.outlierCounts
+
+
+    #
+    # Return a hash of the normalized value vector of each kept row, equal for
+    # rows holding the same values (target included) in every attribute.
+    #
+    def getRowHashes(self):
+        keptCols = [self.getColumn(path) for path in self.pathList]
+        return [hashlib.blake2b(repr(row).encode('utf-8'), digest_size=16).hexdigest() for row in zip(*keptCols)]
+
+
+    #
+    # Return the kept rows as a list of value lists, equal to the `valList`
+    # results of normalizeToList().
+    #
+    def getValueLists(self):
+        keptCols = [self.getColumn(path) for path in self.pathList]
+        return [list(row) for row in zip(*keptCols)]
+
+
+    #
+    # Return the kept rows as a pandas DataFrame with one typed column per path.
+    # Columns listed in `dtypes` are packed to that dtype, see packColumn(),
+    # the remaining columns get the dtype inferred by pandas.
+    #
+    def getFrame(self, dtypes=None):
+        colDict = {}
+        for path in self.pathList:
+            column = self.getColumn(path)
+            if None != dtypes and None != dtypes.get(path):
+                column = packColumn(column, dtypes[path], path)
+            colDict[path] = column
+        return pd.DataFrame(colDict, columns=self.pathList).infer_objects()
+
+
+
+#
+# Combine several NormalizedBatch results over the same `pathList` into one.
+#
+def mergeBatches(batchList, pathList):
+
+    pathList  = list(pathList)
+    columns   = {}
+
+    if 0 == len(batchList):
+        for path in pathList:
+            columns[path] = numpy.empty(0, dtype=object)
+        return NormalizedBatch(pathList, columns, numpy.zeros(0, dtype=bool), numpy.zeros(0, dtype=numpy.int32), numpy.empty(0, dtype=object))
+
+    for path in pathList:
+        columns[path] = numpy.concatenate([nBatch.columns[path] for nBatch in batchList])
+
+    keepMask   = numpy.concatenate([nBatch.keepMask for nBatch in batchList])
+    defCounts  = numpy.concatenate([nBatch.defCounts for nBatch in batchList])
+    idColumn   = numpy.concatenate([nBatch.idColumn for nBatch in batchList])
+
+    stringColumns = None
+    if None != batchList[0].stringColumns:
+        stringColumns = {}
+        for path in batchList[0].stringColumns.keys():
+            stringColumns[path] = numpy.concatenate([nBatch.stringColumns[path] for nBatch in batchList])
+
+    outlierCounts = {}
+    for nBatch in batchList:
+        addOutlierCounts(outlierCounts, nBatch.getOutlierCounts())
+
+    return NormalizedBatch(pathList, columns, keepMask, defCounts, idColumn, stringColumns, outlierCounts)
+
+
+
+#
+# -- ColumnLoader
+#
+# Loads normalized rows into typed numpy columns preallocated for the
+# expected number of rows, so that a dataset is held once as typed values
+# rather than as Python objects per value.  Rows are either taken from the
+# NormalizedBatch results of NormalizationPlan.apply_batch(), or read from
+# already normalized documents as they are (trusted), see addDocs().
+#
+class ColumnLoader(object):
+    """ Accumulates normalized rows in preallocated typed columns.
+    """
+
+    #
+    # `dtypes` holds the dtype of each column in the plan's path list, see
+    # NormalizationPlan.getColumnDtypes().  With `withCounts` the row counts
+    # stored by deduplicating cleanups are loaded as well.
+    #
+    def __init__(self, nPlan, rowCount, dtypes, withCounts=False):
+
+        self.nPlan      = nPlan
+        self.pathList   = nPlan.getPathList()
+        self.rowCount   = 0
+        self.columns    = {}
+        self.rowCounts  = None
+
+        for path in self.pathList:
+            self.columns[path] = numpy.empty(rowCount, dtype=dtypes[path])
+
+        if withCounts:
+            self.rowCounts = numpy.empty(rowCount, dtype=numpy.int64)
+
+
+    #
+    # Make room for `addCount` more rows, in case documents were added since
+    # the rows were counted.
+    #
+    def reserve(self, addCount):
+
+        needCount = self.rowCount + addCount
+        capacity  = len(self.columns[self.pathList[0]]) if len(self.pathList) > 0 else needCount
+        if needCount <= capacity:
+            return
+
+        capacity = max(needCount, 2 * capacity)
+        for path in self.pathList:
+            column = self.columns[path]
+            self.columns[path] = numpy.empty(capacity, dtype=column.dtype)
+            self.columns[path][:self.rowCount] = column[:self.rowCount]
+
+        if self.rowCounts is not None:
+            rowCounts = self.rowCounts
+            self.rowCounts = numpy.empty(capacity, dtype=numpy.int64)
+            self.rowCounts[:self.rowCount] = rowCounts[:self.rowCount]
+
+
+    #
+    # Store `values` as the next rows of the column of `path`.  Integer
+    # columns are widened when the values exceed the range of their dtype,
+    # as in packColumn(), and columns that can not hold the values fall back
+    # to objects.
+    #
+    def storeValues(self, path, values):
+
+        column   = self.columns[path]
+        rowStart = self.rowCount
+        rowEnd   = rowStart + len(values)
+
+        try:
+            if 'i' == column.dtype.kind:
+                values = numpy.asarray(values, dtype=numpy.int64)
+                if len(values) > 0:
+                    packType = selectIntDtype(values.min(), values.max())
+                    if packType.itemsize > column.dtype.itemsize:
+                        print('Values of ' + path + ' exceed the recorded range, using ' + str(packType) + ' instead of ' + str(column.dtype) + '.')
+                        column = column.astype(packType)
+            elif 'O' != column.dtype.kind:
+                values = numpy.asarray(values, dtype=column.dtype)
+        except (ValueError, TypeError, OverflowError) as eX:
+            column = column.astype(object)
+
+        column[rowStart:rowEnd] = values
+        self.columns[path] = column
+
+
+    #
+    # Add the kept rows of the NormalizedBatch `nBatch`, normalized from the
+    # documents in `docBatch`.
+    #
+    def addBatch(self, nBatch, docBatch):
+
+        keptCount = nBatch.getKeptCount()
+        self.reserve(keptCount)
+
+        for path in self.pathList:
+            self.storeValues(path, nBatch.getColumn(path))
+
+        if self.rowCounts is not None:
+            docCounts = numpy.fromiter((nDoc.get(type_utils.CLEANED_COUNT, 1) for nDoc in docBatch), dtype=numpy.int64, count=len(docBatch))
+            self.rowCounts[self.rowCount:self.rowCount + keptCount] = docCounts[nBatch.keepMask]
+
+        self.rowCount += keptCount
+
+
+    #
+    # Add the documents in `docBatch`, which must already be normalized by the
+    # plan, without normalizing them again.  A batch with a missing or
+    # mistyped value is normalized after all, so that it is rejected or filled
+    # in as usual.
+    #
+    def addDocs(self, docBatch):
+
+        docCount = len(docBatch)
+        batchColumns = {}
+
+        try:
+            for path in self.pathList:
+                dtype   = self.columns[path].dtype
+                values  = [nDoc.get(path) for nDoc in docBatch]
+                if None in values:
+                    raise ValueError('Missing value of ' + path)
+                if 'O' == dtype.kind:
+                    column     = numpy.empty(docCount, dtype=object)
+                    column[:]  = values
+                else:
+                    column = numpy.array(values, dtype=(numpy.int64 if 'i' == dtype.kind else dtype))
+                batchColumns[path] = column
+        except (ValueError, TypeError, OverflowError) as eX:
+            self.addBatch(self.nPlan.apply_batch(docBatch), docBatch)
+            return
+
+        self.reserve(docCount)
+
+        for path in self.pathList:
+            self.storeValues(path, batchColumns[path])
+
+        if self.rowCounts is not None:
+            self.rowCounts[self.rowCount:self.rowCount + docCount] = [nDoc.get(type_utils.CLEANED_COUNT, 1) for nDoc in docBatch]
+
+        self.rowCount += docCount
+
+
+    #
+    # Return the number of rows loaded so far.
+    #
+    def getRowCount(self):
+        return self.rowCount
+
+
+    #
+    # Return the row counts of the loaded rows, or None if not loaded.
+    #
+    def getRowCounts(self):
+        if self.rowCounts is None:
+            return None
+        return self.rowCounts[:self.rowCount]
+
+
+    #
+    # Return the loaded rows as a dictionary of the column of each path, in
+    # the order of the plan's path list.  Columns with room for more rows
+    # are trimmed to a copy, and object columns holding numbers are
+    # converted as by DataFrame.infer_objects().
+    #
+    def getColumns(self):
+        colDict = {}
+        for path in self.pathList:
+            column = self.columns[path][:self.rowCount]
+            if len(self.columns[path]) > self.rowCount:
+                column = column.copy()
+            if 'O' == column.dtype.kind:
+                column = pd.Series(column).infer_objects().to_numpy()
+            colDict[path] = column
+        return colDict
+
+
+    #
+    # Return the loaded rows as a pandas DataFrame.
+    #
+    def getFrame(self):
+        return pd.DataFrame(self.getColumns(), columns=self.pathList)
+
+
+#
+# Add the outlier counts in `addCounts` to `outlierCounts`.
+#
+def addOutlierCounts(outlierCounts, addCounts):
+    for path, count in addCounts.items():
+        outlierCounts[path] = outlierCounts.get(path, 0) + count
+
+
+
+#
+# Return the narrowest integer dtype holding every value in the range
+# [`minValue`, `maxValue`].
+#
+def selectIntDtype(minValue, maxValue):
+
+    for intType in COMPACT_INT_DTYPES:
+        intInfo = numpy.iinfo(intType)
+        if intInfo.min <= minValue and maxValue <= intInfo.max:
+            return numpy.dtype(intType)
+
+    return None
+
+
+#
+# Select a compact dtype for each attribute path in `pathList`.
+#
+# Encoded categorical attributes hold codes below the number of classes of
+# their encoder.  Integer attributes use the value range recorded by the
+# schema stage in `attrStats`, widened to include the default value.  Float
+# attributes stay float64.  Paths without a usable range are left for pandas
+# to infer.
+#
+def selectDtypes(pathList, valTypes, defValues, attrStats, attrEncoders):
+
+    dtypes = {}
+
+    for path in pathList:
+
+        valType      = valTypes.get(path)
+        attrEncoder  = attrEncoders.get(path)
+        pathStats    = attrStats.get(path)
+
+        if None != attrEncoder:
+            dtypes[path] = selectIntDtype(0, max(0, len(attrEncoder.classes_) - 1))
+        elif valType in [type_utils.TYPE_INT, type_utils.TYPE_LONG]:
+            if isinstance( pathStats, dict ):
+                minValue = pathStats.get(type_utils.ATTR_MIN)
+                maxValue = pathStats.get(type_utils.ATTR_MAX)
+                if None != minValue and None != maxValue and math.isfinite(minValue) and math.isfinite(maxValue):
+                    # Float values are truncated toward zero by int().
+                    minValue  = math.floor(minValue)
+                    maxValue  = math.ceil(maxValue)
+                    defValue  = defValues.get(path)
+                    if isinstance( defValue, (int, float) ) and math.isfinite(defValue):
+                        minValue  = min(minValue, math.floor(defValue))
+                        maxValue  = max(maxValue, math.ceil(defValue))
+                    dtypes[path] = selectIntDtype(minValue, maxValue)
+        elif type_utils.TYPE_FLOAT == valType:
+            dtypes[path] = numpy.dtype(numpy.float64)
+
+    return dtypes
+
+
+#
+# Return the value of quantile `quant` in the [quantile, value] pairs
+# `quantPairs` recorded by the schema stage, or None if not recorded.
+#
+def getQuantile(quantPairs, quant):
+
+    for pairQuant, pairValue in quantPairs:
+        if pairQuant == quant:
+            return pairValue
+
+    return None
+
+
+#
+# Compute the outlier bounds of each attribute in `attrPolicies`, a dict of
+# the outlier policy keyed by attribute path.  The bounds come from the
+# quantiles the schema stage recorded in `attrStats`.  Bounds of integer
+# attributes are rounded inwards so that clamped values remain integers.
+#
+# Returns a dict of (policy, lowBound, highBound) keyed by attribute path.
+# Attributes with policy "none" or without recorded quantiles are left out.
+#
+def computeOutlierBounds(valTypes, attrStats, attrPolicies):
+
+    outlierBounds = {}
+
+    for path, policy in attrPolicies.items():
+
+        pathStats = attrStats.get(path)
+        if OUTLIER_NONE == policy or not isinstance( pathStats, dict ):
+            continue
+        quantPairs = pathStats.get(type_utils.ATTR_QUANTILES)
+        if None == quantPairs:
+            continue
+
+        if OUTLIER_WINSORIZE == policy:
+            lowBound   = getQuantile(quantPairs, WINSOR_QUANTILES[0])
+            highBound  = getQuantile(quantPairs, WINSOR_QUANTILES[1])
+        elif policy in [OUTLIER_CLIP, OUTLIER_DROP]:
+            lowQuart   = getQuantile(quantPairs, 0.25)
+            highQuart  = getQuantile(quantPairs, 0.75)
+            if None == lowQuart or None == highQuart:
+                continue
+            fenceWidth = OUTLIER_FENCE_FACTOR * (highQuart - lowQuart)
+            lowBound   = lowQuart - fenceWidth
+            highBound  = highQuart + fenceWidth
+        else:
+            print('Unknown outlier policy ' + str(policy) + ' for ' + path + ', not suppressing outliers.')
+            continue
+
+        if None == lowBound or None == highBound:
+            continue
+
+        if valTypes.get(path) in [type_utils.TYPE_INT, type_utils.TYPE_LONG]:
+            lowBound   = int(math.ceil(lowBound))
+            highBound  = int(math.floor(highBound))
+        else:
+            lowBound   = float(lowBound)
+            highBound  = float(highBound)
+
+        if lowBound <= highBound:
+            outlierBounds[path] = (policy, lowBound, highBound)
+
+    return outlierBounds
+
+
+#
+# Compute the values filled in for missing attributes, keyed by path, from
+# the schema defaults `defValues` and the missing value strategy of each
+# attribute in `attrStrategies`.  The mean, median and mode come from the
+# statistics the schema stage recorded in `attrStats` and are converted to
+# the attribute's type, rounding to the nearest integer for integer types.
+# Attributes whose statistic is not recorded or can not be converted keep
+# their default value.
+#
+def computeImputeValues(valTypes, defValues, attrStats, attrStrategies):
+
+    impValues = dict(defValues)
+
+    for path, strategy in attrStrategies.items():
+
+        pathStats = attrStats.get(path)
+        if not path in defValues or not isinstance( pathStats, dict ):
+            continue
+
+        impValue = None
+        if MISSING_MEAN == strategy:
+            impValue = pathStats.get(type_utils.ATTR_MEAN)
+        elif MISSING_MEDIAN == strategy:
+            impValue = getQuantile(pathStats.get(type_utils.ATTR_QUANTILES, []), 0.5)
+        elif MISSING_MODE == strategy:
+            impValue = pathStats.get(type_utils.ATTR_MODE)
+
+        if None == impValue:
+            continue
+
+        valType = valTypes[path]
+        if valType in [type_utils.TYPE_INT, type_utils.TYPE_LONG] and isinstance( impValue, float ):
+            impValue = int(round(impValue))
+
+        converter = AttrConverter(valType, defValues[path])
+        normValue, defUsed, failed = converter.convert(impValue)
+        if not failed and 0 == defUsed:
+            impValues[path] = normValue
+
+    return impValues
+
+
+#
+# Convert the object `column` of attribute `path` to `dtype`.
+#
+# Integer columns are checked against the bounds of `dtype` and widened when
+# a value falls outside of them, for example when documents were added after
+# the schema stage recorded the value ranges.  Columns that can not be
+# converted are returned unchanged.
+#
+def packColumn(column, dtype, path=''):
+
+    try:
+        if 'i' == dtype.kind:
+            wideColumn = numpy.array(column, dtype=numpy.int64)
+            if len(wideColumn) > 0:
+                packType = selectIntDtype(wideColumn.min(), wideColumn.max())
+                if packType.itemsize > dtype.itemsize:
+                    print('Values of ' + path + ' exceed the recorded range, using ' + str(packType) + ' instead of ' + str(dtype) + '.')
+                    dtype = packType
+            return wideColumn.astype(dtype)
+        return numpy.array(column, dtype=dtype)
+    except (ValueError, TypeError, OverflowError) as eX:
+        return column
+
+
+
+#
+# -- AttrConverter
+#
+# Converter for a single attribute, selected once from the attribute's
+# normalized type.  Values that already have the required Python type are
+# returned as they are, any other value takes the same path through
+# type_utils.ahnungTypeAndValue() and the type_utils conversion functions
+# as in normalizeToList().
+#
+class AttrConverter(object):
+    """ Precompiled value conversion for one attribute path.
+    """
+
+    #
+    #
+    #
+    def __init__(self, requiredType, defValue, attrEncoder=None):
+
+        self.requiredType  = requiredType
+        self.defValue      = defValue
+        self.requiredCode  = _requiredCodes.get(requiredType)
+        self.convertFn     = _converters.get(requiredType)
+        self.matchTypes    = frozenset([pyType for pyType, tCode in _typeCodes.items() if tCode == self.requiredCode])
+
+        # Categorical attributes with a fitted encoder are dictionary encoded
+        # to the integer codes of the encoder.  The default value encodes to
+        # the code of its string, or to the first category if it has none.
+        self.codeIndex     = None
+        self.codeMap       = None
+        self.defCode       = None
+        if None != attrEncoder:
+            self.codeIndex = pd.Index([str(nClass) for nClass in attrEncoder.classes_])
+            self.codeMap   = dict(zip(self.codeIndex, range(len(self.codeIndex))))
+            self.defCode   = self.codeMap.get(str(defValue), 0)
+
+
+    #
+    #
+    #
+    def isEncoded(self):
+        return None != self.codeMap
+
+
+    #
+    # Return the integer code of the normalized value `normValue` and the
+    # number of defaults used.  Values unseen by the encoder are replaced by
+    # the code of the default value and counted as a default.
+    #
+    def encode(self, normValue):
+
+        code = self.codeMap.get(normValue)
+        if None == code:
+            return self.defCode, 1
+
+        return code, 0
+
+
+    #
+    # Return the class string for the integer `code`.
+    #
+    def decode(self, code):
+        return self.codeIndex[code]
+
+
+    #
+    # Convert a mismatched value through the type_utils conversion function.
+    # Returns the normalized value and the number of defaults used (0 or 1).
+    #
+    def convertMismatch(self, value):
+
+        if None == self.convertFn:
+            return value, 0
+
+        return self.convertFn(value, self.defValue, 0)
+
+
+    #
+    # Convert a single value that is present.  Returns the normalized value,
+    # the number of defaults used and whether the value has an unknown type,
+    # which rejects the whole instance/document.
+    #
+    def convert(self, value):
+
+        vType = type(value)
+        if vType in self.matchTypes:
+            return value, 0, False
+
+        if CODE_OTHER == _typeCodes[vType]:
+            fkType, fkValue = type_utils.ahnungTypeAndValue(value)
+            if type_utils.TYPE_UNKNOWN == fkType:
+                return None, 0, True
+            elif self.requiredType == fkType:
+                return fkValue, 0, False
+
+        normValue, defUsed = self.convertMismatch(value)
+
+        return normValue, defUsed, False
+
+
+
+#
+# -- NormalizationPlan
+#
+# The per-attribute work of normalizing a flattened document depends only on
+# the estimator metadata, so it is decided once per vehicle.  The plan holds
+# an ordered tuple of (path, converter, default, is_target, is_required)
+# entries and applies them to a single document with apply() or to a list of
+# documents column by column with apply_batch().
+#
+# Numeric attributes listed in `outlierBounds` are clamped to their bounds,
+# or the instance is rejected for the "drop" policy, after conversion.
+#
+# Missing values of the attributes in `requiredPaths` reject the instance,
+# as for the target.  Each attribute in `indicatorPaths` gets an integer
+# missing-indicator attribute, named by the dict value, appended after the
+# attributes in `pathList`.  The number of missing or invalid values allowed
+# per instance is the fraction `allowFraction` of the attributes.
+#
+class NormalizationPlan(object):
+    """ Precompiled normalization of flattened documents for an estimator.
+    """
+
+    #
+    #
+    #
+    def __init__(self, pathList, valTypes, defValues, attrSenses, target, attrEncoders=None, outlierBounds=None,
+                 requiredPaths=None, indicatorPaths=None, allowFraction=DEF_ALLOW_FRACTION):
+
+        planEntries = []
+
+        for path in pathList:
+            defValue     = defValues[path]
+            attrEncoder  = None
+            if None != attrEncoders:
+                attrEncoder = attrEncoders.get(path)
+            converter    = AttrConverter(valTypes[path], defValue, attrEncoder)
+            if converter.isEncoded():
+                # Missing values are filled with the encoded default.
+                defValue = converter.defCode
+            isRequired   = target == path or (None != requiredPaths and path in requiredPaths)
+            planEntries.append((path, converter, defValue, target == path, isRequired))
+
+        self.entries    = tuple(planEntries)
+        self.target     = target
+        self.defAllow   = getDefaultAllowance(planEntries, allowFraction)
+
+        self.indicators = []
+        if None != indicatorPaths:
+            self.indicators = [(path, indicatorPaths[path]) for path in pathList if path in indicatorPaths]
+
+        self.pathList   = [nEntry[0] for nEntry in self.entries] + [nIndicator[1] for nIndicator in self.indicators]
+
+        self.outlierBounds = {}
+        if None != outlierBounds:
+            self.outlierBounds = {path: outlierBounds[path] for path in self.pathList if path in outlierBounds}
+
+        self.senseList  = None
+        if None != attrSenses:
+            self.senseList = [attrSenses.get(path) for path in self.pathList]
+
+
+    #
+    #
+    #
+    def getPathList(self):
+        return self.pathList
+
+
+    #
+    #
+    #
+    def getSenseList(self):
+        return self.senseList
+
+
+    #
+    #
+    #
+    def getOutlierBounds(self):
+        return self.outlierBounds
+
+
+    #
+    # Normalize the flattened document `flatDoc`.  Returns the normalized
+    # document and value list, or (None, None) if the document is rejected,
+    # exactly as normalizeToList().
+    #
+    def apply(self, flatDoc):
+
+        normDoc   = {}
+        valList   = []
+        defCount  = 0
+
+        for path, converter, defValue, isTarget, isRequired in self.entries:
+
+            value = flatDoc.get(path)
+
+            if None == value:
+                if isRequired:
+                    # The target and required attributes must have a value present.
+                    return None, None
+                normValue  = defValue
+                defCount  += 1
+            else:
+                normValue, defUsed, failed = converter.convert(value)
+                if failed:
+                    return None, None
+                defCount += defUsed
+                if converter.isEncoded():
+                    normValue, defUsed = converter.encode(normValue)
+                    if isTarget and defUsed > 0:
+                        # An unseen target value can not be replaced.
+                        return None, None
+                    defCount += defUsed
+
+            pathBounds = self.outlierBounds.get(path)
+            if None != pathBounds:
+                policy, lowBound, highBound = pathBounds
+                if normValue < lowBound:
+                    if OUTLIER_DROP == policy:
+                        return None, None
+                    normValue = lowBound
+                elif normValue > highBound:
+                    if OUTLIER_DROP == policy:
+                        return None, None
+                    normValue = highBound
+
+            normDoc[path] = normValue
+            valList.append(normValue)
+
+        # If too many default values were required, reject the instance/document.
+        if defCount > self.defAllow:
+            return None, None
+
+        for path, indicatorPath in self.indicators:
+            isMissing = 1 if None == flatDoc.get(path) else 0
+            normDoc[indicatorPath] = isMissing
+            valList.append(isMissing)
+
+        return normDoc, valList
+
+
+    #
+    # Normalize the flattened documents in `flatDocs` one attribute at a time.
+    #
+    # Each attribute column is classified by type in a single pass, values
+    # that already have the required type are kept as they are, missing
+    # values are filled from the defaults and only the mismatched values go
+    # through the converters.  Default counting and row rejection are done
+    # with numpy masks over the whole batch.  The values kept for each row
+    # are the same objects apply() would return for that document.
+    #
+    def apply_batch(self, flatDocs):
+
+        docCount   = len(flatDocs)
+
+        defCounts  = numpy.zeros(docCount, dtype=numpy.int32)
+        failMask   = numpy.zeros(docCount, dtype=bool)
+        columns    = {}
+
+        idColumn      = numpy.empty(docCount, dtype=object)
+        idColumn[:]   = [nFlat.get('_id') for nFlat in flatDocs]
+        stringColumns = {}
+        outlierCounts = {}
+        indicatorMasks = {path: None for path, indicatorPath in self.indicators}
+
+        for path, converter, defValue, isTarget, isRequired in self.entries:
+
+            column     = numpy.empty(docCount, dtype=object)
+            column[:]  = [nFlat.get(path) for nFlat in flatDocs]
+            codes      = classifyValues(column)
+
+            # Missing values fail the row for the target and required
+            # attributes and are replaced by the default (and counted) for
+            # all other attributes.  Encoded attributes are filled once they
+            # have been encoded.
+            missing = (CODE_MISSING == codes)
+            if isRequired:
+                failMask |= missing
+            elif converter.isEncoded():
+                defCounts       += missing
+            else:
+                column[missing]  = defValue
+                defCounts       += missing
+
+            # Rows that already failed on an earlier attribute are not
+            # converted, matching the early exit of apply().
+            mismatched = ~missing & ~failMask & (converter.requiredCode != codes)
+
+            for idx in numpy.flatnonzero(mismatched):
+                normValue, defUsed, failed = converter.convert(column[idx])
+                if failed:
+                    failMask[idx] = True
+                else:
+                    column[idx]      = normValue
+                    defCounts[idx]  += defUsed
+
+            if path in self.outlierBounds:
+                outlierCounts[path] = self.suppressOutliers(path, column, failMask)
+
+            if converter.isEncoded():
+                # Dictionary encode the whole column with one hash lookup per
+                # value.  Present values unseen by the encoder use the default,
+                # except for the target where they reject the row.
+                stringColumns[path]  = column
+                codeIdx              = converter.codeIndex.get_indexer(column)
+                unseen               = (codeIdx < 0) & ~missing & ~failMask
+                if isTarget:
+                    failMask        |= unseen
+                else:
+                    defCounts       += unseen
+                codeIdx[codeIdx < 0] = defValue
+                column               = numpy.empty(docCount, dtype=object)
+                column[:]            = codeIdx.tolist()
+
+            columns[path] = column
+
+            if path in indicatorMasks:
+                indicatorMasks[path] = missing
+
+        # If too many default values were required, reject the instance/document.
+        failMask |= (defCounts > self.defAllow)
+
+        for path, indicatorPath in self.indicators:
+            column     = numpy.empty(docCount, dtype=object)
+            column[:]  = indicatorMasks[path].astype(numpy.int8).tolist()
+            columns[indicatorPath] = column
+
+        return NormalizedBatch(self.pathList, columns, ~failMask, defCounts, idColumn, stringColumns, outlierCounts)
+
+
+    #
+    # Apply the outlier bounds of attribute `path` to the normalized values in
+    # `column`, for the rows not already failed in `failMask`.  Values outside
+    # the bounds are clamped in place, or their rows are added to `failMask`
+    # for the "drop" policy.  Returns the number of values outside the bounds.
+    #
+    def suppressOutliers(self, path, column, failMask):
+
+        policy, lowBound, highBound = self.outlierBounds[path]
+
+        liveMask          = ~failMask
+        values            = numpy.full(len(column), numpy.nan)
+        values[liveMask]  = numpy.array(column[liveMask], dtype=numpy.float64)
+
+        # NaN values of failed rows compare False on both sides.
+        belowMask  = values < lowBound
+        aboveMask  = values > highBound
+
+        if OUTLIER_DROP == policy:
+            failMask |= belowMask | aboveMask
+        else:
+            column[belowMask] = lowBound
+            column[aboveMask] = highBound
+
+        return int(numpy.count_nonzero(belowMask) + numpy.count_nonzero(aboveMask))
+
+
+    #
+    # Return the dtype of each column in the path list, for use with
+    # ColumnLoader.  Columns listed in `dtypes`, the compact dtypes of
+    # selectDtypes(), keep that dtype.  Other integer and float columns are
+    # 64-bit, and columns of any other type hold objects.
+    #
+    def getColumnDtypes(self, dtypes=None):
+
+        colTypes = {}
+        for path, converter, defValue, isTarget, isRequired in self.entries:
+            if None != dtypes and None != dtypes.get(path):
+                colTypes[path] = numpy.dtype(dtypes[path])
+            elif converter.isEncoded() or converter.requiredType in [type_utils.TYPE_INT, type_utils.TYPE_LONG]:
+                colTypes[path] = numpy.dtype(numpy.int64)
+            elif type_utils.TYPE_FLOAT == converter.requiredType:
+                colTypes[path] = numpy.dtype(numpy.float64)
+            else:
+                colTypes[path] = numpy.dtype(object)
+
+        for path, indicatorPath in self.indicators:
+            colTypes[indicatorPath] = numpy.dtype(numpy.int8)
+
+        return colTypes
+
+
+    #
+    # Return a hash of everything that determines the normalized documents of
+    # this plan: the attributes, their types, fill-in values, encoder classes,
+    # outlier bounds and missing-indicators and the default allowance.  Plans
+    # with the same fingerprint produce the same cleaned documents.
+    #
+    def getFingerprint(self):
+
+        entryList = []
+        for path, converter, defValue, isTarget, isRequired in self.entries:
+            classList = None
+            if converter.isEncoded():
+                classList = list(converter.codeIndex)
+            entryList.append((path, converter.requiredType, repr(defValue), isTarget, isRequired, classList, self.outlierBounds.get(path)))
+
+        planSummary = (entryList, self.indicators, self.defAllow)
+
+        return hashlib.blake2b(repr(planSummary).encode('utf-8'), digest_size=16).hexdigest()
+
+
+    #
+    # Return a copy of the normalized document `normDoc` with the integer
+    # codes of the encoded categorical attributes replaced by their strings.
+    #
+    def decodeDoc(self, normDoc):
+
+        resDoc = dict(normDoc)
+
+        for path, converter, defValue, isTarget, isRequired in self.entries:
+            if converter.isEncoded() and path in resDoc:
+                resDoc[path] = converter.decode(resDoc[path])
+
+        return resDoc
+
+
+
+#
+# Normalize the flattened documents in `flatDocs` with a plan built from the
+# given metadata.  Callers normalizing many batches for the same estimator
+# should reuse the vehicle's plan instead, see
+# AhnungVehicle.getNormalizationPlan().
+#
+def normalizeBatch(flatDocs, pathList, valTypes, defValues, target):
+
+    nPlan = NormalizationPlan(pathList, valTypes, defValues, None, target)
+
+    return nPlan.apply_batch(flatDocs)
+
+
+
+#
+# Build the plan that reads documents from the cleaned collection, where the
+# categorical attributes encoded by `attrEncoders` already hold integer codes.
+# Those attributes are read as integers and default to the encoded default.
+#
+def makeCleanedPlan(pathList, valTypes, defValues, attrSenses, target, attrEncoders):
+
+    codeTypes     = dict(valTypes)
+    codeDefaults  = dict(defValues)
+
+    for path in pathList:
+        attrEncoder = attrEncoders.get(path)
+        if None != attrEncoder:
+            converter           = AttrConverter(valTypes[path], defValues[path], attrEncoder)
+            codeTypes[path]     = type_utils.TYPE_INT
+            codeDefaults[path]  = converter.defCode
+
+    return NormalizationPlan(pathList, codeTypes, codeDefaults, attrSenses, target)
@@ -1,4 +1,5 @@
 
+import os
 import sys
 import json
 import getpass
@@ -24,25 +25,70 @@ class AhnungConfig(object):
     IS_CLASSIFICATION   = 'is_classification'
     IS_REGRESSION       = 'is_regression'
     RANDOM_SEED         = 'random_seed'
+    SEARCH_SEED         = 'search_seed'
     ALLOWED_CPUS        = 'allowed_cpus'
+    CPU_BUDGET          = 'cpu_budget'
+    DASK_SCHEDULER      = 'dask_scheduler'
+    DASK_LOCAL          = 'local'
+    DASK_WORKERS        = 'dask_workers'
+    SEARCH_TMP_FOLDER   = 'search_tmp_folder'
     MAX_GLOBAL_TIME     = 'max_global_time'
     MAX_PERMODEL_TIME   = 'max_permodel_time'
     ENSEMBLE_SIZE       = 'ensemble_size'
     ENSEMBLE_NBEST      = 'ensemble_nbest'
     MAX_MODELS_ON_DISC  = 'max_models_on_disc'
     METRIC              = 'metric'
+    HOLDOUT_FRACTION    = 'holdout_fraction'
+    RESAMPLING_STRATEGY = 'resampling_strategy'
+    RESAMPLE_AUTO       = 'auto'
 
     SCHEMA_PROPERTIES   = 'schema_properties'
     AT_MIN_PRESENT      = 'attr_type_min_present'
     AT_MIN_TYPEALIGN    = 'attr_type_min_typealign'
     MAX_CAT_VALS        = 'max_categorical_values'
 
+    CLEANUP_PROPERTIES  = 'cleanup_properties'
+    KEEP_CAT_STRINGS    = 'keep_category_strings'
+    DEDUP_MODE          = 'dedup_mode'
+    DEDUP_NONE          = 'none'
+    DEDUP_DISTINCT      = 'distinct'
+    DEDUP_BOUNDED       = 'bounded'
+    DEDUP_MAX_COPIES    = 'dedup_max_copies'
+    OUTLIER_POLICY      = 'outlier_policy'
+    OUTLIER_ATTR_POLICIES = 'outlier_attr_policies'
+    MISSING_VALUE       = 'missing_value'
+    MISSING_ATTR_VALUES = 'missing_attr_values'
+    MISSING_INDICATORS  = 'missing_indicators'
+    MISSING_ALLOWANCE   = 'missing_allowance'
+    INCREMENTAL_CLEANUP = 'incremental_cleanup'
+
     MODEL_PROPERTIES    = 'model_properties'
     CATEGORY_BALANCING  = 'target_category_balancing'
     BALANCE_CAT_NONE    = 'none'
     BALANCE_CAT_EQUAL   = 'equalize'
     BALANCE_CAT_AVG     = 'average'
+    BALANCE_CAT_WEIGHT  = 'weight'
     CATEGORY_MAX_OVER   = 'category_max_oversample'
+    COMPACT_DTYPES      = 'compact_dtypes'
+    FLOAT32_TRAINING    = 'float32_training'
+    TRUST_CLEANED       = 'trust_cleaned'
+    DATASET_CACHE_DIR   = 'dataset_cache_dir'
+    DATASET_CACHE_MB    = 'dataset_cache_max_mb'
+    DATASET_CACHE_DAYS  = 'dataset_cache_max_age_days'
+    WARM_START          = 'warm_start'
+    WARM_START_CONFIGS  = 'warm_start_configs'
+    META_FEATURE_STORE  = 'meta_feature_store'
+    META_NEIGHBORS      = 'meta_neighbors'
+    PLATEAU_EPSILON     = 'plateau_epsilon'
+    PLATEAU_SECONDS     = 'plateau_seconds'
+    PLATEAU_EVALUATIONS = 'plateau_evaluations'
+    SUCCESSIVE_HALVING  = 'successive_halving'
+    HALVING_MIN_SUBSAMPLE = 'halving_min_subsample'
+    HALVING_ETA         = 'halving_eta'
+    PERMI_ROWS          = 'perm_importance_rows'
+    PERMI_REPEATS       = 'perm_importance_repeats'
+    PERMI_CI            = 'perm_importance_ci'
+    PERMI_CHECK         = 'perm_importance_check'
 
     SERVICE_PROPERTIES  = 'service_properties'
     SERVICE_HOSTNAME    = 'service_hostname'
@@ -69,8 +115,14 @@ class AhnungConfig(object):
     METRIC_RECALL_MICRO     = 'recall_micro'
     METRIC_LOG_LOSS         = 'log_loss'
 
+    DEF_NUM_FOLDS           = 5
+    DEF_HOLDOUT_FRACTION    = 0.2
+    DEF_RESAMPLING_STRATEGY = 'cv-iterative-fit'
     DEF_RANDOM_SEED         = 10001
     DEF_ALLOWED_CPUS        = 1
+    DEF_CPU_BUDGET          = 0
+    DEF_DASK_SCHEDULER      = ''
+    DEF_DASK_WORKERS        = 2
     DEF_MAX_GLOBAL_TIME     = 600
     DEF_PERMODEL_TIME       = 60
     DEF_ENSEMBLE_SIZE       = 50
@@ -79,6 +131,22 @@ class AhnungConfig(object):
     DEF_METRIC              = METRIC_ACCURACY
     DEF_SERV_HOSTNAME       = 'localhost'
     DEF_SERV_PORTNUM        = 8088
+    DEF_DEDUP_MAX_COPIES    = 3
+    DEF_MISSING_VALUE       = 'default'
+    DEF_MISSING_ALLOWANCE   = '0.1'
+    DEF_DATASET_CACHE_DIR   = '~/.cache/ahnung/datasets'
+    DEF_DATASET_CACHE_MB    = 4096
+    DEF_DATASET_CACHE_DAYS  = 7.0
+    DEF_WARM_START_CONFIGS  = 10
+    DEF_META_NEIGHBORS      = 3
+    DEF_PLATEAU_EPSILON     = 0.0001
+    DEF_PLATEAU_SECONDS     = 0
+    DEF_PLATEAU_EVALUATIONS = 0
+    DEF_HALVING_MIN_SUBSAMPLE = 0.1
+    DEF_HALVING_ETA         = 3
+    DEF_PERMI_ROWS          = 5000
+    DEF_PERMI_REPEATS       = 10
+    DEF_PERMI_CI            = 0.005
 
     #
     #
@@ -186,6 +254,11 @@ class AhnungConfig(object):
         return props_dict
 
 
+    def getCleanupPropertiesDict(self):
+        props_dict = self.settings.get(self.CLEANUP_PROPERTIES)
+        return props_dict
+
+
     def getModelPropertiesDict(self):
         props_dict = self.settings.get(self.MODEL_PROPERTIES)
         return props_dict
@@ -311,6 +384,20 @@ class AhnungConfig(object):
         return flagBool
 
 
+    #
+    #
+    #
+    def getEstimatorBoolean(self, estName, boolName, defaultVal=False):
+        boolResult = defaultVal
+        estDict = self.getEstimatorByName(estName)
+        boolStr = None
+        if None != estDict:
+            boolStr = estDict.get(boolName)
+        if None != boolStr:
+            boolResult = self.isStringTrue(str(boolStr))
+        return boolResult
+
+
     #
     #
     #
@@ -358,6 +445,70 @@ class AhnungConfig(object):
         return stringVal
 
 
+    #
+    #
+    #
+    def getNumFolds(self):
+
+        num_folds = self.DEF_NUM_FOLDS
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            num_folds_str = gProp_dict.get(self.NUM_FOLDS)
+            if None != num_folds_str:
+                num_folds = int(num_folds_str)
+
+        return num_folds
+
+
+
+    #
+    #
+    #
+    def getHoldoutFraction(self):
+
+        holdout_frac = self.DEF_HOLDOUT_FRACTION
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            holdout_frac_str = gProp_dict.get(self.HOLDOUT_FRACTION)
+            if None != holdout_frac_str:
+                holdout_frac = float(holdout_frac_str)
+
+        return holdout_frac
+
+
+
+    #
+    #
+    #
+    def getResamplingStrategy(self):
+
+        resampling = self.DEF_RESAMPLING_STRATEGY
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            resampling_str = gProp_dict.get(self.RESAMPLING_STRATEGY)
+            if None != resampling_str:
+                resampling = str(resampling_str)
+
+        return resampling
+
+
+
+    #
+    #
+    #
+    def getEstimatorDict(self, estName, dictName, defaultVal=None):
+        dictResult = defaultVal
+        estDict = self.getEstimatorByName(estName)
+        if None != estDict:
+            dictLookup = estDict.get(dictName)
+            if isinstance( dictLookup, dict ):
+                dictResult = dictLookup
+        return dictResult
+
+
     #
     #
     #
@@ -375,6 +526,23 @@ class AhnungConfig(object):
 
 
 
+    #
+    # Return the seed of the model search, or None to use the random seed.
+    #
+    def getSearchSeed(self):
+
+        search_seed = None
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            search_seed_str = gProp_dict.get(self.SEARCH_SEED)
+            if None != search_seed_str:
+                search_seed = int(search_seed_str)
+
+        return search_seed
+
+
+
     #
     #
     #
@@ -392,6 +560,80 @@ class AhnungConfig(object):
 
 
 
+    #
+    # Return the address of the dask scheduler that distributes the model
+    # search, "local" for a cluster of worker processes on this host, or ""
+    # to search with the AutoSKLearn `n_jobs` processes.
+    #
+    def getDaskScheduler(self):
+
+        dask_scheduler = self.DEF_DASK_SCHEDULER
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            dask_scheduler_str = gProp_dict.get(self.DASK_SCHEDULER)
+            if None != dask_scheduler_str:
+                dask_scheduler = str(dask_scheduler_str)
+
+        return dask_scheduler
+
+
+
+    #
+    #
+    #
+    def getDaskWorkers(self):
+
+        dask_workers = self.DEF_DASK_WORKERS
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            dask_workers_str = gProp_dict.get(self.DASK_WORKERS)
+            if None != dask_workers_str:
+                dask_workers = int(dask_workers_str)
+
+        return dask_workers
+
+
+
+    #
+    # Return the folder for the temporary files of the model search, or None
+    # for the AutoSKLearn default.  Distributed searches need a folder that
+    # all worker hosts share.
+    #
+    def getSearchTmpFolder(self):
+
+        tmp_folder = None
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            tmp_folder_str = gProp_dict.get(self.SEARCH_TMP_FOLDER)
+            if None != tmp_folder_str and len(str(tmp_folder_str)) > 0:
+                tmp_folder = str(tmp_folder_str)
+
+        return tmp_folder
+
+
+
+    #
+    # Return the number of CPU cores shared by the model searches of all
+    # estimators when they run concurrently, or 0 to run them one after
+    # another.
+    #
+    def getCPUBudget(self):
+
+        cpu_budget = self.DEF_CPU_BUDGET
+        
+        gProp_dict = self.getGlobalPropertiesDict()
+        if None != gProp_dict:
+            cpu_budget_str = gProp_dict.get(self.CPU_BUDGET)
+            if None != cpu_budget_str:
+                cpu_budget = int(cpu_budget_str)
+
+        return cpu_budget
+
+
+
     #
     #
     #
@@ -590,6 +832,166 @@ class AhnungConfig(object):
         return max_vals
 
 
+    #
+    #
+    #
+    def getCleanupKeepCategoryStrings(self):
+
+        keep_strings = False
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            keep_strings_str = cleanup_dict.get(self.KEEP_CAT_STRINGS)
+            if None != keep_strings_str:
+                keep_strings = self.isStringTrue(str(keep_strings_str))
+
+        return keep_strings
+
+
+    #
+    #
+    #
+    def getCleanupDedupMode(self):
+
+        dedup_mode = self.DEDUP_NONE
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            dedup_str = cleanup_dict.get(self.DEDUP_MODE)
+            if None != dedup_str:
+                dedup_mode = str(dedup_str)
+
+        return dedup_mode
+
+
+    #
+    #
+    #
+    def getCleanupDedupMaxCopies(self):
+
+        max_copies = self.DEF_DEDUP_MAX_COPIES
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            max_copies_str = cleanup_dict.get(self.DEDUP_MAX_COPIES)
+            if None != max_copies_str:
+                max_copies = int(max_copies_str)
+
+        return max_copies
+
+
+    #
+    #
+    #
+    def getCleanupOutlierPolicy(self):
+
+        outlier_policy = 'none'
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            policy_str = cleanup_dict.get(self.OUTLIER_POLICY)
+            if None != policy_str:
+                outlier_policy = str(policy_str)
+
+        return outlier_policy
+
+
+    #
+    #
+    #
+    def getCleanupOutlierAttrPolicies(self):
+
+        attr_policies = {}
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            policies_dict = cleanup_dict.get(self.OUTLIER_ATTR_POLICIES)
+            if isinstance( policies_dict, dict ):
+                attr_policies = policies_dict
+
+        return attr_policies
+
+
+    #
+    #
+    #
+    def getCleanupMissingValue(self):
+
+        missing_value = self.DEF_MISSING_VALUE
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            missing_str = cleanup_dict.get(self.MISSING_VALUE)
+            if None != missing_str:
+                missing_value = str(missing_str)
+
+        return missing_value
+
+
+    #
+    #
+    #
+    def getCleanupMissingAttrValues(self):
+
+        attr_values = {}
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            values_dict = cleanup_dict.get(self.MISSING_ATTR_VALUES)
+            if isinstance( values_dict, dict ):
+                attr_values = values_dict
+
+        return attr_values
+
+
+    #
+    #
+    #
+    def getCleanupMissingIndicators(self):
+
+        indicators = False
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            indicators_str = cleanup_dict.get(self.MISSING_INDICATORS)
+            if None != indicators_str:
+                indicators = self.isStringTrue(str(indicators_str))
+
+        return indicators
+
+
+    #
+    #
+    #
+    def getCleanupMissingAllowance(self):
+
+        allowance = self.DEF_MISSING_ALLOWANCE
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            allowance_str = cleanup_dict.get(self.MISSING_ALLOWANCE)
+            if None != allowance_str:
+                allowance = str(allowance_str)
+
+        return allowance
+
+
+    #
+    #
+    #
+    def getCleanupIncremental(self):
+
+        incremental = True
+        
+        cleanup_dict = self.getCleanupPropertiesDict()
+        if None != cleanup_dict:
+            incremental_str = cleanup_dict.get(self.INCREMENTAL_CLEANUP)
+            if None != incremental_str:
+                incremental = self.isStringTrue(str(incremental_str))
+
+        return incremental
+
+
     #
     #
     #
@@ -622,6 +1024,330 @@ class AhnungConfig(object):
         return max_over
 
 
+    #
+    #
+    #
+    def getModelCompactDtypes(self):
+
+        compact_dtypes = True
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            compact_str = model_dict.get(self.COMPACT_DTYPES)
+            if None != compact_str:
+                compact_dtypes = self.isStringTrue(str(compact_str))
+
+        return compact_dtypes
+
+
+    #
+    #
+    #
+    def getModelTrustCleaned(self):
+
+        trust_cleaned = True
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            trust_str = model_dict.get(self.TRUST_CLEANED)
+            if None != trust_str:
+                trust_cleaned = self.isStringTrue(str(trust_str))
+
+        return trust_cleaned
+
+
+    #
+    # Return the directory of the dataset cache of the model stage, or None
+    # when the cache is disabled with an empty directory name.
+    #
+    def getModelDatasetCacheDir(self):
+
+        cache_dir = self.DEF_DATASET_CACHE_DIR
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            cache_dir_str = model_dict.get(self.DATASET_CACHE_DIR)
+            if None != cache_dir_str:
+                cache_dir = str(cache_dir_str)
+
+        if 0 == len(cache_dir):
+            return None
+
+        return os.path.expanduser(cache_dir)
+
+
+    #
+    #
+    #
+    def getModelDatasetCacheMaxMB(self):
+
+        max_mb = self.DEF_DATASET_CACHE_MB
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            max_mb_str = model_dict.get(self.DATASET_CACHE_MB)
+            if None != max_mb_str:
+                max_mb = int(max_mb_str)
+
+        return max_mb
+
+
+    #
+    #
+    #
+    def getModelDatasetCacheMaxAgeDays(self):
+
+        max_days = self.DEF_DATASET_CACHE_DAYS
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            max_days_str = model_dict.get(self.DATASET_CACHE_DAYS)
+            if None != max_days_str:
+                max_days = float(max_days_str)
+
+        return max_days
+
+
+    #
+    #
+    #
+    def getModelFloat32Training(self):
+
+        use_float32 = False
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            float32_str = model_dict.get(self.FLOAT32_TRAINING)
+            if None != float32_str:
+                use_float32 = self.isStringTrue(str(float32_str))
+
+        return use_float32
+
+
+    #
+    #
+    #
+    def getModelWarmStart(self):
+
+        warm_start = True
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            warm_str = model_dict.get(self.WARM_START)
+            if None != warm_str:
+                warm_start = self.isStringTrue(str(warm_str))
+
+        return warm_start
+
+
+    #
+    #
+    #
+    def getModelWarmStartConfigs(self):
+
+        warm_configs = self.DEF_WARM_START_CONFIGS
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            warm_configs_str = model_dict.get(self.WARM_START_CONFIGS)
+            if None != warm_configs_str:
+                warm_configs = int(warm_configs_str)
+
+        return warm_configs
+
+
+    #
+    #
+    #
+    def getModelMetaFeatureStore(self):
+
+        meta_store = True
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            meta_store_str = model_dict.get(self.META_FEATURE_STORE)
+            if None != meta_store_str:
+                meta_store = self.isStringTrue(str(meta_store_str))
+
+        return meta_store
+
+
+    #
+    #
+    #
+    def getModelMetaNeighbors(self):
+
+        meta_neighbors = self.DEF_META_NEIGHBORS
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            meta_neighbors_str = model_dict.get(self.META_NEIGHBORS)
+            if None != meta_neighbors_str:
+                meta_neighbors = int(meta_neighbors_str)
+
+        return meta_neighbors
+
+
+    #
+    #
+    #
+    def getModelPlateauEpsilon(self):
+
+        epsilon = self.DEF_PLATEAU_EPSILON
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            epsilon_str = model_dict.get(self.PLATEAU_EPSILON)
+            if None != epsilon_str:
+                epsilon = float(epsilon_str)
+
+        return epsilon
+
+
+    #
+    #
+    #
+    def getModelPlateauSeconds(self):
+
+        plateau_seconds = self.DEF_PLATEAU_SECONDS
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            plateau_seconds_str = model_dict.get(self.PLATEAU_SECONDS)
+            if None != plateau_seconds_str:
+                plateau_seconds = int(plateau_seconds_str)
+
+        return plateau_seconds
+
+
+    #
+    #
+    #
+    def getModelPlateauEvaluations(self):
+
+        plateau_evals = self.DEF_PLATEAU_EVALUATIONS
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            plateau_evals_str = model_dict.get(self.PLATEAU_EVALUATIONS)
+            if None != plateau_evals_str:
+                plateau_evals = int(plateau_evals_str)
+
+        return plateau_evals
+
+
+    #
+    #
+    #
+    def getModelSuccessiveHalving(self):
+
+        use_halving = False
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            halving_str = model_dict.get(self.SUCCESSIVE_HALVING)
+            if None != halving_str:
+                use_halving = self.isStringTrue(str(halving_str))
+
+        return use_halving
+
+
+    #
+    #
+    #
+    def getModelHalvingMinSubsample(self):
+
+        min_subsample = self.DEF_HALVING_MIN_SUBSAMPLE
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            min_subsample_str = model_dict.get(self.HALVING_MIN_SUBSAMPLE)
+            if None != min_subsample_str:
+                min_subsample = float(min_subsample_str)
+
+        return min_subsample
+
+
+    #
+    #
+    #
+    def getModelHalvingEta(self):
+
+        halving_eta = self.DEF_HALVING_ETA
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            halving_eta_str = model_dict.get(self.HALVING_ETA)
+            if None != halving_eta_str:
+                halving_eta = int(halving_eta_str)
+
+        return halving_eta
+
+
+    #
+    #
+    #
+    def getModelPermImportanceRows(self):
+
+        permi_rows = self.DEF_PERMI_ROWS
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            permi_rows_str = model_dict.get(self.PERMI_ROWS)
+            if None != permi_rows_str:
+                permi_rows = int(permi_rows_str)
+
+        return permi_rows
+
+
+    #
+    #
+    #
+    def getModelPermImportanceRepeats(self):
+
+        permi_repeats = self.DEF_PERMI_REPEATS
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            permi_repeats_str = model_dict.get(self.PERMI_REPEATS)
+            if None != permi_repeats_str:
+                permi_repeats = int(permi_repeats_str)
+
+        return permi_repeats
+
+
+    #
+    #
+    #
+    def getModelPermImportanceCI(self):
+
+        permi_ci = self.DEF_PERMI_CI
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            permi_ci_str = model_dict.get(self.PERMI_CI)
+            if None != permi_ci_str:
+                permi_ci = float(permi_ci_str)
+
+        return permi_ci
+
+
+    #
+    #
+    #
+    def getModelPermImportanceCheck(self):
+
+        permi_check = False
+        
+        model_dict = self.getModelPropertiesDict()
+        if None != model_dict:
+            permi_check_str = model_dict.get(self.PERMI_CHECK)
+            if None != permi_check_str:
+                permi_check = self.isStringTrue(str(permi_check_str))
+
+        return permi_check
+
+
 
 
 
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import copy
+import time
+import multiprocessing
+
+import numpy
+import pymongo
+
+import matplotlib.figure
+
+from schema import type_utils
+
+from model import explore_hypotheses
+
+
+#
+# Columns of the benchmark results, in the order of the CSV file.
+#
+RESULT_COLUMNS = [
+    'sweep_id',
+    'estimator',
+    'time_budget',
+    'allowed_cpus',
+    'search_seed',
+    'accuracy',
+    'balanced_accuracy',
+    'ensemble_size',
+    'explore_seconds',
+    'refit_seconds',
+    'stop_reason',
+    'peak_rss',
+    'peak_child_rss',
+]
+
+
+
+#
+# -- BenchmarkStage
+#
+# Runs the model stage of one configuration for each point of a sweep over
+# time budgets, CPU counts and search seeds.  Each point runs in a forked
+# process, so that its peak memory is its own, and reads the dataset from the
+# dataset cache after the first point.  The warm start and the meta-feature
+# store are disabled, the points must not learn from each other.  The score,
+# ensemble size, search and refit times and peak memory of each estimator at
+# each point are stored in the benchmark results collection and a CSV file,
+# and the score-versus-time curve of each estimator is printed and charted.
+#
+# Each point replaces the model and statistics of the estimators, the model
+# of the last point stays in the metadata.
+#
+class BenchmarkStage(object):
+    """ Time budget sweep of the model stage.
+    """
+
+    #
+    #
+    #
+    def __init__(self, aConfig, timeBudgets, cpuCounts, searchSeeds, csvFname):
+
+        self.aConfig      = aConfig
+        self.timeBudgets  = timeBudgets
+        self.cpuCounts    = cpuCounts
+        self.searchSeeds  = searchSeeds
+        self.csvFname     = csvFname
+        self.sweepId      = time.strftime('%Y%m%d-%H%M%S')
+
+
+    #
+    # Return a copy of the configuration with the settings of one point of
+    # the sweep, which replace those of the individual estimators.
+    #
+    def getPointConfig(self, timeBudget, cpuCount, searchSeed):
+
+        pointConfig = copy.copy(self.aConfig)
+        pointConfig.settings = copy.deepcopy(self.aConfig.settings)
+
+        searchSettings = {
+            pointConfig.MAX_GLOBAL_TIME  : str(timeBudget),
+            pointConfig.ALLOWED_CPUS     : str(cpuCount),
+            pointConfig.SEARCH_SEED      : str(searchSeed),
+        }
+        modelSettings = {
+            pointConfig.WARM_START          : 'false',
+            pointConfig.META_FEATURE_STORE  : 'false',
+        }
+
+        gProps_dict = pointConfig.getGlobalPropertiesDict()
+        gProps_dict.update(searchSettings)
+        gProps_dict[pointConfig.CPU_BUDGET] = '0'
+        pointConfig.settings.setdefault(pointConfig.MODEL_PROPERTIES, {}).update(modelSettings)
+        for estimator in pointConfig.getEstimatorList():
+            estimator.update(searchSettings)
+            estimator.update(modelSettings)
+
+        pointConfig.vehicleDict = pointConfig.makeDefaultVehicleDict()
+
+        return pointConfig
+
+
+    #
+    # Return the benchmark result of the estimator of `estVehicle` after the
+    # model stage ran.
+    #
+    def getPointResult(self, estVehicle):
+
+        allStats   = estVehicle.getAttrStats()
+        lastRun    = allStats.get(type_utils.STATS_BALANCING_RUNS, [{}])[-1]
+        stopStats  = allStats.get(type_utils.STATS_SEARCH_STOP, {})
+        stepMemory = allStats.get(type_utils.STATS_STEP_MEMORY, {})
+
+        pointResult = {}
+        pointResult['sweep_id']           = self.sweepId
+        pointResult['estimator']          = estVehicle.getEstimatorName()
+        pointResult['time_budget']        = estVehicle.getMaxGlobalTime()
+        pointResult['allowed_cpus']       = estVehicle.getAllowedCPUs()
+        pointResult['search_seed']        = estVehicle.getSearchSeed()
+        pointResult['accuracy']           = lastRun.get('accuracy')
+        pointResult['balanced_accuracy']  = lastRun.get('balanced_accuracy')
+        pointResult['ensemble_size']      = len(estVehicle.getAutoSklearnClassifier().get_models_with_weights())
+        pointResult['explore_seconds']    = stopStats.get('explore_seconds')
+        pointResult['refit_seconds']      = allStats.get(type_utils.STATS_REFIT_SECONDS)
+        pointResult['stop_reason']        = stopStats.get('reason')
+        pointResult['peak_rss']           = max([0] + [nStep['peak_rss'] for nStep in stepMemory.values()])
+        pointResult['peak_child_rss']     = max([0] + [nStep['peak_child_rss'] for nStep in stepMemory.values()])
+
+        return pointResult
+
+
+    #
+    # Run the model stage with `pointConfig`, in a forked process, and put
+    # the list of results of its estimators into `resultQueue`.  The results
+    # are also stored in the benchmark results collection.
+    #
+    def runPoint(self, pointConfig, resultQueue):
+
+        eStage = explore_hypotheses.ExplorationStage(pointConfig)
+        eStage.explore()
+
+        pointResults = []
+        for estimator in pointConfig.getEstimatorList():
+            estVehicle = pointConfig.getEstVehicle(estimator.get(pointConfig.SRC_COLLNAME))
+            pointResults.append(self.getPointResult(estVehicle))
+
+        if len(pointResults) > 0:
+            resultColl = pymongo.collection.Collection( estVehicle.getMetaClientDB(), type_utils.BENCHMARK_COLL )
+            resultColl.insert_many([dict(pResult) for pResult in pointResults])
+
+        resultQueue.put(pointResults)
+
+
+    #
+    # Run all points of the sweep, then write the CSV file and the curves.
+    #
+    def benchmark(self):
+
+        print('\n=============================================')
+        print('\tBENCHMARK ' + self.sweepId + '...')
+        print('=============================================\n')
+
+        mpContext  = multiprocessing.get_context('fork')
+        allResults = []
+
+        for timeBudget in self.timeBudgets:
+            for cpuCount in self.cpuCounts:
+                for searchSeed in self.searchSeeds:
+
+                    print('\nBenchmark point: ' + str(timeBudget) + ' sec, ' + str(cpuCount) + ' CPU(s), seed ' + str(searchSeed))
+                    pointConfig = self.getPointConfig(timeBudget, cpuCount, searchSeed)
+                    resultQueue = mpContext.Queue()
+                    pointProc   = mpContext.Process(target=self.runPoint, args=(pointConfig, resultQueue))
+                    pointProc.start()
+                    pointProc.join()
+
+                    if 0 != pointProc.exitcode:
+                        print('Benchmark point failed with exit code ' + str(pointProc.exitcode) + '.')
+                        continue
+                    allResults += resultQueue.get()
+
+        self.writeCSV(allResults)
+        self.reportCurves(allResults)
+
+
+    #
+    # Write `allResults` to the CSV file.
+    #
+    def writeCSV(self, allResults):
+
+        with open(self.csvFname, 'w', newline='') as csvFile:
+            csvWriter = csv.DictWriter(csvFile, fieldnames=RESULT_COLUMNS, extrasaction='ignore')
+            csvWriter.writeheader()
+            csvWriter.writerows(allResults)
+
+        print('\nBenchmark results written to ' + self.csvFname)
+
+
+    #
+    # Print the score-versus-time curve of each estimator, averaged over the
+    # search seeds, and chart it next to the CSV file, one line per CPU
+    # count.
+    #
+    def reportCurves(self, allResults):
+
+        for estName in sorted(set([nResult['estimator'] for nResult in allResults])):
+
+            print('\n=============================================')
+            print('\tSCORE VS TIME: ' + estName)
+            print('=============================================')
+            print('\t  budget  cpus  seeds  explore sec  refit sec  accuracy  bal. accuracy  ensemble')
+
+            fig   = matplotlib.figure.Figure()
+            chart = fig.add_subplot(1, 1, 1)
+
+            for cpuCount in self.cpuCounts:
+                curveSeconds = []
+                curveScores  = []
+                for timeBudget in self.timeBudgets:
+                    pointResults = [nResult for nResult in allResults if nResult['estimator'] == estName and nResult['time_budget'] == timeBudget and nResult['allowed_cpus'] == cpuCount]
+                    if 0 == len(pointResults):
+                        continue
+                    meanOf = lambda colName: float(numpy.mean([nResult[colName] for nResult in pointResults]))
+                    print('\t%8d %5d %6d %12.1f %10.1f %9.4f %14.4f %9.1f' % (timeBudget, cpuCount, len(pointResults), meanOf('explore_seconds'), meanOf('refit_seconds'), meanOf('accuracy'), meanOf('balanced_accuracy'), meanOf('ensemble_size')))
+                    curveSeconds.append(meanOf('explore_seconds'))
+                    curveScores.append(meanOf('accuracy'))
+                chart.plot(curveSeconds, curveScores, marker='o', label=str(cpuCount) + ' CPU(s)')
+
+            chart.set_xlabel('Search time (sec)')
+            chart.set_ylabel('Test accuracy')
+            chart.set_title(estName)
+            chart.legend()
+
+            chartFname = os.path.splitext(self.csvFname)[0] + '_' + estName + '.png'
+            fig.savefig(chartFname)
+            print('\tCurve charted in ' + chartFname)
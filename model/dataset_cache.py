@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy
+
+
+#
+# Name of the file describing the arrays of a cached dataset.
+#
+META_FNAME      = 'meta.json'
+
+#
+# Prefix of the directories holding datasets that are still being written.
+#
+PARTIAL_PREFIX  = 'partial-'
+
+#
+# Metadata keys of the attribute names and of the number of training rows of
+# a cached model matrix.
+#
+META_ATTR_NAMES   = 'attr_names'
+META_TRAIN_COUNT  = 'train_count'
+
+
+
+#
+# Return the cache key of the items in `keyParts`, which must have a stable
+# repr().
+#
+def getCacheKey(*keyParts):
+    return hashlib.blake2b(repr(keyParts).encode('utf-8'), digest_size=16).hexdigest()
+
+
+
+#
+# -- DatasetCache
+#
+# On-disk cache of the model matrices of the model stage, keyed by a
+# fingerprint of the cleaned collection and the vehicle metadata.  Each
+# dataset is stored as one .npy file per named array (the attributes, the
+# target values and the weights) in a directory named by its key, and is
+# memory-mapped read-only from those files on later runs, without querying
+# the cleaned collection or copying the arrays into memory.  Datasets are
+# evicted once older than the maximum age, and the least recently used ones
+# are evicted while the cache exceeds its maximum size.
+#
+class DatasetCache(object):
+    """ On-disk cache of memory-mapped numeric arrays.
+    """
+
+    #
+    #
+    #
+    def __init__(self, cacheDir, maxBytes, maxAgeSeconds):
+
+        self.cacheDir       = cacheDir
+        self.maxBytes       = maxBytes
+        self.maxAgeSeconds  = maxAgeSeconds
+
+
+    #
+    #
+    #
+    def getEntryDir(self, cacheKey):
+        return os.path.join(self.cacheDir, cacheKey)
+
+
+    #
+    # Return the dictionary of arrays cached under `cacheKey`, memory-mapped
+    # read-only from the cache files, and the metadata stored with them, or
+    # None and None if they are not cached.
+    #
+    def load(self, cacheKey):
+
+        entryDir  = self.getEntryDir(cacheKey)
+        metaPath  = os.path.join(entryDir, META_FNAME)
+
+        try:
+            with open(metaPath, 'r') as metaFile:
+                metaData = json.load(metaFile)
+
+            if time.time() - metaData['created'] > self.maxAgeSeconds:
+                return None, None
+
+            arrayDict = {}
+            for arrayName in metaData['arrays']:
+                arrayDict[arrayName] = numpy.load(os.path.join(entryDir, arrayName + '.npy'), mmap_mode='r')
+
+            # The access time of the metadata file orders the eviction.
+            os.utime(metaPath)
+        except (OSError, ValueError, KeyError) as eX:
+            return None, None
+
+        return arrayDict, metaData
+
+
+    #
+    # Store the dictionary of named arrays `arrayDict` under `cacheKey`, with
+    # the JSON values in `extraMeta` added to its metadata.  Arrays of
+    # objects can not be mapped from .npy files and are not cached.  Returns
+    # True if the arrays were stored.
+    #
+    def store(self, cacheKey, arrayDict, extraMeta=None):
+
+        for arrayName, dsArray in arrayDict.items():
+            if 'O' == dsArray.dtype.kind:
+                print('\tNot caching the dataset, ' + arrayName + ' holds objects.')
+                return False
+
+        entryDir    = self.getEntryDir(cacheKey)
+        partialDir  = os.path.join(self.cacheDir, PARTIAL_PREFIX + cacheKey + '-' + str(os.getpid()))
+
+        try:
+            os.makedirs(partialDir, exist_ok=True)
+
+            for arrayName, dsArray in arrayDict.items():
+                numpy.save(os.path.join(partialDir, arrayName + '.npy'), dsArray)
+
+            metaData = dict(extraMeta) if None != extraMeta else {}
+            metaData['arrays']   = list(arrayDict.keys())
+            metaData['created']  = time.time()
+            with open(os.path.join(partialDir, META_FNAME), 'w') as metaFile:
+                json.dump(metaData, metaFile)
+
+            # Replace an expired entry, then move the new one in place.  A
+            # concurrent run storing the same key leaves an equal entry.
+            shutil.rmtree(entryDir, ignore_errors=True)
+            os.rename(partialDir, entryDir)
+        except OSError as eX:
+            print('\tCould not cache the dataset in ' + self.cacheDir + ': ' + str(eX))
+            shutil.rmtree(partialDir, ignore_errors=True)
+            return False
+
+        self.evict(cacheKey)
+
+        return True
+
+
+    #
+    # Return the number of bytes held by the files in `entryDir`.
+    #
+    def getEntryBytes(self, entryDir):
+
+        entryBytes = 0
+        for fName in os.listdir(entryDir):
+            entryBytes += os.path.getsize(os.path.join(entryDir, fName))
+
+        return entryBytes
+
+
+    #
+    # Remove the expired datasets, then the least recently used ones until
+    # the cache fits its maximum size.  The dataset under `keepKey` is kept.
+    #
+    def evict(self, keepKey=None):
+
+        nowTime  = time.time()
+        entries  = []
+
+        for entryName in os.listdir(self.cacheDir):
+            entryDir = os.path.join(self.cacheDir, entryName)
+            try:
+                if entryName.startswith(PARTIAL_PREFIX):
+                    # Partial entries left behind by failed runs.
+                    if nowTime - os.path.getmtime(entryDir) > self.maxAgeSeconds:
+                        shutil.rmtree(entryDir, ignore_errors=True)
+                    continue
+
+                metaPath  = os.path.join(entryDir, META_FNAME)
+                usedTime  = os.path.getmtime(metaPath)
+                with open(metaPath, 'r') as metaFile:
+                    createdTime = json.load(metaFile)['created']
+
+                if entryName != keepKey and nowTime - createdTime > self.maxAgeSeconds:
+                    print('\tEvicting expired cached dataset ' + entryName)
+                    shutil.rmtree(entryDir, ignore_errors=True)
+                else:
+                    entries.append((usedTime, entryName, self.getEntryBytes(entryDir)))
+            except (OSError, ValueError, KeyError) as eX:
+                continue
+
+        totalBytes = sum([entryBytes for usedTime, entryName, entryBytes in entries])
+
+        for usedTime, entryName, entryBytes in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            if entryName == keepKey:
+                continue
+            print('\tEvicting cached dataset ' + entryName + ' to fit the cache size.')
+            shutil.rmtree(os.path.join(self.cacheDir, entryName), ignore_errors=True)
+            totalBytes -= entryBytes
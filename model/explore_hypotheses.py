@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import json
 import time
+import inspect
 # from datetime import datetime as dt
 
 import pandas as pd
@@ -13,8 +15,10 @@ import numpy
 import config
 # import vehicle
 import mongo_utils
+import perf_utils
 
 import autosklearn.classification
+import autosklearn.evaluation
 import autosklearn.metrics
 import sklearn.model_selection
 import sklearn.datasets
@@ -25,7 +29,14 @@ import sklearn.inspection
 # from schema import schema_analysis
 from schema import type_utils
 
-from cleanup import dataset_cleanup
+from cleanup import normalization
+
+from model import dataset_cache
+from model import model_matrix
+from model import search_scheduler
+from model import smac_utils
+from model import meta_features
+from model import perm_importance
 
 
 #
@@ -52,11 +63,34 @@ max_time_global = 360
 max_time_model = 36
 
 
+#
+# Minimum fraction of the test predictions that must agree between float32
+# and float64 inputs for the float32 training matrix to be reported as
+# accurate.
+#
+min_float32_agreement = 0.99
+
+#
+# Number of model runs kept in the balancing comparison of the statistics.
+#
+max_balancing_runs = 20
+
+#
+# The "auto" resampling strategy switches from cross validation to a single
+# holdout once the holdout holds this many rows of the least frequent class
+# at the largest holdout fraction.  The holdout fraction is the smallest
+# fraction holding that many rows, within the bounds below.
+#
+auto_holdout_class_rows = 1000
+auto_min_holdout        = 0.1
+auto_max_holdout        = 0.33
+
+
 
 class ExplorationStage(object):
     """ The Ahnung exploration stage pulls normalized and standardized
         instances (in documents, aka rows) from the cleaned document source
-        collection.  The documents are combined into a Pandas DataFrame
+        collection.  The documents are packed into a single feature matrix
         and then passed to autosklearn to search for accurate model and
         hyperparameter configurations.
     """
@@ -72,36 +106,349 @@ class ExplorationStage(object):
 
 
     #
-    # Explore models and hyperparameters for the dataset of the
-    # documents/rows in `collName`.
-    # 
+    # Load the cleaned documents matching each query of `partQueries` into
+    # one dictionary of typed columns, with the rows of each query following
+    # those of the previous ones.  Returns the columns and the end row of
+    # each part.
     #
-    def loadCleanDF(self, srcColl, srcQuery, estVehicle, target):
+    def loadCleanColumns(self, srcColl, partQueries, estVehicle, target, dedupMode):
 
         valTypes   = estVehicle.getAttrDatatypes()
-        defValues  = estVehicle.getAttrDefaults()
         attrSenses = estVehicle.getAttrSenses()
-        
-        pathList   = valTypes.keys()
+        nPlan      = estVehicle.getCleanedPlan()
 
         print('For estimator ' + estVehicle.getEstimatorName())
         print('\tTypes selected: ' + str(valTypes))
         print('\tSenses selected: ' + str(attrSenses))
         
-        dsList = []
-        
-        for nFlat in srcColl.find( srcQuery ):
+        # The cleaned documents can be read as they are when the cleanup stage
+        # stored them with the plan and settings in effect now.
+        cleanupMatch  = self.isCleanupCurrent(estVehicle)
+        trustCleaned  = estVehicle.getTrustCleaned()
+        if trustCleaned and not cleanupMatch:
+            print('\tThe cleanup settings changed since the cleanup stage ran, normalizing the cleaned documents again.')
+            trustCleaned = False
 
-            valList, normDoc = dataset_cleanup.normalizeToList(nFlat, pathList, valTypes, defValues, target)
-            if None != valList:
-                dsList.append(valList)
+        compactDtypes = None
+        if estVehicle.getCompactDtypes():
+            compactDtypes = estVehicle.getColumnDtypes()
+            print('\tCompact dtypes: ' + str({path: str(dtype) for path, dtype in compactDtypes.items()}))
+        colDtypes = nPlan.getColumnDtypes(compactDtypes)
 
-        dsFrame = pd.DataFrame(dsList, columns=pathList)
+        rssBefore = perf_utils.getPeakRSS()
+        loadStart = time.time()
 
-        # print('DataFrame:')
-        # print(str(dsFrame))
-        
-        return dsFrame
+        dsColumns, partEnds = self.readCleanColumns(srcColl, partQueries, estVehicle, nPlan, colDtypes, trustCleaned, dedupMode)
+
+        loadSeconds = time.time() - loadStart
+
+        self.reportLoadMemory(dsColumns, rssBefore, estVehicle, loadSeconds)
+
+        return dsColumns, partEnds
+
+
+    #
+    # Read the documents matching the queries in `partQueries` into a single
+    # dictionary of columns with the dtypes `colDtypes`, normalized by `nPlan`
+    # unless `trustCleaned`.  Returns the columns and the end row of each
+    # part.
+    #
+    def readCleanColumns(self, srcColl, partQueries, estVehicle, nPlan, colDtypes, trustCleaned, dedupMode):
+
+        withCounts = dedupMode in [self.aConfig.DEDUP_DISTINCT, self.aConfig.DEDUP_BOUNDED]
+
+        rowCount  = sum([srcColl.count_documents(srcQuery) for srcQuery in partQueries])
+        loader    = normalization.ColumnLoader(nPlan, rowCount, colDtypes, withCounts)
+        partEnds  = []
+
+        for srcQuery in partQueries:
+            docCursor = srcColl.find(srcQuery, projection={ type_utils.CLEANED_STRINGS: False }, batch_size=normalization.BATCH_SIZE)
+            for docBatch in normalization.iterBatches(docCursor):
+                if trustCleaned:
+                    loader.addDocs(docBatch)
+                else:
+                    loader.addBatch(nPlan.apply_batch(docBatch), docBatch)
+            partEnds.append(loader.getRowCount())
+
+        dsColumns = loader.getColumns()
+
+        if withCounts:
+            partEnds = self.applyRowCounts(dsColumns, loader.getRowCounts(), estVehicle, dedupMode, partEnds)
+
+        return dsColumns, partEnds
+
+
+    #
+    # Return the dedup mode in which the cleaned rows of `estVehicle` are
+    # loaded.  The "distinct" mode needs sample weights, without them every
+    # distinct row would weigh the same and the class and instance
+    # frequencies would change.  When the installed AutoSKLearn does not
+    # accept sample weights, the rows are loaded in "bounded" mode instead.
+    # The configured and the loaded mode are recorded in the estimator
+    # statistics, so that the fallback shows next to the model.
+    #
+    def getLoadDedupMode(self, estVehicle):
+
+        dedupMode = estVehicle.getDedupMode()
+
+        dedupStats = {}
+        dedupStats['configured_mode']  = dedupMode
+        dedupStats['fallback']         = None
+        if self.aConfig.DEDUP_DISTINCT == dedupMode and not self.acceptsSampleWeights(autosklearn.classification.AutoSklearnClassifier):
+            print('\tDedup: the installed AutoSKLearn does not accept sample weights, repeating the distinct rows up to ' + str(estVehicle.getDedupMaxCopies()) + ' copies each instead.')
+            dedupMode = self.aConfig.DEDUP_BOUNDED
+            dedupStats['fallback']     = 'no_sample_weight'
+        dedupStats['load_mode']        = dedupMode
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_DEDUP_LOAD] = dedupStats
+        estVehicle.setAttrStats(allStats)
+
+        return dedupMode
+
+
+    #
+    # Return True if the cleanup stage stored the cleaned documents of
+    # `estVehicle` with the plan and settings in effect now.
+    #
+    def isCleanupCurrent(self, estVehicle):
+
+        cState = estVehicle.getCleanupState()
+
+        return estVehicle.getCleanupFingerprint() == cState.get(type_utils.CLEANUP_FINGERPRINT)
+
+
+    #
+    # Return the on-disk cache of the model matrices, or None if disabled.
+    #
+    def getDatasetCache(self):
+
+        cacheDir = self.aConfig.getModelDatasetCacheDir()
+        if None == cacheDir:
+            return None
+
+        try:
+            os.makedirs(cacheDir, exist_ok=True)
+        except OSError as eX:
+            print('\tThe dataset cache directory ' + cacheDir + ' is not available: ' + str(eX))
+            return None
+
+        maxBytes = self.aConfig.getModelDatasetCacheMaxMB() * 1024 * 1024
+        maxAge   = self.aConfig.getModelDatasetCacheMaxAgeDays() * 24 * 3600
+
+        return dataset_cache.DatasetCache(cacheDir, maxBytes, maxAge)
+
+
+    #
+    # Apply the multiplicities `rowCounts` of the distinct rows in the columns
+    # `dsColumns`, as stored by the cleanup stage when deduplicating.  Returns
+    # the part end rows.
+    #
+    # In "bounded" mode each row is repeated up to the configured number of
+    # copies, in place, and the part end rows `partEnds` are moved to match.
+    # In "distinct" mode each row is kept once and its count is added as the
+    # CLEANED_COUNT column, used as the sample weight of the row, see
+    # ModelMatrix and getLoadDedupMode().
+    #
+    def applyRowCounts(self, dsColumns, rowCounts, estVehicle, dedupMode, partEnds):
+
+        rawCount  = int(rowCounts.sum())
+
+        if self.aConfig.DEDUP_BOUNDED == dedupMode:
+            maxCopies = estVehicle.getDedupMaxCopies()
+            rowCopies = numpy.minimum(rowCounts, maxCopies)
+            copyEnds  = numpy.concatenate(([0], numpy.cumsum(rowCopies)))
+            partEnds  = [int(copyEnds[partEnd]) for partEnd in partEnds]
+            self.takeRows(dsColumns, numpy.repeat(numpy.arange(len(rowCounts)), rowCopies))
+            print('\tDedup: ' + str(rawCount) + ' instances kept as ' + str(int(copyEnds[-1])) + ' rows, at most ' + str(maxCopies) + ' copies each.')
+        else:
+            dsColumns[type_utils.CLEANED_COUNT] = rowCounts
+            print('\tDedup: ' + str(rawCount) + ' instances kept as ' + str(len(rowCounts)) + ' distinct rows.')
+
+        return partEnds
+
+
+    #
+    # Replace each of the columns `dsColumns` by its rows `rowIdxs`, in
+    # place, one column at a time.
+    #
+    def takeRows(self, dsColumns, rowIdxs):
+
+        for colName in dsColumns:
+            dsColumns[colName] = dsColumns[colName][rowIdxs]
+
+
+    #
+    # Return True if the fit() of `automl`, an AutoSKLearn estimator or its
+    # class, accepts sample weights.
+    #
+    def acceptsSampleWeights(self, automl):
+        return 'sample_weight' in inspect.signature(automl.fit).parameters
+
+
+    #
+    # Return the keyword arguments passing `weights` to the fit() of `automl`,
+    # or no arguments if there are no weights or fit() does not accept them.
+    #
+    def getFitWeightArgs(self, automl, weights):
+
+        if weights is None:
+            return {}
+
+        if not self.acceptsSampleWeights(automl):
+            print('\nThe installed AutoSKLearn does not accept sample weights, the row weights are not used for training.')
+            return {}
+
+        return { 'sample_weight': numpy.asarray(weights) }
+
+
+    #
+    # Report the memory held by the loaded columns `dsColumns`, compared to
+    # the same columns stored as 64-bit numbers, and the peak resident set
+    # size of the process before (`rssBefore`) and after loading, which took
+    # `loadSeconds`.  The figures are also recorded in the estimator
+    # statistics.
+    #
+    def reportLoadMemory(self, dsColumns, rssBefore, estVehicle, loadSeconds):
+
+        rowCount   = len(next(iter(dsColumns.values()))) if len(dsColumns) > 0 else 0
+        frameBytes = perf_utils.getColumnsBytes(dsColumns)
+        wideBytes  = perf_utils.getWideColumnsBytes(dsColumns)
+        rssAfter   = perf_utils.getPeakRSS()
+
+        print('\tLoaded ' + str(rowCount) + ' rows in ' + ('%.2f' % loadSeconds) + ' seconds.')
+        print('\tColumn memory: ' + perf_utils.formatBytes(frameBytes) + ' (' + perf_utils.formatBytes(wideBytes) + ' with 64-bit columns)')
+        print('\tPeak RSS before load: ' + perf_utils.formatBytes(rssBefore) + ', after load: ' + perf_utils.formatBytes(rssAfter))
+
+        memStats = {}
+        memStats['rows']             = rowCount
+        memStats['frame_bytes']      = frameBytes
+        memStats['wide_frame_bytes'] = wideBytes
+        memStats['peak_rss_before']  = rssBefore
+        memStats['peak_rss_after']   = rssAfter
+        memStats['load_seconds']     = loadSeconds
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_FRAME_MEMORY] = memStats
+        estVehicle.setAttrStats(allStats)
+
+
+    #
+    # Record the peak resident set size of this process, and of the finished
+    # child processes, at the end of the model stage step `stepName`.
+    #
+    def recordStepMemory(self, estVehicle, stepName):
+
+        peakRSS       = perf_utils.getPeakRSS()
+        peakChildRSS  = perf_utils.getPeakChildRSS()
+
+        print('\tPeak RSS after ' + stepName + ': ' + perf_utils.formatBytes(peakRSS) + ', child processes: ' + perf_utils.formatBytes(peakChildRSS))
+
+        allStats = estVehicle.getAttrStats()
+        allStats.setdefault(type_utils.STATS_STEP_MEMORY, {})[stepName] = { 'peak_rss': peakRSS, 'peak_child_rss': peakChildRSS }
+        estVehicle.setAttrStats(allStats)
+
+
+    #
+    # Load the training and holdout (test) portions of the cleaned collection
+    # as one dictionary of columns, the training rows first.  Returns the
+    # columns and the number of training rows.
+    #
+    # The portions are selected on the server by the holdout flag that the
+    # cleanup stage stored with each document.  Collections cleaned before the
+    # flags were introduced are loaded whole and split in memory instead.
+    #
+    def loadTrainTestColumns(self, srcColl, srcQuery, estVehicle, target, dedupMode):
+
+        labelQuery = { type_utils.CLEANED_HOLDOUT: { '$exists': True } }
+        if None != srcColl.find_one(labelQuery, projection=['_id']):
+            trainQuery  = dict(srcQuery, **{ type_utils.CLEANED_HOLDOUT: False })
+            testQuery   = dict(srcQuery, **{ type_utils.CLEANED_HOLDOUT: True })
+            dsColumns, partEnds = self.loadCleanColumns(srcColl, [trainQuery, testQuery], estVehicle, target, dedupMode)
+            trainCount  = partEnds[0]
+        else:
+            print('\tNo holdout labels in the cleaned collection, rerun the cleanup stage.  Splitting out test and train datasets in memory.')
+            dsColumns, partEnds = self.loadCleanColumns(srcColl, [srcQuery], estVehicle, target, dedupMode)
+            trainRows, testRows = sklearn.model_selection.train_test_split(numpy.arange(partEnds[-1]), test_size=estVehicle.getHoldoutFraction(), random_state=estVehicle.getRandomSeed())
+            self.takeRows(dsColumns, numpy.concatenate((trainRows, testRows)))
+            trainCount  = len(trainRows)
+
+        return dsColumns, trainCount
+
+
+    #
+    # Return the cache key of the model matrix of `estVehicle` loaded from
+    # `srcColl` with `srcQuery` and rows loaded in `dedupMode`, or None if
+    # the cleaned collection is out of date and its matrix can not be cached.
+    # The key covers the cleaned collection and its cleanup state, and every
+    # setting that changes the rows, their split or the matrix dtype.
+    #
+    def getMatrixCacheKey(self, srcColl, srcQuery, estVehicle, target, dedupMode):
+
+        if not self.isCleanupCurrent(estVehicle):
+            return None
+
+        cState = estVehicle.getCleanupState()
+
+        return dataset_cache.getCacheKey(self.aConfig.getCleanedURI(), srcColl.full_name, srcQuery, target,
+                                         estVehicle.getCleanupFingerprint(), str(cState.get(type_utils.CLEANUP_WATERMARK)), cState.get(type_utils.CLEANUP_RAW_COUNT),
+                                         dedupMode, estVehicle.getDedupMaxCopies(), estVehicle.getHoldoutFraction(), estVehicle.getRandomSeed(),
+                                         estVehicle.getFloat32Training())
+
+
+    #
+    # Return the ModelMatrix of the training and holdout (test) portions of
+    # the cleaned collection.  A matrix stored in the dataset cache is mapped
+    # read-only from its files, otherwise the columns are loaded from the
+    # cleaned collection, packed and stored in the cache.  The source of the
+    # matrix and the seconds taken are recorded in the estimator statistics,
+    # so that cold and warm loads can be compared.
+    #
+    def loadModelMatrix(self, srcColl, srcQuery, estVehicle, target):
+
+        dedupMode  = self.getLoadDedupMode(estVehicle)
+        loadStart  = time.time()
+
+        dsCache   = self.getDatasetCache()
+        cacheKey  = None
+        mMatrix   = None
+        if None != dsCache:
+            cacheKey = self.getMatrixCacheKey(srcColl, srcQuery, estVehicle, target, dedupMode)
+        if None != cacheKey:
+            arrayDict, cacheMeta = dsCache.load(cacheKey)
+            if None != arrayDict:
+                mMatrix = model_matrix.ModelMatrix(cacheMeta[dataset_cache.META_ATTR_NAMES], cacheMeta[dataset_cache.META_TRAIN_COUNT],
+                                                   arrayDict['X'], arrayDict['y'], arrayDict.get('weights'))
+                print('\tMapped the cached model matrix ' + cacheKey + '.')
+
+        matrixSource = 'cache'
+        if None == mMatrix:
+            matrixSource = 'collection'
+            dsColumns, trainCount = self.loadTrainTestColumns(srcColl, srcQuery, estVehicle, target, dedupMode)
+            self.recordStepMemory(estVehicle, 'load')
+
+            # The model stage works on a single read-only matrix from here on,
+            # the training, test and complete datasets are views of its rows.
+            # The loaded columns are released as they are packed.
+            mMatrix = model_matrix.packModelMatrix(dsColumns, target, trainCount, estVehicle.getFloat32Training())
+            cacheMeta = { dataset_cache.META_ATTR_NAMES: mMatrix.getAttrNames(), dataset_cache.META_TRAIN_COUNT: mMatrix.getTrainCount() }
+            if None != cacheKey and dsCache.store(cacheKey, mMatrix.getArrays(), cacheMeta):
+                print('\tCached the model matrix as ' + cacheKey + '.')
+
+        loadSeconds = time.time() - loadStart
+        print('\tModel matrix from the ' + matrixSource + ' in ' + ('%.2f' % loadSeconds) + ' seconds.')
+
+        loadStats = {}
+        loadStats['source']     = matrixSource
+        loadStats['seconds']    = loadSeconds
+        loadStats['cache_key']  = cacheKey
+        loadStats['mapped']     = isinstance(mMatrix.X, numpy.memmap)
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_MATRIX_LOAD] = loadStats
+        estVehicle.setAttrStats(allStats)
+
+        return mMatrix
 
 
     #
@@ -117,15 +464,28 @@ class ExplorationStage(object):
 
 
     #
+    # Check the float32 trained `automl` against float64 inputs by comparing
+    # the predictions `y_wide` of the float64 test dataset, computed by
+    # computeStats(), with the predictions of the float32 test dataset
+    # `X_test_narrow`.  Records the accuracy of each and the fraction of
+    # predictions that agree in the estimator statistics.
     #
-    #
-    def splitDatasetXandY(self, cleanDF, target):
-        
-        all_y = cleanDF[target].copy()
-        all_X = cleanDF.drop(target, 1)
-        
-        return all_X, all_y
+    def checkFloat32Accuracy(self, automl, y_wide, X_test_narrow, y_test, estVehicle):
+
+        y_narrow  = automl.predict(X_test_narrow, batch_size=None, n_jobs=1)
+
+        checkStats = {}
+        checkStats['accuracy_float64']  = float(sklearn.metrics.accuracy_score(y_test, y_wide))
+        checkStats['accuracy_float32']  = float(sklearn.metrics.accuracy_score(y_test, y_narrow))
+        checkStats['agreement']         = float(numpy.mean(y_wide == y_narrow))
 
+        print('\n\tFloat32 check, accuracy float64: ' + str(checkStats['accuracy_float64']) + ', float32: ' + str(checkStats['accuracy_float32']) + ', agreement: ' + str(checkStats['agreement']))
+        if checkStats['agreement'] < min_float32_agreement:
+            print('\tWARNING: float32 and float64 predictions disagree on more than ' + str(1 - min_float32_agreement) + ' of the test dataset.')
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_FLOAT32_CHECK] = checkStats
+        estVehicle.setAttrStats(allStats)
 
 
     #
@@ -172,25 +532,25 @@ class ExplorationStage(object):
 
 
     #
+    # Balance the classes of the target values `y_train`, with the sample
+    # weights `w_train` (or None).  Returns the rows of the balanced dataset,
+    # as an index array into `y_train` or None for all rows as they are, and
+    # the sample weights of the balanced dataset.
     #
-    #
-    def balanceSamples(self, X_train, y_train, estVehicle):
+    def balanceSamples(self, y_train, w_train, estVehicle):
         
-        target   = estVehicle.getEstimatorTarget()
-
         balFlag  = self.aConfig.getModelCategoryBalancing()
         maxOver  = self.aConfig.getModelMaxOversample()
 
         if self.aConfig.BALANCE_CAT_NONE == balFlag:
-            return X_train.copy(), y_train.copy()
+            return None, w_train
+
+        if self.aConfig.BALANCE_CAT_WEIGHT == balFlag:
+            return None, self.weightSamples(y_train, w_train)
 
-        # combined = numpy.column_stack((X_train, y_train))
-        combined = X_train.copy()
-        combined[target] = y_train
-        
         uniq, unq_idx, unq_cnt = numpy.unique(y_train, return_inverse=True, return_counts=True)
         catCnt                 = len(uniq)
-        inputCnt               = combined.shape[0]
+        inputCnt               = len(y_train)
 
         unq_wts                = numpy.zeros(catCnt)
         if self.aConfig.BALANCE_CAT_EQUAL == balFlag:
@@ -198,8 +558,7 @@ class ExplorationStage(object):
         else:
             # Assume balFlag == self.aConfig.BALANCE_CAT_AVG
             eFrac = 1 / catCnt
-            for idx in range(catCnt):
-                unq_wts[idx] = (eFrac + (unq_cnt[idx] / inputCnt)) / 2
+            unq_wts[:] = (eFrac + (unq_cnt / inputCnt)) / 2
             
         min_cnt_idx  = numpy.argmin(unq_cnt)
         min_wts_idx  = numpy.argmin(unq_wts)
@@ -208,54 +567,489 @@ class ExplorationStage(object):
         
         target_count = min(max_allowed_count, inputCnt)
         
-        resCatCnt    = numpy.array((len(uniq),), dtype=numpy.int32)
         resCatCnt    = (unq_wts * target_count).astype(numpy.int32)
 
-        row_sets     = []
-        balidx       = 0
-
-        for idx in range(len(uniq)):
+        # The balanced dataset is computed as row indices into y_train.  A
+        # stable sort by class lists the rows of each class in input order.
+        # Each class is repeated whole as often as it fits its balanced count
+        # and the remainder is drawn with replacement.  The random draws and
+        # the final shuffle are the same calls on the same numpy generator as
+        # when the rows were copied class by class.
+        classRows    = numpy.argsort(unq_idx, kind='stable')
+        classStarts  = numpy.concatenate(([0], numpy.cumsum(unq_cnt)))
+        index_sets   = []
+
+        for idx in range(catCnt):
     
-            cat_cnt = unq_cnt[idx]
-            cat_remain = resCatCnt[idx]
-            while cat_remain >= cat_cnt:
-                indices     = numpy.where(unq_idx == idx)[0]
-                row_sets.append(combined.iloc[indices,:])
-                cat_remain  = cat_remain - cat_cnt
-                balidx      = balidx + cat_cnt
+            catRows    = classRows[classStarts[idx]:classStarts[idx + 1]]
+            fullCopies, cat_remain = divmod(int(resCatCnt[idx]), int(unq_cnt[idx]))
+            index_sets.append(numpy.tile(catRows, fullCopies))
                 
             if cat_remain > 0:
-                indices     = numpy.random.choice(numpy.where(unq_idx == idx)[0], cat_remain)
-                row_sets.append(combined.iloc[indices,:])
-                balidx      = balidx + cat_remain
+                index_sets.append(numpy.random.choice(catRows, cat_remain))
         
-        balanced     = pd.concat(row_sets, ignore_index=True)
-        balanced     = sklearn.utils.shuffle(balanced)
+        balIndex     = numpy.concatenate(index_sets)
+        balOrder     = sklearn.utils.shuffle(numpy.arange(len(balIndex)))
+        balRows      = balIndex[balOrder]
+
+        w_res        = None
+        if w_train is not None:
+            w_res    = w_train[balRows]
+
+        return balRows, w_res
+
+
+    #
+    # Balance the classes of `y_train` by sample weights instead of copies of
+    # rows.  Each row is weighted by the inverse frequency of its class, so
+    # that all classes carry the same total weight, as with "equalize".  The
+    # weights multiply the sample weights `w_train` of a deduplicated dataset.
+    #
+    def weightSamples(self, y_train, w_train):
+
+        uniq, unq_idx = numpy.unique(y_train, return_inverse=True)
+        catCnt        = len(uniq)
+
+        rowWeights    = w_train if w_train is not None else numpy.ones(len(y_train))
 
-        y_res        = balanced[target].copy()
-        del balanced[target]
-        X_res        = balanced.copy()
+        classTotals   = numpy.bincount(unq_idx, weights=rowWeights, minlength=catCnt)
+        classWeights  = (rowWeights.sum() / catCnt) / classTotals
 
-        return X_res, y_res
+        print('\nClass weights: ' + str(dict(zip(uniq.tolist(), classWeights.tolist()))))
 
+        return rowWeights * classWeights[unq_idx]
 
+
+    #
+    # Return the rows of a sample of the rows `balRows` (all rows if None)
+    # drawn with replacement in proportion to their weights `rowWeights`, as
+    # many as there are weights, in ascending order.  This takes the place
+    # of the sample weights where they are not accepted, so that the classes
+    # balanced by weightSamples() are balanced in the drawn rows as well.
     #
+    def resampleByWeights(self, balRows, rowWeights):
+
+        rowCount   = len(rowWeights)
+        drawnRows  = numpy.sort(numpy.random.choice(rowCount, rowCount, p=rowWeights / rowWeights.sum()))
+
+        print('\nResampled ' + str(rowCount) + ' rows in proportion to their weights.')
+
+        if balRows is None:
+            return drawnRows
+
+        return balRows[drawnRows]
+
+
     #
+    # Return the metric that replaces `metric_string` when the classes are
+    # balanced by weights that AutoSKLearn does not accept.  Averaging per
+    # class takes the place of the weights: "accuracy" becomes
+    # "balanced_accuracy" and the micro averages become macro averages.
     #
-    def computeStats(self, automl, target, X_test, y_test, estVehicle):
+    def getBalancedMetric(self, metric_string):
+
+        balancedMetrics = {
+            self.aConfig.METRIC_ACCURACY.lower():         self.aConfig.METRIC_BAL_ACCURACY,
+            self.aConfig.METRIC_F1_MICRO.lower():         self.aConfig.METRIC_F1_MACRO,
+            self.aConfig.METRIC_PRECISION_MICRO.lower():  self.aConfig.METRIC_PRECISION_MACRO,
+            self.aConfig.METRIC_RECALL_MICRO.lower():     self.aConfig.METRIC_RECALL_MACRO
+        }
+
+        return balancedMetrics.get(metric_string.lower(), metric_string)
+
+
+    #
+    # Record the balancing mode, search time and test scores of this run in
+    # the estimator statistics and print the runs recorded so far, to compare
+    # the balancing modes.  `weights_replaced` names what took the place of
+    # the class weights in the search, if they were not accepted.  At most
+    # `max_balancing_runs` runs are kept.
+    #
+    def recordBalancingRun(self, estVehicle, metric_string, train_rows, explore_seconds, y_test, y_hat, weights_replaced=None):
+
+        runStats = {}
+        runStats['mode']                 = self.aConfig.getModelCategoryBalancing()
+        runStats['max_oversample']       = self.aConfig.getModelMaxOversample()
+        runStats['metric']               = metric_string
+        runStats['weights_replaced_by']  = weights_replaced
+        runStats['time_budget']          = estVehicle.getMaxGlobalTime()
+        runStats['train_rows']           = int(train_rows)
+        runStats['explore_seconds']      = explore_seconds
+        runStats['accuracy']             = float(sklearn.metrics.accuracy_score(y_test, y_hat))
+        runStats['balanced_accuracy']    = float(sklearn.metrics.balanced_accuracy_score(y_test, y_hat))
+        runStats['recorded']             = time.time()
+
+        allStats = estVehicle.getAttrStats()
+        balRuns  = allStats.get(type_utils.STATS_BALANCING_RUNS, []) + [runStats]
+        allStats[type_utils.STATS_BALANCING_RUNS] = balRuns[-max_balancing_runs:]
+        estVehicle.setAttrStats(allStats)
+
+        print('\n\tBalancing runs (mode, metric, budget, train rows, explore sec, accuracy, balanced accuracy):')
+        for nRun in allStats[type_utils.STATS_BALANCING_RUNS]:
+            print('\t%-9s %-18s %6d %9d %9.1f %8.4f %8.4f' % (nRun['mode'], nRun['metric'], nRun['time_budget'], nRun['train_rows'], nRun['explore_seconds'], nRun['accuracy'], nRun['balanced_accuracy']))
+
+
+    #
+    # Return the meta-features of the training dataset `X_train`, `y_train`
+    # and record them in the estimator statistics, or None when the
+    # meta-feature store is disabled.
+    #
+    def computeMetaFeatures(self, X_train, y_train, senseList, estVehicle):
+
+        if not estVehicle.getMetaFeatureStore():
+            return None
+
+        start_wc_seconds = time.time()
+        metaFeatures = meta_features.computeMetaFeatures(X_train, y_train, senseList, estVehicle.getRandomSeed())
+        print('\nMeta-features (' + ('%.1f' % (time.time() - start_wc_seconds)) + ' sec): ' + str(metaFeatures))
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_META_FEATURES] = metaFeatures
+        estVehicle.setAttrStats(allStats)
+
+        return metaFeatures
+
+
+    #
+    # Return the configuration values recorded by the previous search of
+    # `estVehicle` to seed its next search, see recordWarmStart().  Without a
+    # previous search, return the best configurations of the datasets nearest
+    # to `metaFeatures` in the meta-feature store, if not None.
+    #
+    def getWarmStartConfigs(self, estVehicle, metaFeatures=None):
+
+        if not estVehicle.getWarmStart():
+            return []
+
+        warmStats = estVehicle.getAttrStats().get(type_utils.STATS_WARM_START, {})
+        if len(warmStats.get('configs', [])) > 0 or None == metaFeatures:
+            return [wConfig['config'] for wConfig in warmStats.get('configs', [])]
+
+        metaStore    = meta_features.MetaFeatureStore(estVehicle.getMetaClientDB())
+        nearestDocs  = metaStore.findNearest(estVehicle.getEstimatorName(), metaFeatures, estVehicle.getMetaNeighbors())
+
+        # Take the best configurations of the nearest datasets first.
+        nearConfigs = []
+        for configIdx in range(estVehicle.getWarmStartConfigs()):
+            for distance, nDoc in nearestDocs:
+                if configIdx < len(nDoc[meta_features.META_CONFIGS]) and len(nearConfigs) < estVehicle.getWarmStartConfigs():
+                    nearConfigs.append(nDoc[meta_features.META_CONFIGS][configIdx]['config'])
+
+        neighborStats = [{'estimator': nDoc[meta_features.META_ESTIMATOR], 'distance': distance} for distance, nDoc in nearestDocs]
+        for nStats in neighborStats:
+            print('\tNearest modeled dataset: ' + nStats['estimator'] + ', distance ' + ('%.3f' % nStats['distance']))
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_META_NEIGHBORS] = neighborStats
+        estVehicle.setAttrStats(allStats)
+
+        return nearConfigs
+
+
+    #
+    # Return the PlateauWatcher of the stopping policy of `estVehicle`, or
+    # None if the search always runs for its full time budget.
+    #
+    def getPlateauWatcher(self, estVehicle):
+
+        plateauSeconds  = estVehicle.getPlateauSeconds()
+        plateauEvals    = estVehicle.getPlateauEvaluations()
+        if plateauSeconds <= 0 and plateauEvals <= 0:
+            return None
+
+        print('Plateau stopping policy  : ', 'epsilon ' + str(estVehicle.getPlateauEpsilon()) + ', ' + str(plateauSeconds) + ' sec, ' + str(plateauEvals) + ' evaluations')
+
+        return smac_utils.PlateauWatcher(estVehicle.getPlateauEpsilon(), plateauSeconds, plateauEvals)
+
+
+    #
+    # Return the AutoSKLearn resampling strategy of `estVehicle` and its
+    # arguments for the training target values `y_train`, before balancing,
+    # so that oversampled copies of rows do not count.  The "auto"
+    # strategy picks a single holdout when it holds enough rows of the least
+    # frequent class, otherwise cross validation with at most as many folds
+    # as that class has rows.  With `halving` the non-iterative variant is
+    # used, as required by the subsample budgets.  The strategy and its
+    # estimated cost per candidate, in fits on the full training data, are
+    # recorded in the estimator statistics.
+    #
+    def getResampling(self, estVehicle, y_train, halving):
+
+        resampling    = estVehicle.getResamplingStrategy()
+        numFolds      = estVehicle.getNumFolds()
+        minorityRows  = int(numpy.min(numpy.unique(y_train, return_counts=True)[1]))
+        holdoutFrac   = None
+
+        if self.aConfig.RESAMPLE_AUTO == resampling:
+            if minorityRows * auto_max_holdout >= auto_holdout_class_rows:
+                resampling   = 'holdout-iterative-fit'
+                holdoutFrac  = min(auto_max_holdout, max(auto_min_holdout, auto_holdout_class_rows / float(minorityRows)))
+            else:
+                resampling   = 'cv-iterative-fit'
+                numFolds     = max(2, min(numFolds, minorityRows))
+
+        if halving:
+            resampling = resampling.replace('-iterative-fit', '')
+
+        if resampling.startswith('holdout'):
+            strategy_args = {}
+            costFits      = 1.0 - auto_max_holdout
+            if None != holdoutFrac:
+                strategy_args['train_size'] = 1.0 - holdoutFrac
+                costFits                    = 1.0 - holdoutFrac
+        else:
+            strategy_args = {'folds': numFolds}
+            costFits      = numFolds - 1.0
+
+        resampleStats = {}
+        resampleStats['strategy']       = resampling
+        resampleStats['arguments']      = strategy_args
+        resampleStats['train_rows']     = int(len(y_train))
+        resampleStats['minority_rows']  = minorityRows
+        resampleStats['cost_fits']      = costFits
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_RESAMPLING] = resampleStats
+        estVehicle.setAttrStats(allStats)
+
+        print('Resampling strategy      : ', resampling + ' ' + str(strategy_args) + ', estimated cost ' + ('%.2f' % costFits) + ' full-data fits per candidate (' + str(len(y_train)) + ' rows, ' + str(minorityRows) + ' in the least frequent class)')
+
+        return resampling, strategy_args
+
+
+    #
+    # Return the (smallest subsample percentage, eta) of the successive
+    # halving search of `estVehicle`, or None for a search on the full
+    # training data.
+    #
+    def getHalvingArgs(self, estVehicle):
+
+        if not estVehicle.getSuccessiveHalving():
+            return None
+
+        if not 'budget_type' in inspect.signature(autosklearn.evaluation.ExecuteTaFuncWithQueue).parameters:
+            print('Successive halving on subsamples is not supported by the installed AutoSKLearn, searching on the full training data.')
+            return None
+
+        minSubsample  = 100.0 * estVehicle.getHalvingMinSubsample()
+        eta           = estVehicle.getHalvingEta()
+        print('Successive halving       : ', 'top 1/' + str(eta) + ' promoted, subsample budgets (%) ' + str(['%.1f' % hBudget for hBudget in smac_utils.getHalvingBudgets(minSubsample, eta)]))
+
+        return minSubsample, eta
+
+
+    #
+    # Record the number of configurations evaluated on each subsample budget
+    # of a successive halving search, and their best cost.
+    #
+    def recordHalvingSchedule(self, automl, estVehicle, halvingArgs):
+
+        if None == halvingArgs:
+            return
+
+        halvingStats = {}
+        halvingStats['min_subsample']  = halvingArgs[0]
+        halvingStats['eta']            = halvingArgs[1]
+        halvingStats['budgets']        = smac_utils.getBudgetSchedule(automl)
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_HALVING] = halvingStats
+        estVehicle.setAttrStats(allStats)
+
+        print('\n\tSuccessive halving (subsample %, evaluations, best cost):')
+        for nBudget in halvingStats['budgets']:
+            print('\t%6.1f %8d %10.5f' % (nBudget['budget'], nBudget['evaluations'], nBudget['best_cost']))
+
+
+    #
+    # Record the duration of the search and the reason it stopped, either
+    # the time budget or the plateau of `plateauWatch`.
+    #
+    def recordSearchStop(self, estVehicle, plateauWatch, explore_seconds):
+
+        stopStats = {}
+        stopStats['reason']           = 'time_budget'
+        stopStats['time_budget']      = estVehicle.getMaxGlobalTime()
+        stopStats['explore_seconds']  = explore_seconds
+        stopStats['unused_seconds']   = max(0.0, estVehicle.getMaxGlobalTime() - explore_seconds)
+        if None != plateauWatch:
+            stopStats['evaluations']  = plateauWatch.evaluations
+            stopStats['best_cost']    = plateauWatch.bestCost
+            if None != plateauWatch.stopReason:
+                stopStats['reason']         = plateauWatch.stopReason
+                stopStats['stop_seconds']   = plateauWatch.stopSeconds
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_SEARCH_STOP] = stopStats
+        estVehicle.setAttrStats(allStats)
+
+        print('\tSearch stopped by ' + stopStats['reason'] + ' after ' + ('%.1f' % explore_seconds) + ' of ' + str(stopStats['time_budget']) + ' sec.')
+
+
+    #
+    # Record the meta-features and the best configurations recorded under
+    # STATS_WARM_START in the meta-feature store, to seed the searches of
+    # similar datasets.
+    #
+    def saveMetaFeatures(self, estVehicle, metaFeatures):
+
+        warmStats = estVehicle.getAttrStats().get(type_utils.STATS_WARM_START, {})
+        if None == metaFeatures or 0 == len(warmStats.get('configs', [])):
+            return
+
+        metaStore = meta_features.MetaFeatureStore(estVehicle.getMetaClientDB())
+        metaStore.save(estVehicle.getEstimatorName(), metaFeatures, warmStats['metric'], warmStats['configs'])
+
+
+    #
+    # Record the best configurations evaluated by the search of `automl`,
+    # merged with those recorded by earlier searches with the same metric, to
+    # seed the next search.  When the previous search used the same metric,
+    # also record how long this search took to reach its best cost.
+    #
+    def recordWarmStart(self, automl, estVehicle, metric_string, search_start, seeded_count):
+
+        if not estVehicle.getWarmStart():
+            return
+
+        runConfigs = smac_utils.getRunHistoryConfigs(automl)
+        if 0 == len(runConfigs):
+            print('\tNo run history to warm start the next search.')
+            return
+
+        allStats   = estVehicle.getAttrStats()
+        prevStats  = allStats.get(type_utils.STATS_WARM_START, {})
+
+        warmStats = {}
+        warmStats['metric']          = metric_string
+        warmStats['time_budget']     = estVehicle.getMaxGlobalTime()
+        warmStats['seeded_configs']  = seeded_count
+        warmStats['evaluated']       = len(runConfigs)
+        warmStats['best_cost']       = runConfigs[0]['cost']
+
+        # The costs of another metric do not compare.
+        bestConfigs = [{'config': rConfig['config'], 'cost': rConfig['cost']} for rConfig in runConfigs]
+        if metric_string == prevStats.get('metric'):
+            bestConfigs += prevStats.get('configs', [])
+            warmStats['previous_best_cost']        = prevStats['best_cost']
+            warmStats['seconds_to_previous_best']  = smac_utils.getSecondsToCost(runConfigs, prevStats['best_cost'], search_start)
+
+        seenConfigs = set()
+        warmStats['configs'] = []
+        for bConfig in sorted(bestConfigs, key=lambda bConfig: bConfig['cost']):
+            configKey = json.dumps(bConfig['config'], sort_keys=True)
+            if not configKey in seenConfigs and len(warmStats['configs']) < estVehicle.getWarmStartConfigs():
+                seenConfigs.add(configKey)
+                warmStats['configs'].append(bConfig)
+
+        allStats[type_utils.STATS_WARM_START] = warmStats
+        estVehicle.setAttrStats(allStats)
+
+        print('\n\tWarm start: best cost ' + ('%.5f' % warmStats['best_cost']) + ' over ' + str(warmStats['evaluated']) + ' configurations, ' + str(seeded_count) + ' seeded.')
+        if 'previous_best_cost' in warmStats:
+            reachedSeconds = warmStats['seconds_to_previous_best']
+            reachedStr     = 'not reached' if None == reachedSeconds else 'reached after ' + ('%.1f' % reachedSeconds) + ' sec'
+            print('\tWarm start: previous best cost ' + ('%.5f' % warmStats['previous_best_cost']) + ' ' + reachedStr + '.')
+
+
+    #
+    # Record the seconds taken by the evaluation phase `phaseName` since
+    # `phaseStart` in `evalSeconds` and return the current time.
+    #
+    def timePhase(self, evalSeconds, phaseName, phaseStart):
+
+        phaseEnd               = time.time()
+        evalSeconds[phaseName] = phaseEnd - phaseStart
+        print('\tEvaluation phase ' + phaseName + ': ' + ('%.2f' % evalSeconds[phaseName]) + ' sec')
+
+        return phaseEnd
+
+
+    #
+    # Return the permutation importance of each attribute of the test matrix
+    # `X_test` for `automl` and the target values `y_test`, computed on a
+    # stratified subsample with adaptive repeats, and its cost.  With the
+    # `perm_importance_check` setting, the exhaustive importances, 10 repeats
+    # on all test rows, are computed as well and the attributes whose
+    # importance lies within the confidence interval of the exhaustive one,
+    # or whose interval overlaps it, are counted.
+    #
+    def computePermImportance(self, automl, X_test, y_test, estVehicle):
 
-        estName       = estVehicle.getEstimatorName()
         rand_seed     = estVehicle.getRandomSeed()
         allowed_jobs  = estVehicle.getAllowedCPUs()
+        exh_repeats   = 10
+
+        p_imp = perm_importance.computePermImportance(
+                    automl, X_test, y_test,
+                    stratified   = estVehicle.getIsClassification(),
+                    randSeed     = rand_seed,
+                    maxRows      = estVehicle.getPermImportanceRows(),
+                    maxRepeats   = estVehicle.getPermImportanceRepeats(),
+                    ciHalfWidth  = estVehicle.getPermImportanceCI(),
+                    nJobs        = allowed_jobs,
+                    )
+
+        costStats = {}
+        costStats['test_rows']                  = len(y_test)
+        costStats['sample_rows']                = p_imp.sample_rows
+        costStats['repeats']                    = [len(impList) for impList in p_imp.importances]
+        costStats['ci_half_widths']             = p_imp.ci_half_widths.tolist()
+        costStats['predictions']                = p_imp.predictions
+        costStats['predicted_rows']             = p_imp.predicted_rows
+        costStats['seconds']                    = p_imp.seconds
+        costStats['exhaustive_predicted_rows']  = (1 + exh_repeats * X_test.shape[1]) * len(y_test)
+
+        print('\tPermutation importance: ' + str(p_imp.predictions) + ' predictions of ' + str(p_imp.sample_rows) + ' of ' + str(len(y_test)) + ' test rows in ' + ('%.2f' % p_imp.seconds) + ' sec, ' + ('%.1f%%' % (100.0 * p_imp.predicted_rows / max(1, costStats['exhaustive_predicted_rows']))) + ' of the exhaustive predicted rows.')
+
+        if estVehicle.getPermImportanceCheck():
+            exhStart = time.time()
+            exh_imp  = sklearn.inspection.permutation_importance(automl, X_test, y_test, n_repeats=exh_repeats, random_state=rand_seed, n_jobs=allowed_jobs)
+            exhCI    = numpy.array([perm_importance.getCIHalfWidth(impList) for impList in exh_imp.importances])
+            impDiffs = numpy.abs(p_imp.importances_mean - exh_imp.importances_mean)
+
+            costStats['exhaustive_seconds']    = time.time() - exhStart
+            costStats['exhaustive_means']      = exh_imp.importances_mean.tolist()
+            costStats['within_exhaustive_ci']  = int(numpy.sum(impDiffs <= exhCI))
+            costStats['within_ci']             = int(numpy.sum(impDiffs <= exhCI + p_imp.ci_half_widths))
+
+            print('\tExhaustive permutation importance in ' + ('%.2f' % costStats['exhaustive_seconds']) + ' sec, ' + str(costStats['within_exhaustive_ci']) + ' of ' + str(len(impDiffs)) + ' importances within its confidence interval, ' + str(costStats['within_ci']) + ' with overlapping intervals.')
+
+        return p_imp, costStats
+
+
+    #
+    # Record the test scores of `automl` on the test matrix `X_test` with the
+    # attribute names `attrNames`, and the target values `y_test`.  A float32
+    # matrix is upcast to float64 for the evaluation only.
+    # For classification, the class probabilities of the test dataset are
+    # predicted once, the predicted classes are the most probable of
+    # `classLabels`, the sorted classes of the training dataset, and all
+    # scores and curves are computed from them.  The seconds of each
+    # evaluation phase are recorded in the estimator statistics.
+    #
+    def computeStats(self, automl, target, X_test, y_test, attrNames, estVehicle, classLabels=None):
+
+        estName       = estVehicle.getEstimatorName()
+        allowed_jobs  = estVehicle.getAllowedCPUs()
+        evalSeconds   = {}
 
 
         ## print('\nEXPLORE, y_test = ' + str(y_test))
         ## print('EXPLORE, X_test = ' + str(X_test))
-        np_x_test     = X_test.to_numpy(dtype='float')
-        np_y_test     = y_test.to_numpy(dtype='float')
+        np_x_test     = X_test.astype(numpy.float64, copy=False)
+        np_y_test     = y_test.astype(numpy.float64)
         ## print('EXPLORE, X_test.dtype = ' + str(np_x_test.dtype))
         print("\nChecking the AutoSklearnClassifier against the " + estName + " test dataset.")
-        y_hat         = automl.predict(np_x_test, batch_size=None, n_jobs=1)
+        phaseStart    = time.time()
+        if estVehicle.getIsClassification():
+            proba_y_hat = automl.predict_proba(np_x_test, batch_size=None, n_jobs=allowed_jobs)
+            if classLabels is None:
+                classLabels = numpy.arange(proba_y_hat.shape[1])
+            y_hat       = numpy.asarray(classLabels)[numpy.argmax(proba_y_hat, axis=1)]
+        else:
+            y_hat       = automl.predict(np_x_test, batch_size=None, n_jobs=allowed_jobs)
+        phaseStart    = self.timePhase(evalSeconds, 'predict', phaseStart)
      
         print("\n\tAccuracy score: ", sklearn.metrics.accuracy_score(y_test, y_hat))
         
@@ -287,13 +1081,12 @@ class ExplorationStage(object):
 
             allStats[type_utils.STATS_PRECISION_SCORE] = precisionDict
             allStats[type_utils.STATS_RECALL_SCORE]    = recallDict
+        phaseStart = self.timePhase(evalSeconds, 'scores', phaseStart)
 
         #
         # Compute ROC curves for each target class/label.
         #
         if estVehicle.getIsClassification():
-            proba_y_hat = automl.predict_proba(np_x_test, batch_size=None, n_jobs=allowed_jobs)
-
             fprDict         = {}
             tprDict         = {}
             rocaucDict      = {}
@@ -316,15 +1109,20 @@ class ExplorationStage(object):
             allStats[type_utils.STATS_ROCAUC_SCORE]  = rocaucDict
             allStats[type_utils.STATS_FPR]           = fprDict
             allStats[type_utils.STATS_TPR]           = tprDict
+        phaseStart = self.timePhase(evalSeconds, 'roc', phaseStart)
 
         #
         # Compute Permutation Importance
         #
-        p_imp = sklearn.inspection.permutation_importance(automl, np_x_test, np_y_test, n_repeats=10, random_state=rand_seed, n_jobs=allowed_jobs)
-        allStats[type_utils.STATS_ATTR_NAMES]  = list(X_test)
+        p_imp, costStats = self.computePermImportance(automl, np_x_test, np_y_test, estVehicle)
+        allStats[type_utils.STATS_ATTR_NAMES]  = list(attrNames)
         allStats[type_utils.STATS_PERMI_MEAN]  = p_imp.importances_mean.tolist()
         allStats[type_utils.STATS_PERMI_STD]   = p_imp.importances_std.tolist()
-        allStats[type_utils.STATS_PERMI_VALS]  = p_imp.importances.tolist()
+        allStats[type_utils.STATS_PERMI_VALS]  = p_imp.importances
+        allStats[type_utils.STATS_PERMI_COST]  = costStats
+        phaseStart = self.timePhase(evalSeconds, 'permutation_importance', phaseStart)
+
+        allStats[type_utils.STATS_EVAL_SECONDS] = evalSeconds
 
         estVehicle.setAttrStats(allStats)
         
@@ -336,11 +1134,11 @@ class ExplorationStage(object):
     # documents/rows in `estName`.
     # 
     #
-    def exploreSKLearn(self, target, estVehicle, cleanDF):
+    def exploreSKLearn(self, target, estVehicle, mMatrix, daskClient=None):
 
         estName = estVehicle.getEstimatorName()
         
-        rand_seed = estVehicle.getRandomSeed()
+        rand_seed = estVehicle.getSearchSeed()
 
         start_wc_seconds = time.time()
         
@@ -378,6 +1176,13 @@ class ExplorationStage(object):
         # Select the training metric (loss function).
         #
         metric_string      = estVehicle.getMetric()
+        weights_replaced   = None
+        if self.aConfig.BALANCE_CAT_WEIGHT == self.aConfig.getModelCategoryBalancing():
+            if not self.acceptsSampleWeights(autosklearn.classification.AutoSklearnClassifier):
+                balanced_string = self.getBalancedMetric(metric_string)
+                print('Balancing by weights is not supported by the installed AutoSKLearn, using the metric ' + balanced_string + ' instead of ' + metric_string + '.')
+                metric_string    = balanced_string
+                weights_replaced = 'metric_swap'
         metric_object      = self.getClassificationMetric(metric_string)
 
         print("Selected estimators      : ", use_est)
@@ -394,11 +1199,27 @@ class ExplorationStage(object):
         
         print("Using " + estName + " dataset.")
         
-        all_X, all_y = self.splitDatasetXandY(cleanDF, target)
-        
-        print("Splitting out test and train datasets.")
-        X_train, X_test, y_train, y_test = \
-                sklearn.model_selection.train_test_split(all_X, all_y, test_size=0.2, random_state=rand_seed)
+        X_train, y_train, w_train = mMatrix.getTrain()
+        X_test, y_test, w_test    = mMatrix.getTest()
+
+        attrNames = mMatrix.getAttrNames()
+        senseList = self.generateSenseList(attrNames, estVehicle.getModelSenses())
+
+        print('\nExplore: Attribute names: ' + str(attrNames))
+        print('Explore: Selected senses: ' + str(senseList))
+
+        metaFeatures = self.computeMetaFeatures(X_train, y_train, senseList, estVehicle)
+
+        # Oversampling copies the selected rows, otherwise the training rows
+        # of the model matrix are passed as they are.
+        balRows, w_train_bal = self.balanceSamples(y_train, w_train, estVehicle)
+        if balRows is None:
+            X_train_bal, y_train_bal = X_train, y_train
+        else:
+            X_train_bal, y_train_bal = X_train[balRows], y_train[balRows]
+        print('\nTraining dataset size: ' + str(X_train_bal.shape))
+        print('Test dataset size: ' + str(X_test.shape))
+        self.recordStepMemory(estVehicle, 'balance')
         
         
         # autosklearn.regression.AutoSklearnRegressor
@@ -407,7 +1228,22 @@ class ExplorationStage(object):
         # if None == automl:
 
         print("Instantiating AutoSklearnClassifier.")
-        strategy_args = {'folds': 5}
+
+        # A distributed search evaluates the configurations on the dask
+        # workers, which read the dataset that AutoSKLearn stores in its
+        # temporary folder.  The ensemble is built here.
+        search_args   = {}
+        if None != estVehicle.getSearchTmpFolder():
+            search_args['tmp_folder'] = estVehicle.getSearchTmpFolder()
+        if None != daskClient:
+            search_args['dask_client'] = daskClient
+        warmConfigs   = self.getWarmStartConfigs(estVehicle, metaFeatures)
+        plateauWatch  = self.getPlateauWatcher(estVehicle)
+        halvingArgs   = self.getHalvingArgs(estVehicle)
+        if len(warmConfigs) > 0 or None != plateauWatch or None != halvingArgs:
+            search_args['get_smac_object_callback'] = smac_utils.SMACObjectCallback(warmConfigs, plateauWatch, halvingArgs)
+
+        resampling, strategy_args = self.getResampling(estVehicle, y_train, None != halvingArgs)
         automl = autosklearn.classification.AutoSklearnClassifier(
                      time_left_for_this_task = max_time_global,
                      per_run_time_limit      = max_time_model,
@@ -420,30 +1256,43 @@ class ExplorationStage(object):
                      ensemble_size           = ensemble_size,
                      ensemble_nbest          = ensemble_nbest,
                      max_models_on_disc      = max_models_on_disc,
-                     resampling_strategy            = 'cv-iterative-fit',
+                     resampling_strategy            = resampling,
                      resampling_strategy_arguments  = strategy_args,
-                     metric                  = metric_object
+                     metric                  = metric_object,
+                     **search_args
                      )
  
                      # initial_configurations_via_metalearning = 0,
 
-        attrNames = all_X.columns.values.tolist()
-        senseList = self.generateSenseList(attrNames, estVehicle.getAttrSenses())
-
-        print('\nExplore: Attribute names: ' + str(attrNames))
-        print('Explore: Selected senses: ' + str(senseList))
-
-        X_train_bal, y_train_bal = self.balanceSamples(X_train, y_train, estVehicle)
-        print('\nTraining dataset size: ' + str(X_train_bal.shape))
-        print('Test dataset size: ' + str(X_test.shape))
-
         print("\nTraining the AutoSklearnClassifier on the " + estName + " train dataset.\n")
-        automl.fit(X_train_bal, y_train_bal, feat_type=senseList, dataset_name=estName)
+        try:
+            automl.fit(X_train_bal, y_train_bal, feat_type=senseList, dataset_name=estName, **self.getFitWeightArgs(automl, w_train_bal))
+        finally:
+            if None != plateauWatch:
+                plateauWatch.stop()
 
         end_wc_seconds = time.time()
         print("\n\tElapsed explore time (sec): ", end_wc_seconds - start_wc_seconds)
-
-        self.computeStats(automl, target, X_test, y_test, estVehicle)        
+        self.recordStepMemory(estVehicle, 'search')
+        self.recordSearchStop(estVehicle, plateauWatch, end_wc_seconds - start_wc_seconds)
+        self.recordHalvingSchedule(automl, estVehicle, halvingArgs)
+        self.recordWarmStart(automl, estVehicle, metric_string, start_wc_seconds, len(warmConfigs))
+        self.saveMetaFeatures(estVehicle, metaFeatures)
+
+        train_rows = X_train_bal.shape[0]
+        classLabels = numpy.unique(y_train_bal)
+        del X_train_bal, y_train_bal
+
+        y_hat = self.computeStats(automl, target, X_test, y_test, attrNames, estVehicle, classLabels)
+        self.recordBalancingRun(estVehicle, metric_string, train_rows, end_wc_seconds - start_wc_seconds, y_test, y_hat, weights_replaced)
+
+        if mMatrix.isFloat32():
+            checkStart = time.time()
+            self.checkFloat32Accuracy(automl, y_hat, X_test, y_test, estVehicle)
+            allStats = estVehicle.getAttrStats()
+            self.timePhase(allStats[type_utils.STATS_EVAL_SECONDS], 'float32_check', checkStart)
+            estVehicle.setAttrStats(allStats)
+        self.recordStepMemory(estVehicle, 'test')
         
         # print("\n\tResults DataFrame: ")
         # print(automl.cv_results_)
@@ -464,22 +1313,33 @@ class ExplorationStage(object):
     # documents/rows in `estName`.
     # 
     #
-    def finalizeSKLearnEnsemble(self, automl, target, estVehicle, cleanDF):
+    def finalizeSKLearnEnsemble(self, automl, target, estVehicle, mMatrix):
 
         estName = estVehicle.getEstimatorName()
         
         start_wc_seconds = time.time()
         
-        all_X, all_y = self.splitDatasetXandY(cleanDF, target)
+        all_X, all_y, all_w = mMatrix.getAll()
 
         print('\nFinal ' + estName + ' training using all data and refit().')
         
-        all_X_bal, all_y_bal = self.balanceSamples(all_X, all_y, estVehicle)
-        automl.refit(all_X_bal, all_y_bal)
+        # refit() does not accept sample weights, the rows are resampled in
+        # proportion to their weights instead.
+        balRows, all_w_bal = self.balanceSamples(all_y, all_w, estVehicle)
+        if all_w_bal is not None:
+            balRows = self.resampleByWeights(balRows, all_w_bal)
+        if balRows is None:
+            automl.refit(all_X, all_y)
+        else:
+            automl.refit(all_X[balRows], all_y[balRows])
 
         end_wc_seconds = time.time()
         
         print("\n\tElapsed refit time (sec): ", end_wc_seconds - start_wc_seconds)
+
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_REFIT_SECONDS] = end_wc_seconds - start_wc_seconds
+        estVehicle.setAttrStats(allStats)
         
         # print("\n\tResults DataFrame: ")
         # print(automl.cv_results_)
@@ -502,7 +1362,13 @@ class ExplorationStage(object):
         srcColl    = pymongo.collection.Collection( cleanedClientDB, collName )
         srcQuery   = {  target : { "$exists": True }}
 
-        cleanDF    = self.loadCleanDF(srcColl, srcQuery, estVehicle, target)
+        # Replace the memory figures of an earlier run.
+        allStats = estVehicle.getAttrStats()
+        allStats[type_utils.STATS_STEP_MEMORY] = {}
+
+        mMatrix = self.loadModelMatrix(srcColl, srcQuery, estVehicle, target)
+        print('\tModel matrix: ' + str(mMatrix.X.shape) + ' ' + str(mMatrix.X.dtype) + ', ' + perf_utils.formatBytes(mMatrix.getBytes()))
+        self.recordStepMemory(estVehicle, 'matrix')
         
         # destColl   = pymongo.collection.Collection( resultClientDB, collName )
         # destColl.drop()
@@ -510,19 +1376,19 @@ class ExplorationStage(object):
         # print('Explore dataframe:')
         # print(str(cleanDF))
         
-        # Use the recorded categorical attribute transforms to convert the
-        # categorical attributes to categorical integers expected by autosklearn.
+        # The cleanup stage stored the categorical attributes as the integer
+        # codes expected by autosklearn, so no transform is needed here.
         # Note that the target attribute will be one of those attributes when
         # True == estVehicle.getIsClassification().
-        attrSenses = estVehicle.getAttrSenses()
-        for attrName, attrSense in attrSenses.items():
-            if attrSense == type_utils.SENSE_CATEGORICAL:
-                attrEncoder = estVehicle.getAttrTransform(attrName)
-                cleanDF[attrName] = attrEncoder.transform(cleanDF[attrName])
 
-        automl = self.exploreSKLearn(target, estVehicle, cleanDF.copy())
-        
-        automl = self.finalizeSKLearnEnsemble(automl, target, estVehicle, cleanDF.copy())
+        daskClient = self.getDaskClient(estVehicle)
+        try:
+            automl = self.exploreSKLearn(target, estVehicle, mMatrix, daskClient)
+
+            automl = self.finalizeSKLearnEnsemble(automl, target, estVehicle, mMatrix)
+            self.recordStepMemory(estVehicle, 'refit')
+        finally:
+            self.closeDaskClient(daskClient)
         
         estVehicle.setAutoSklearnClassifier(automl)
 
@@ -538,11 +1404,129 @@ class ExplorationStage(object):
 
 
 
+    #
+    # Return a dask client connected to the scheduler selected for the model
+    # search of `estVehicle`, or None to search with the AutoSKLearn `n_jobs`
+    # processes.  The scheduler "local" starts a cluster of worker processes
+    # on this host.
+    #
+    def getDaskClient(self, estVehicle):
+
+        schedAddr = estVehicle.getDaskScheduler()
+        if None == schedAddr or 0 == len(schedAddr):
+            return None
+
+        if not 'dask_client' in inspect.signature(autosklearn.classification.AutoSklearnClassifier).parameters:
+            print('The installed AutoSKLearn does not accept a dask client, searching with ' + str(estVehicle.getAllowedCPUs()) + ' local job(s) instead.')
+            return None
+
+        try:
+            import dask.distributed
+        except ImportError as eX:
+            print('The dask.distributed package is not installed, searching with ' + str(estVehicle.getAllowedCPUs()) + ' local job(s) instead.')
+            return None
+
+        if self.aConfig.DASK_LOCAL == schedAddr:
+            workerCount = estVehicle.getDaskWorkers()
+            daskCluster = dask.distributed.LocalCluster(n_workers=workerCount, processes=True, threads_per_worker=1)
+            daskClient  = dask.distributed.Client(daskCluster)
+        else:
+            daskClient  = dask.distributed.Client(schedAddr)
+
+        workerCount = len(daskClient.scheduler_info().get('workers', {}))
+        print('Distributed search on the dask scheduler ' + str(daskClient.scheduler.address) + ' with ' + str(workerCount) + ' worker(s).')
+        if None == estVehicle.getSearchTmpFolder() and self.aConfig.DASK_LOCAL != schedAddr:
+            print('WARNING: workers on other hosts need a shared search_tmp_folder to read the dataset.')
+
+        return daskClient
+
+
+    #
+    # Close `daskClient`, and the local cluster it started, if any.
+    #
+    def closeDaskClient(self, daskClient):
+
+        if None == daskClient:
+            return
+
+        daskCluster = daskClient.cluster
+        daskClient.close()
+        if None != daskCluster:
+            daskCluster.close()
+
+
+    #
+    # Run the model search of the estimator on `collName`, in a process
+    # forked by the search scheduler, with its own database connection and
+    # on the `grantedCPUs` cores the scheduler reserved for it.
+    #
+    def exploreForked(self, collName, target, grantedCPUs):
+
+        mUtils = mongo_utils.MongoUtils()
+        cleanedClient = mUtils.getMongoClient(self.aConfig.getCleanedURI())
+        cleanedClientDB = cleanedClient.get_default_database()
+
+        estVehicle = self.aConfig.getEstVehicle(collName)
+        estVehicle.resetMetaClientDB()
+        estVehicle.setGrantedCPUs(grantedCPUs)
+        self.setRandomSeeds(estVehicle)
+        self.exploreEst(estVehicle, cleanedClientDB, target, collName)
+        estVehicle.doFlushAll()
+
+
+
+    #
+    # Run the model searches of the estimators in `estList` in parallel
+    # processes sharing `cpuBudget` cores.  The searches store the models
+    # and statistics of the estimators, so the vehicles of this process
+    # reload them afterwards, along with the GridFS ids of the stored
+    # objects, which the searches replaced.
+    #
+    def exploreConcurrent(self, estList, cpuBudget):
+
+        scheduler = search_scheduler.SearchScheduler(cpuBudget)
+
+        for estimator in estList:
+            collName = estimator.get(self.aConfig.SRC_COLLNAME)
+            target = estimator.get(self.aConfig.TARGET_NAME)
+            estVehicle = self.aConfig.getEstVehicle(collName)
+            scheduler.addSearch(collName, estVehicle.getAllowedCPUs(), self.exploreForked, (collName, target))
+
+        results = scheduler.run()
+
+        for jobName, jobCPUs, elapsed, exitCode in results:
+            if 0 != exitCode:
+                print('\nWARNING: the model search for ' + jobName + ' failed with exit code ' + str(exitCode) + '.')
+
+        for estimator in estList:
+            estVehicle = self.aConfig.getEstVehicle(estimator.get(self.aConfig.SRC_COLLNAME))
+            estVehicle.getFSId(None, doLoad=True)
+            estVehicle.getAttrStats(doLoad=True)
+            if estVehicle.getIsClassification():
+                estVehicle.getAutoSklearnClassifier(doLoad=True)
+            if estVehicle.getIsRegression():
+                estVehicle.getAutoSklearnRegressor(doLoad=True)
+
+
+
     #
     #
     #
     def explore(self):
 
+        print('\n=============================================')
+        print('\tMODEL STAGE...')
+        print('=============================================\n')
+
+        # Get the list of estimators (predictors) that will be constructed.
+        estList = self.aConfig.getEstimatorList()
+
+        # With a CPU budget, several estimators are searched at once.  The
+        # database connections are opened by each search process.
+        cpuBudget = self.aConfig.getCPUBudget()
+        if cpuBudget > 0 and len(estList) > 1:
+            self.exploreConcurrent(estList, cpuBudget)
+            return
 
         mUtils = mongo_utils.MongoUtils()
 
@@ -558,14 +1542,6 @@ class ExplorationStage(object):
         # resultClient = mUtils.getMongoClient(result_uri)
         # resultClientDB = resultClient.get_default_database()
 
-
-        print('\n=============================================')
-        print('\tMODEL STAGE...')
-        print('=============================================\n')
-
-        # Get the list of estimators (predictors) that will be constructed.
-        estList = self.aConfig.getEstimatorList()
-
         # Build the schema and transfer raw docs for each estimator.
         for estimator in estList:
             collName = estimator.get(self.aConfig.SRC_COLLNAME)
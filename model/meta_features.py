@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import math
+import time
+
+import numpy
+import pymongo
+
+import sklearn.model_selection
+import sklearn.naive_bayes
+import sklearn.neighbors
+import sklearn.tree
+
+from schema import type_utils
+
+
+#
+# Maximum number of training rows used by the landmarkers.
+#
+LANDMARK_MAX_ROWS   = 2000
+
+#
+# Names of the meta-features compared by MetaFeatureStore.findNearest(), in
+# order.  The counts are compared on a log scale.
+#
+META_FEATURE_NAMES  = [
+    'log_rows',
+    'log_attributes',
+    'log_classes',
+    'class_entropy',
+    'minority_fraction',
+    'categorical_fraction',
+    'landmark_stump',
+    'landmark_naive_bayes',
+    'landmark_1nn',
+]
+
+#
+# Keys of the documents in the meta-feature collection.
+#
+META_ESTIMATOR      = 'estimator'
+META_FEATURES       = 'meta_features'
+META_METRIC         = 'metric'
+META_CONFIGS        = 'configs'
+META_UPDATED        = 'updated'
+
+
+
+#
+# Return the mean 3-fold cross-validated accuracy of `landmarker` on the
+# attributes `X` and target values `y`.
+#
+def getLandmarkScore(landmarker, X, y):
+
+    cvFolds = min(3, int(numpy.min(numpy.unique(y, return_counts=True)[1])))
+    if cvFolds < 2:
+        return 0.0
+
+    return float(numpy.mean(sklearn.model_selection.cross_val_score(landmarker, X, y, cv=cvFolds)))
+
+
+
+#
+# Return the meta-features of the training attributes `X` and target values
+# `y`, where `senseList` holds the sense of each attribute.  The landmarkers
+# are fit on a stratified subsample of at most LANDMARK_MAX_ROWS rows.
+#
+def computeMetaFeatures(X, y, senseList, randSeed):
+
+    rowCount, attrCount = X.shape
+    classes, classCounts = numpy.unique(y, return_counts=True)
+    classFracs = classCounts / float(rowCount)
+
+    metaFeatures = {}
+    metaFeatures['log_rows']              = math.log10(max(1, rowCount))
+    metaFeatures['log_attributes']        = math.log10(max(1, attrCount))
+    metaFeatures['log_classes']           = math.log10(max(1, len(classes)))
+    metaFeatures['class_entropy']         = float(-numpy.sum(classFracs * numpy.log(classFracs)) / math.log(len(classes))) if len(classes) > 1 else 0.0
+    metaFeatures['minority_fraction']     = float(numpy.min(classFracs))
+    metaFeatures['categorical_fraction']  = senseList.count(type_utils.SENSE_CATEGORICAL) / float(max(1, attrCount))
+
+    landRows = numpy.arange(rowCount)
+    if rowCount > LANDMARK_MAX_ROWS:
+        # A stratified split needs two rows of each class and room for each
+        # class on both sides of the split.
+        stratify = y
+        if numpy.min(classCounts) < 2 or min(LANDMARK_MAX_ROWS, rowCount - LANDMARK_MAX_ROWS) < len(classes):
+            stratify = None
+        landRows, restRows = sklearn.model_selection.train_test_split(landRows, train_size=LANDMARK_MAX_ROWS, random_state=randSeed, stratify=stratify)
+    X_land, y_land = X[landRows], y[landRows]
+
+    metaFeatures['landmark_stump']        = getLandmarkScore(sklearn.tree.DecisionTreeClassifier(max_depth=1, random_state=randSeed), X_land, y_land)
+    metaFeatures['landmark_naive_bayes']  = getLandmarkScore(sklearn.naive_bayes.GaussianNB(), X_land, y_land)
+    metaFeatures['landmark_1nn']          = getLandmarkScore(sklearn.neighbors.KNeighborsClassifier(n_neighbors=1), X_land, y_land)
+
+    return metaFeatures
+
+
+
+#
+# -- MetaFeatureStore
+#
+# The metadata collection holding, for each estimator trained, the
+# meta-features of its dataset and the best configurations of its last model
+# search.  The configurations of the datasets nearest to a new one seed the
+# search of the new one.
+#
+class MetaFeatureStore(object):
+    """ Meta-features and best configurations of the modeled datasets.
+    """
+
+    #
+    #
+    #
+    def __init__(self, metaClientDB):
+
+        self.metaColl = pymongo.collection.Collection( metaClientDB, type_utils.META_FEATURES_COLL )
+
+
+    #
+    # Record the meta-features and best configurations of the dataset of the
+    # estimator `estName`, replacing any earlier record.
+    #
+    def save(self, estName, metaFeatures, metric, configs):
+
+        metaDoc = {
+            META_ESTIMATOR  : estName,
+            META_FEATURES   : metaFeatures,
+            META_METRIC     : metric,
+            META_CONFIGS    : configs,
+            META_UPDATED    : time.time(),
+        }
+        self.metaColl.replace_one({ META_ESTIMATOR: estName }, metaDoc, upsert=True)
+
+
+    #
+    # Return the records of the `nCount` datasets nearest to `metaFeatures`,
+    # other than the dataset of `estName`, as a list of (distance, record).
+    # Each meta-feature is scaled by its range over all records, so that all
+    # of them weigh the same.
+    #
+    def findNearest(self, estName, metaFeatures, nCount):
+
+        metaDocs = [nDoc for nDoc in self.metaColl.find({ META_ESTIMATOR: { '$ne': estName } }) if len(nDoc.get(META_CONFIGS, [])) > 0]
+        if 0 == len(metaDocs):
+            return []
+
+        allFeatures  = numpy.array([[nDoc[META_FEATURES].get(fName, 0.0) for fName in META_FEATURE_NAMES] for nDoc in metaDocs])
+        newFeatures  = numpy.array([metaFeatures.get(fName, 0.0) for fName in META_FEATURE_NAMES])
+
+        bothFeatures  = numpy.vstack([allFeatures, newFeatures])
+        featureRange  = numpy.ptp(bothFeatures, axis=0)
+        featureRange[featureRange == 0.0] = 1.0
+        distances     = numpy.sqrt(numpy.sum(((allFeatures - newFeatures) / featureRange) ** 2, axis=1))
+
+        return [(float(distances[docIdx]), metaDocs[docIdx]) for docIdx in numpy.argsort(distances, kind='stable')[:nCount]]
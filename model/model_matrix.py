@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import numpy
+
+from schema import type_utils
+
+
+#
+# Return True if the values of `column` survive the conversion to float32:
+# integer values must convert exactly and finite float values must stay
+# finite.
+#
+def isFloat32Exact(column):
+
+    narrowCol = column.astype(numpy.float32)
+
+    if column.dtype.kind in 'iub':
+        return numpy.array_equal(narrowCol.astype(numpy.float64), column.astype(numpy.float64))
+
+    return numpy.array_equal(numpy.isfinite(narrowCol), numpy.isfinite(column))
+
+
+
+#
+# -- ModelMatrix
+#
+# The dataset of the model stage as a single read-only feature matrix, with
+# the target values and the optional sample weights (the CLEANED_COUNT
+# column) as separate arrays.  The training rows come first and the holdout
+# (test) rows last, so that the training, test and complete datasets are
+# views of the same matrix rather than copies.  See packModelMatrix().
+#
+class ModelMatrix(object):
+    """ Read-only feature matrix with train and test row ranges.
+    """
+
+    #
+    # `X` holds the attributes `attrNames` of each row, `y` the target
+    # values and `weights` the sample weights or None.  The first
+    # `trainCount` rows are the training dataset.
+    #
+    def __init__(self, attrNames, trainCount, X, y, weights=None):
+
+        self.attrNames   = list(attrNames)
+        self.trainCount  = trainCount
+        self.X           = X
+        self.y           = y
+        self.weights     = weights
+
+        self.X.flags.writeable = False
+        self.y.flags.writeable = False
+        if self.weights is not None:
+            self.weights.flags.writeable = False
+
+
+    #
+    #
+    #
+    def getAttrNames(self):
+        return self.attrNames
+
+
+    #
+    #
+    #
+    def getTrainCount(self):
+        return self.trainCount
+
+
+    #
+    # Return the arrays of the matrix by name, as stored in the dataset
+    # cache.  The weights are left out if there are none.
+    #
+    def getArrays(self):
+
+        arrayDict = { 'X': self.X, 'y': self.y }
+        if self.weights is not None:
+            arrayDict['weights'] = self.weights
+
+        return arrayDict
+
+
+    #
+    # Return True if the matrix holds float32 values.
+    #
+    def isFloat32(self):
+        return numpy.float32 == self.X.dtype
+
+
+    #
+    # Return the number of bytes held by the matrix and its arrays.
+    #
+    def getBytes(self):
+
+        matrixBytes = self.X.nbytes + self.y.nbytes
+        if self.weights is not None:
+            matrixBytes += self.weights.nbytes
+
+        return matrixBytes
+
+
+    #
+    # Return views of the attributes, target values and weights (or None) of
+    # the rows in [`rowStart`, `rowEnd`).
+    #
+    def getRows(self, rowStart, rowEnd):
+
+        weights = None
+        if self.weights is not None:
+            weights = self.weights[rowStart:rowEnd]
+
+        return self.X[rowStart:rowEnd], self.y[rowStart:rowEnd], weights
+
+
+    #
+    #
+    #
+    def getTrain(self):
+        return self.getRows(0, self.trainCount)
+
+
+    #
+    #
+    #
+    def getTest(self):
+        return self.getRows(self.trainCount, self.X.shape[0])
+
+
+    #
+    #
+    #
+    def getAll(self):
+        return self.getRows(0, self.X.shape[0])
+
+
+
+#
+# Pack the loaded columns `dsColumns`, a dictionary of equally long arrays
+# holding the attributes, the `target` and possibly the CLEANED_COUNT
+# weights, into a ModelMatrix whose first `trainCount` rows are the
+# training dataset.  The matrix is float32 if `useFloat32` and all values
+# survive the conversion, float64 otherwise.
+#
+# Each column is removed from `dsColumns` as soon as it is packed, so that
+# its memory is released while the matrix fills rather than after it, as
+# long as the caller holds no other reference to the columns.
+#
+def packModelMatrix(dsColumns, target, trainCount, useFloat32=False):
+
+    attrNames  = [colName for colName in dsColumns if not colName in [target, type_utils.CLEANED_COUNT]]
+    rowCount   = len(dsColumns[target])
+
+    dtype = numpy.dtype(numpy.float64)
+    if useFloat32:
+        dtype = numpy.dtype(numpy.float32)
+        for colName in attrNames:
+            if not isFloat32Exact(dsColumns[colName]):
+                print('Values of ' + colName + ' are not representable as float32, training with float64.')
+                dtype = numpy.dtype(numpy.float64)
+                break
+        if numpy.float32 == dtype:
+            print('Training with a float32 matrix.')
+
+    X = numpy.empty((rowCount, len(attrNames)), dtype=dtype)
+    for colIdx, colName in enumerate(attrNames):
+        X[:, colIdx] = dsColumns.pop(colName)
+
+    y = numpy.asarray(dsColumns.pop(target))
+
+    weights = None
+    if type_utils.CLEANED_COUNT in dsColumns:
+        weights = numpy.asarray(dsColumns.pop(type_utils.CLEANED_COUNT), dtype=numpy.float64)
+
+    return ModelMatrix(attrNames, trainCount, X, y, weights)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import time
+import multiprocessing
+
+import numpy
+import scipy.stats
+
+import sklearn.model_selection
+import sklearn.utils
+
+
+#
+# Minimum number of permutations of each attribute, before the confidence
+# interval of its importance is checked.
+#
+MIN_REPEATS     = 5
+
+#
+# Confidence level of the confidence intervals of the importances.
+#
+CI_LEVEL        = 0.95
+
+#
+# The estimator and test dataset of the permutation workers, set before the
+# worker processes are forked so that they share the memory of the test
+# dataset rather than receiving copies.
+#
+workerArgs      = None
+
+
+
+#
+# Return the half width of the confidence interval of the mean of the
+# importances in `impList`.
+#
+def getCIHalfWidth(impList):
+
+    if len(impList) < 2:
+        return float('inf')
+
+    tValue = scipy.stats.t.ppf(0.5 + CI_LEVEL / 2.0, len(impList) - 1)
+
+    return float(tValue * numpy.std(impList, ddof=1) / numpy.sqrt(len(impList)))
+
+
+
+#
+# Return the rows of a random subsample of at most `maxRows` of the test
+# rows with the target values `y`, stratified by them when `stratified`.
+# All rows are returned when `maxRows` is 0 or not smaller.  The subsample
+# is not stratified when a class has a single row or when either side of
+# the split has fewer rows than there are classes.
+#
+def getSampleRows(y, maxRows, stratified, randSeed):
+
+    rowCount = len(y)
+    if maxRows <= 0 or maxRows >= rowCount:
+        return numpy.arange(rowCount)
+
+    stratify = None
+    if stratified:
+        classCounts = numpy.unique(y, return_counts=True)[1]
+        if numpy.min(classCounts) > 1 and min(maxRows, rowCount - maxRows) >= len(classCounts):
+            stratify = y
+
+    sampleRows, restRows = sklearn.model_selection.train_test_split(numpy.arange(rowCount), train_size=maxRows, random_state=randSeed, stratify=stratify)
+
+    return numpy.sort(sampleRows)
+
+
+
+#
+# Return the importances of the attribute `attrIdx`, the score decrease of
+# each permutation of its values, and the number of predictions made.  Each
+# repeat draws a new subsample of the test rows, so that the confidence
+# interval of the mean importance covers the sampling of the rows as well as
+# the permutations.  The attribute is permuted until that interval is no
+# wider than `ciHalfWidth` on each side, between MIN_REPEATS and
+# `maxRepeats` times.
+#
+def permuteAttribute(attrIdx):
+
+    estimator, X, y, fullScore, stratified, randSeed, maxRows, maxRepeats, ciHalfWidth = workerArgs
+
+    randState    = numpy.random.RandomState(randSeed + attrIdx)
+    impList      = []
+    predictions  = 0
+
+    while len(impList) < maxRepeats:
+        sampleRows = getSampleRows(y, maxRows, stratified, randState.randint(numpy.iinfo(numpy.int32).max))
+        X_perm     = X[sampleRows]
+        y_sample   = y[sampleRows]
+        if len(sampleRows) == len(y):
+            baseScore = fullScore
+        else:
+            baseScore    = estimator.score(X_perm, y_sample)
+            predictions += 1
+        X_perm[:, attrIdx] = X_perm[randState.permutation(len(sampleRows)), attrIdx]
+        impList.append(float(baseScore - estimator.score(X_perm, y_sample)))
+        predictions += 1
+        if len(impList) >= MIN_REPEATS and getCIHalfWidth(impList) <= ciHalfWidth:
+            break
+
+    return impList, predictions
+
+
+
+#
+# Compute the permutation importance of each attribute (column) of `X` for
+# the fitted `estimator` and the target values `y`, like
+# sklearn.inspection.permutation_importance() with the estimator score, but
+# on subsamples of at most `maxRows` rows, stratified for classification,
+# and with adaptive repeats, see permuteAttribute().  The attributes are
+# permuted by `nJobs` forked processes sharing the test dataset.
+#
+# Returns a Bunch with the `importances` of each attribute, a list whose
+# length is the number of repeats of that attribute, their mean, standard
+# deviation and confidence interval half width, and the cost: the number of
+# predictions, predicted rows and seconds taken.
+#
+def computePermImportance(estimator, X, y, stratified, randSeed, maxRows, maxRepeats, ciHalfWidth, nJobs):
+
+    global workerArgs
+
+    startTime   = time.time()
+    sampleRows  = len(y) if maxRows <= 0 else min(maxRows, len(y))
+    fullScore   = None
+    predictions = 0
+    if sampleRows == len(y):
+        fullScore   = float(estimator.score(X, y))
+        predictions = 1
+
+    workerArgs = (estimator, X, y, fullScore, stratified, randSeed, maxRows, max(MIN_REPEATS, maxRepeats), ciHalfWidth)
+    try:
+        attrIdxs = list(range(X.shape[1]))
+        if nJobs > 1 and len(attrIdxs) > 1:
+            with multiprocessing.get_context('fork').Pool(min(nJobs, len(attrIdxs))) as workerPool:
+                attrResults = workerPool.map(permuteAttribute, attrIdxs, chunksize=1)
+        else:
+            attrResults = [permuteAttribute(attrIdx) for attrIdx in attrIdxs]
+    finally:
+        workerArgs = None
+
+    importances  = [impList for impList, attrPredictions in attrResults]
+    predictions += sum([attrPredictions for impList, attrPredictions in attrResults])
+
+    return sklearn.utils.Bunch(
+               importances       = importances,
+               importances_mean  = numpy.array([numpy.mean(impList) for impList in importances]),
+               importances_std   = numpy.array([numpy.std(impList) for impList in importances]),
+               ci_half_widths    = numpy.array([getCIHalfWidth(impList) for impList in importances]),
+               sample_rows       = sampleRows,
+               predictions       = predictions,
+               predicted_rows    = predictions * sampleRows,
+               seconds           = time.time() - startTime,
+               )
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import time
+import multiprocessing
+import multiprocessing.connection
+
+
+#
+# -- SearchScheduler
+#
+# Runs model searches in parallel processes under a global budget of CPU
+# cores.  Each search requests a number of cores.  Whenever cores are free
+# the pending searches are packed into them, the largest requests first, so
+# the cores freed by a search that finishes early go to the next searches at
+# once.  A search requesting more cores than the budget runs alone.
+#
+# The searches run in forked processes, so they must open their own database
+# connections.
+#
+class SearchScheduler(object):
+    """ Packs parallel searches into a global CPU core budget.
+    """
+
+    #
+    #
+    #
+    def __init__(self, cpuBudget):
+
+        self.cpuBudget  = max(1, cpuBudget)
+        self.pending    = []
+        self.results    = []
+
+
+    #
+    # Add the search `jobName`, requesting `jobCPUs` cores, that runs
+    # `jobFn(*jobArgs, grantedCPUs)` in its own process.  The request is
+    # capped to the budget, and the granted number of cores is passed to the
+    # search so that it runs as many jobs as it is scheduled for.
+    #
+    def addSearch(self, jobName, jobCPUs, jobFn, jobArgs):
+        self.pending.append((jobName, min(max(1, jobCPUs), self.cpuBudget), jobFn, jobArgs))
+
+
+    #
+    # Start the pending searches that fit into `freeCPUs` cores, the largest
+    # requests first.  Returns the started searches as a dict of (name, cores,
+    # start time) keyed by process sentinel, and the cores left.
+    #
+    def startFitting(self, mpContext, freeCPUs):
+
+        started = {}
+        for nJob in sorted(self.pending, key=lambda pJob: -pJob[1]):
+            jobName, jobCPUs, jobFn, jobArgs = nJob
+            if jobCPUs > freeCPUs:
+                continue
+
+            self.pending.remove(nJob)
+            jobProc = mpContext.Process(target=jobFn, args=tuple(jobArgs) + (jobCPUs,), name=jobName)
+            jobProc.start()
+            freeCPUs -= jobCPUs
+            print('\nScheduler: started ' + jobName + ' on ' + str(jobCPUs) + ' core(s), ' + str(freeCPUs) + ' of ' + str(self.cpuBudget) + ' free.')
+            started[jobProc.sentinel] = (jobProc, jobName, jobCPUs, time.time())
+
+        return started, freeCPUs
+
+
+    #
+    # Run all searches and wait for them to finish.  Returns a list of
+    # (name, cores, elapsed seconds, exit code) per search.
+    #
+    def run(self):
+
+        mpContext   = multiprocessing.get_context('fork')
+        freeCPUs    = self.cpuBudget
+        running     = {}
+        startTime   = time.time()
+
+        while len(self.pending) > 0 or len(running) > 0:
+
+            started, freeCPUs = self.startFitting(mpContext, freeCPUs)
+            running.update(started)
+
+            for sentinel in multiprocessing.connection.wait(list(running.keys())):
+                jobProc, jobName, jobCPUs, jobStart = running.pop(sentinel)
+                jobProc.join()
+                elapsed   = time.time() - jobStart
+                freeCPUs += jobCPUs
+                self.results.append((jobName, jobCPUs, elapsed, jobProc.exitcode))
+                print('\nScheduler: ' + jobName + ' finished in ' + ('%.1f' % elapsed) + ' seconds (exit code ' + str(jobProc.exitcode) + '), ' + str(freeCPUs) + ' core(s) free.')
+
+        self.report(time.time() - startTime)
+
+        return self.results
+
+
+    #
+    # Print the elapsed time of each search and an estimate of the wall-clock
+    # time saved over running them one after another.  The serial time is
+    # estimated as the sum of the elapsed times, measured while the searches
+    # shared the machine, and is not a measured serial run.
+    #
+    def report(self, wallSeconds):
+
+        serialSeconds = sum([elapsed for jobName, jobCPUs, elapsed, exitCode in self.results])
+
+        print('\n=============================================')
+        print('\tSEARCH SCHEDULE (' + str(self.cpuBudget) + ' cores)')
+        print('=============================================')
+        for jobName, jobCPUs, elapsed, exitCode in self.results:
+            print('\t%-24s %4d cores %10.1f sec  exit %s' % (jobName, jobCPUs, elapsed, str(exitCode)))
+        print('\tSerial estimate (sum)    : %10.1f sec' % serialSeconds)
+        print('\tParallel wall-clock      : %10.1f sec' % wallSeconds)
+        print('\tEstimated saving         : %10.1f sec' % (serialSeconds - wallSeconds))
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+
+import numpy
+
+
+#
+# Seconds between the polls of the run history by PlateauWatcher.
+#
+PLATEAU_POLL_SECONDS = 5.0
+
+
+
+#
+# Return `value` as a plain Python value that MongoDB can store.
+#
+def toPlainValue(value):
+
+    if isinstance(value, numpy.generic):
+        return value.item()
+
+    return value
+
+
+
+#
+# Return the run history of the fitted AutoSKLearn estimator `automl`, or
+# None if it is not available.
+#
+def getRunHistory(automl):
+    return getattr(getattr(automl, 'automl_', None), 'runhistory_', None)
+
+
+
+#
+# Return the successful runs in the run history of the fitted AutoSKLearn
+# estimator `automl` as a list of dicts holding the configuration values
+# ('config'), the mean cost over its runs ('cost') and the end time of its
+# first run ('endtime'), ordered by cost.  Only the runs on the largest
+# budget (subsample) of each configuration count.  Returns an empty list if
+# the run history is not available.
+#
+def getRunHistoryConfigs(automl):
+
+    runHistory = getRunHistory(automl)
+    if None == runHistory:
+        return []
+
+    configCosts   = {}
+    configEnds    = {}
+    configBudget  = {}
+    for runKey, runValue in runHistory.data.items():
+        if not 'SUCCESS' in str(runValue.status):
+            continue
+        runBudget = float(getattr(runKey, 'budget', 0.0))
+        if runBudget < configBudget.get(runKey.config_id, runBudget):
+            continue
+        if runBudget > configBudget.get(runKey.config_id, runBudget):
+            del configCosts[runKey.config_id]
+            del configEnds[runKey.config_id]
+        configBudget[runKey.config_id] = runBudget
+        configCosts.setdefault(runKey.config_id, []).append(float(runValue.cost))
+        endTime = float(getattr(runValue, 'endtime', 0.0))
+        configEnds[runKey.config_id] = min(configEnds.get(runKey.config_id, endTime), endTime)
+
+    runConfigs = []
+    for configId, costList in configCosts.items():
+        configValues = runHistory.ids_config[configId].get_dictionary()
+        runConfigs.append({
+            'config'   : { key: toPlainValue(value) for key, value in configValues.items() },
+            'cost'     : float(numpy.mean(costList)),
+            'endtime'  : configEnds[configId],
+        })
+
+    return sorted(runConfigs, key=lambda rConfig: rConfig['cost'])
+
+
+
+#
+# Return the budgets of a successive halving search as percentages of the
+# training data, the smallest first.  The budgets grow by the factor `eta`
+# from `minSubsample` percent up to the full data.
+#
+def getHalvingBudgets(minSubsample, eta):
+
+    budgetList = [100.0]
+    while budgetList[0] / eta >= minSubsample:
+        budgetList.insert(0, budgetList[0] / eta)
+
+    return budgetList
+
+
+
+#
+# Return the successful runs in the run history of the fitted AutoSKLearn
+# estimator `automl` per budget, as a list of dicts holding the budget, the
+# number of configurations evaluated on it and their best cost, the smallest
+# budget first.
+#
+def getBudgetSchedule(automl):
+
+    runHistory = getRunHistory(automl)
+    if None == runHistory:
+        return []
+
+    budgetCosts = {}
+    for runKey, runValue in runHistory.data.items():
+        if 'SUCCESS' in str(runValue.status):
+            budgetCosts.setdefault(float(getattr(runKey, 'budget', 0.0)), []).append(float(runValue.cost))
+
+    return [{'budget': runBudget, 'evaluations': len(budgetCosts[runBudget]), 'best_cost': min(budgetCosts[runBudget])} for runBudget in sorted(budgetCosts.keys())]
+
+
+
+#
+# Return the seconds from the start of the search to the end of the first
+# run in `runConfigs`, see getRunHistoryConfigs(), reaching `targetCost` or
+# better, or None if no run reached it.
+#
+def getSecondsToCost(runConfigs, targetCost, searchStart):
+
+    reachedEnds = [rConfig['endtime'] for rConfig in runConfigs if rConfig['cost'] <= targetCost]
+    if 0 == len(reachedEnds):
+        return None
+
+    return max(0.0, min(reachedEnds) - searchStart)
+
+
+
+#
+# -- PlateauWatcher
+#
+# Stops a SMAC search once the best cost of its successful runs has not
+# improved by more than `epsilon` for `patienceSeconds` seconds or for
+# `patienceEvals` evaluations, whichever comes first.  A patience of 0
+# disables that limit.  The run history is polled by a daemon thread, which
+# stops the search by lowering the run limit of the SMAC scenario to the runs
+# done so far, so that SMAC finishes its current run and returns.
+#
+class PlateauWatcher(object):
+    """ Early termination of a SMAC search on a plateau of the best cost.
+    """
+
+    #
+    #
+    #
+    def __init__(self, epsilon, patienceSeconds, patienceEvals):
+
+        self.epsilon          = epsilon
+        self.patienceSeconds  = patienceSeconds
+        self.patienceEvals    = patienceEvals
+        self.stopReason       = None
+        self.stopSeconds      = None
+        self.evaluations      = 0
+        self.bestCost         = None
+        self.smbo             = None
+        self.stopEvent        = None
+        self.watchThread      = None
+
+
+    #
+    # The SMAC objects and the thread are not pickled with the fitted
+    # AutoSKLearn estimator holding this watcher.
+    #
+    def __getstate__(self):
+
+        watchState = dict(self.__dict__)
+        watchState['smbo']         = None
+        watchState['stopEvent']    = None
+        watchState['watchThread']  = None
+
+        return watchState
+
+
+    #
+    # Start watching the search of the SMAC object `smacObj`.
+    #
+    def watch(self, smacObj):
+
+        self.smbo         = smacObj.solver
+        self.stopEvent    = threading.Event()
+        self.watchThread  = threading.Thread(target=self.pollRuns, name='plateau-watcher', daemon=True)
+        self.watchThread.start()
+
+
+    #
+    # Stop watching.
+    #
+    def stop(self):
+
+        if None != self.stopEvent:
+            self.stopEvent.set()
+            self.watchThread.join()
+        self.smbo = None
+
+
+    #
+    # Return True if the search stalled at the time `nowTime`, recording the
+    # reason.  `costEnds` are the (end time, cost) of the successful runs.
+    #
+    def isPlateau(self, costEnds, nowTime, startTime):
+
+        self.evaluations = len(costEnds)
+
+        # Small improvements do not add up, they are measured from the cost
+        # of the last improvement.
+        improvedTime   = startTime
+        improvedEvals  = 0
+        improvedCost   = None
+        bestCost       = None
+        for evalIdx, (endTime, runCost) in enumerate(sorted(costEnds)):
+            if None == improvedCost or runCost < improvedCost - self.epsilon:
+                improvedTime   = endTime
+                improvedEvals  = evalIdx + 1
+                improvedCost   = runCost
+            if None == bestCost or runCost < bestCost:
+                bestCost = runCost
+        self.bestCost = bestCost
+
+        if None == bestCost:
+            return False
+
+        if self.patienceSeconds > 0 and nowTime - improvedTime >= self.patienceSeconds:
+            self.stopReason = 'plateau_seconds'
+        elif self.patienceEvals > 0 and len(costEnds) - improvedEvals >= self.patienceEvals:
+            self.stopReason = 'plateau_evaluations'
+
+        return None != self.stopReason
+
+
+    #
+    # Poll the run history of the watched search every PLATEAU_POLL_SECONDS
+    # seconds until it stalls or the watcher is stopped.
+    #
+    def pollRuns(self):
+
+        startTime = time.time()
+
+        while not self.stopEvent.wait(PLATEAU_POLL_SECONDS):
+
+            # A copy, SMAC keeps adding runs while this thread reads them.
+            runValues = list(self.smbo.runhistory.data.values())
+            costEnds  = [(float(getattr(rValue, 'endtime', 0.0)), float(rValue.cost)) for rValue in runValues if 'SUCCESS' in str(rValue.status)]
+
+            nowTime = time.time()
+            if self.isPlateau(costEnds, nowTime, startTime):
+                self.stopSeconds = nowTime - startTime
+                print('\nPlateau: best cost ' + ('%.5f' % self.bestCost) + ' not improved by ' + str(self.epsilon) + ' (' + self.stopReason + '), stopping the search after ' + ('%.1f' % self.stopSeconds) + ' sec and ' + str(self.evaluations) + ' evaluations.')
+                self.smbo.scenario.ta_run_limit = self.smbo.stats.ta_runs
+                return
+
+
+
+#
+# -- SMACObjectCallback
+#
+# The `get_smac_object_callback` of AutoSKLearn, building the default SMAC
+# object of AutoSKLearn with the given configuration values tried first,
+# ahead of the configurations suggested by the AutoSKLearn metalearning.
+# Configurations that are not valid in the configuration space of the search,
+# for example after a change of the included estimators, are skipped.  The
+# optional PlateauWatcher watches the search.
+#
+# With `halvingArgs`, the (smallest subsample percentage, eta) of a
+# successive halving search, the SMAC object is built with the successive
+# halving intensifier instead of the AutoSKLearn default.  The candidates are
+# evaluated on stratified subsamples of the training data first and the best
+# 1/eta of them move on to the next larger subsample, up to the full data.
+#
+class SMACObjectCallback(object):
+    """ SMAC factory seeding and watching the search.
+    """
+
+    #
+    #
+    #
+    def __init__(self, configValues, plateauWatcher=None, halvingArgs=None):
+
+        self.configValues    = configValues
+        self.plateauWatcher  = plateauWatcher
+        self.halvingArgs     = halvingArgs
+
+
+    #
+    # Return the configurations of `self.configValues` that are valid in
+    # `configSpace`, without duplicates.
+    #
+    def getConfigurations(self, configSpace):
+
+        if 0 == len(self.configValues):
+            return []
+
+        import ConfigSpace
+
+        initConfigs = []
+        for nValues in self.configValues:
+            try:
+                nConfig = ConfigSpace.Configuration(configSpace, values=nValues)
+                nConfig.is_valid_configuration()
+            except (ValueError, KeyError, TypeError) as eX:
+                continue
+            if not nConfig in initConfigs:
+                initConfigs.append(nConfig)
+
+        print('\tSeeding the search with ' + str(len(initConfigs)) + ' of ' + str(len(self.configValues)) + ' earlier configuration(s).')
+
+        return initConfigs
+
+
+    #
+    # Return the SMAC object of a successive halving search on subsamples,
+    # starting with the configurations `initConfigs`.  The `smacArgs` of the
+    # AutoSKLearn release, such as `n_jobs` and `dask_client`, are passed on.
+    #
+    def getHalvingSMAC(self, scenario_dict, seed, ta, ta_kwargs, initConfigs, smacArgs):
+
+        from smac.facade.smac_ac_facade import SMAC4AC
+        from smac.intensification.successive_halving import SuccessiveHalving
+        from smac.runhistory.runhistory2epm import RunHistory2EPM4LogCost
+        from smac.scenario.scenario import Scenario
+
+        minSubsample, eta = self.halvingArgs
+
+        smacScenario  = Scenario(scenario_dict)
+        defConfig     = smacScenario.cs.get_default_configuration()
+        initConfigs   = [defConfig] + [iConfig for iConfig in initConfigs if iConfig != defConfig]
+
+        ta_kwargs['budget_type'] = 'subsample'
+
+        return SMAC4AC(
+                   scenario                = smacScenario,
+                   rng                     = seed,
+                   runhistory2epm          = RunHistory2EPM4LogCost,
+                   tae_runner              = ta,
+                   tae_runner_kwargs       = ta_kwargs,
+                   initial_configurations  = initConfigs,
+                   run_id                  = seed,
+                   intensifier             = SuccessiveHalving,
+                   intensifier_kwargs      = { 'initial_budget': minSubsample, 'max_budget': 100.0, 'eta': eta, 'min_chall': 1 },
+                   **smacArgs
+                   )
+
+
+    #
+    # Called by AutoSKLearn with keyword arguments, whose set differs between
+    # releases: `backend` was dropped, `n_jobs` and `dask_client` were added.
+    #
+    def __call__(self, scenario_dict, seed, ta, ta_kwargs, metalearning_configurations, backend=None, **smacArgs):
+
+        import autosklearn.smbo
+
+        initConfigs  = self.getConfigurations(scenario_dict['cs'])
+        initConfigs += [mConfig for mConfig in metalearning_configurations if not mConfig in initConfigs]
+
+        if None != self.halvingArgs:
+            smacObj = self.getHalvingSMAC(scenario_dict, seed, ta, ta_kwargs, initConfigs, smacArgs)
+        else:
+            smacFactory  = getattr(autosklearn.smbo, 'get_smac_object', None)
+            if None == smacFactory:
+                smacFactory = autosklearn.smbo._get_smac_object
+            if None != backend:
+                smacArgs['backend'] = backend
+
+            smacObj = smacFactory(
+                       scenario_dict                = scenario_dict,
+                       seed                         = seed,
+                       ta                           = ta,
+                       ta_kwargs                    = ta_kwargs,
+                       metalearning_configurations  = initConfigs,
+                       **smacArgs
+                       )
+
+        if None != self.plateauWatcher:
+            self.plateauWatcher.watch(smacObj)
+
+        return smacObj
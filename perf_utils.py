@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import sys
+import resource
+
+
+#
+# Bytes per unit of the ru_maxrss value reported by getrusage().  Linux
+# reports kilobytes, macOS reports bytes.
+#
+RSS_UNIT_BYTES = 1 if 'darwin' == sys.platform else 1024
+
+
+
+#
+# Return the peak resident set size of this process in bytes.
+#
+def getPeakRSS():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT_BYTES
+
+
+#
+# Return the largest peak resident set size of the terminated child processes
+# of this process in bytes.
+#
+def getPeakChildRSS():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * RSS_UNIT_BYTES
+
+
+#
+# Return the number of bytes held by the numpy array `column`, including the
+# Python objects referenced by an object column.
+#
+def getColumnBytes(column):
+
+    colBytes = column.nbytes
+    if 'O' == column.dtype.kind:
+        colBytes += sum([sys.getsizeof(value) for value in column])
+
+    return int(colBytes)
+
+
+#
+# Return the number of bytes held by the columns in the dictionary `colDict`.
+#
+def getColumnsBytes(colDict):
+    return sum([getColumnBytes(column) for column in colDict.values()])
+
+
+#
+# Format a byte count for progress messages.
+#
+def formatBytes(byteCount):
+
+    value = float(byteCount)
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if value < 1024.0:
+            return '%.1f %s' % (value, unit)
+        value = value / 1024.0
+
+    return '%.1f TiB' % (value)
+
+
+#
+# Return the number of bytes the columns in `colDict` would hold with every
+# numeric column stored as 64-bit values, the layout pandas infers by
+# default.
+#
+def getWideColumnsBytes(colDict):
+
+    wideBytes = 0
+    for column in colDict.values():
+        if column.dtype.kind in 'iuf':
+            wideBytes += 8 * len(column)
+        else:
+            wideBytes += getColumnBytes(column)
+
+    return wideBytes
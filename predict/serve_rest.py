@@ -27,7 +27,7 @@ from PipelineProfiler import _plot_pipeline_matrix
 from schema import type_utils
 from schema import schema_analysis
 
-from cleanup import dataset_cleanup
+from cleanup import normalization
 
 
 
@@ -174,24 +174,15 @@ class PredictEndpoint(flask.views.MethodView):
         # print('Flattened JSON type: ' + str(type(flatDoc)))
         # print('Flattened JSON string: ' + str(flatDoc))
         target           = estVehicle.getEstimatorTarget()
-        valTypes         = estVehicle.getAttrDatatypes()
-        defValues        = estVehicle.getAttrDefaults()
-        # print('Value types type: ' + str(type(valTypes)))
-        # print('Value types string: ' + str(valTypes))
         
         # Normalize the document to only contain attibute values.
-        pathList         = list(valTypes.copy().keys())
-        pathList.remove(target)
-        normDoc, valList = dataset_cleanup.normalizeToList(flatDoc, pathList, valTypes, defValues, None)
-        reqFrame = pd.DataFrame([valList], columns=pathList)
+        nPlan            = estVehicle.getNormalizationPlan(withTarget=False)
+        normDoc, valList = nPlan.apply(flatDoc)
+        if None == normDoc:
+            return flask.Markup('Too many missing or invalid attributes to predict ' + target + '.')
+        reqFrame = pd.DataFrame([valList], columns=nPlan.getPathList())
         
-        # Transform categorical values.
-        attrSenses = estVehicle.getAttrSenses().copy()
-        attrSenses.pop(target)
-        for attrName, attrSense in attrSenses.items():
-            if attrSense == type_utils.SENSE_CATEGORICAL:
-                attrEncoder = estVehicle.getAttrTransform(attrName)
-                reqFrame[attrName] = attrEncoder.transform(reqFrame[attrName])
+        # Categorical values were encoded to integer codes by the plan.
 
         # print('Request frame type: ' + str(type(reqFrame)))
         # print('Request frame string: ' + str(reqFrame))
@@ -208,7 +199,7 @@ class PredictEndpoint(flask.views.MethodView):
         else:
             predReturn = predicted[0]
 
-        resDict = normDoc.copy()
+        resDict = nPlan.decodeDoc(normDoc)
         target    = self.vehicle.getEstimatorTarget()
         # jsonResultStr = '{ "' + target + '": ' + str(predReturn) + ' }'
         resDict[target] = predReturn
@@ -723,7 +714,7 @@ class PermImpEndpoint(flask.views.MethodView):
             col_names    = numpy.array(allStats[type_utils.STATS_ATTR_NAMES])
             imp_means    = numpy.array(allStats[type_utils.STATS_PERMI_MEAN])
             # imp_stds     = numpy.array(allStats[type_utils.STATS_PERMI_STD])
-            imp_vals     = numpy.array(allStats[type_utils.STATS_PERMI_VALS])
+            imp_vals     = allStats[type_utils.STATS_PERMI_VALS]
 
             sorted_idx   = numpy.flip(imp_means.argsort())
 
@@ -738,8 +729,8 @@ class PermImpEndpoint(flask.views.MethodView):
                 fig = matplotlib.figure.Figure()
                 fax = fig.subplots()
                 
-                cSlice = imp_vals[sorted_idx[attrIdx:attrIdx+attrCnt]]
-                cVals = numpy.flip(cSlice).T
+                # The attributes may be permuted a different number of times.
+                cVals = [imp_vals[sIdx] for sIdx in numpy.flip(sorted_idx[attrIdx:attrIdx+attrCnt])]
                 cLabels = numpy.flip(col_names[sorted_idx[attrIdx:attrIdx+attrCnt]])
                 fax.boxplot(cVals, vert=False, labels=cLabels)
                 fax.set_title(estName + " Feature Importance by Permutation")
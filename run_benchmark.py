@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import sys
+
+import config
+from model import benchmark_sweep
+
+
+""" When launched as a script, load the configuration settings and run
+    the benchmark sweep of the model stage.
+"""
+if __name__ == "__main__":
+
+    if len(sys.argv) < 3:
+        print('Specify the configuration settings JSON file and the time budgets to benchmark.')
+        print('USAGE: ' + sys.argv[0] + ' <settings.json> <budgets> [cpu_counts [seeds [results.csv]]]')
+        print('    - Lists are comma separated, for example 225,450,900.')
+        sys.exit()
+
+    csFname = sys.argv[1]
+    confSettings = config.AhnungConfig(csFname)
+
+    timeBudgets = [int(nValue) for nValue in sys.argv[2].split(',')]
+
+    cpuCounts = [confSettings.getAllowedCPUs()]
+    if len(sys.argv) > 3:
+        cpuCounts = [int(nValue) for nValue in sys.argv[3].split(',')]
+
+    searchSeeds = [confSettings.getRandomSeed()]
+    if len(sys.argv) > 4:
+        searchSeeds = [int(nValue) for nValue in sys.argv[4].split(',')]
+
+    csvFname = 'benchmark_results.csv'
+    if len(sys.argv) > 5:
+        csvFname = sys.argv[5]
+
+    bStage = benchmark_sweep.BenchmarkStage(confSettings, timeBudgets, cpuCounts, searchSeeds, csvFname)
+    bStage.benchmark()
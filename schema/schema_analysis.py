@@ -16,6 +16,8 @@ import mongo_utils
 
 from schema import type_utils
 
+from cleanup import normalization
+
 
 #
 # Convert the python dictionary `srcDoc` representing extended JSON at named
@@ -100,6 +102,25 @@ class SchemaStage(object):
         valuesDict[nextStr] = count
 
 
+    #
+    # Widen the numeric value range recorded in the schema `entry` to include
+    # `numValue`.  The range lets later stages select compact column dtypes.
+    #
+    def update_attr_range(self, entry, numValue):
+
+        if None == numValue or numValue != numValue:
+            # Ignore missing and NaN values.
+            return
+
+        minValue = entry[type_utils.ATTR_MIN]
+        if None == minValue or numValue < minValue:
+            entry[type_utils.ATTR_MIN] = numValue
+
+        maxValue = entry[type_utils.ATTR_MAX]
+        if None == maxValue or numValue > maxValue:
+            entry[type_utils.ATTR_MAX] = numValue
+
+
     #
     #
     #
@@ -116,6 +137,8 @@ class SchemaStage(object):
             entry[type_utils.ATTR_MODE]     = value
             entry[type_utils.ATTR_INTSTR]   = 0
             entry[type_utils.ATTR_FLOATSTR] = 0
+            entry[type_utils.ATTR_MIN]      = None
+            entry[type_utils.ATTR_MAX]      = None
             schemaTable[attrpath]           = entry
         else:
             present_count = entry[type_utils.PRESENT_COUNT]
@@ -132,6 +155,11 @@ class SchemaStage(object):
         if this_count > mode_count:
             entry[type_utils.ATTR_MODE] = value
 
+        if isinstance( value, (int, float) ):
+            self.update_attr_range(entry, value)
+        elif isinstance( value, dict ) and attrtype in [type_utils.TYPE_INT, type_utils.TYPE_LONG, type_utils.TYPE_FLOAT]:
+            self.update_attr_range(entry, type_utils.ahnungTypeAndValue(value)[1])
+
         if type_utils.TYPE_STRING == attrtype:
             resultNum = None
             
@@ -150,6 +178,8 @@ class SchemaStage(object):
                 except (ValueError, TypeError) as eX:
                     pass
 
+            self.update_attr_range(entry, resultNum)
+
 
 
     #
@@ -409,6 +439,9 @@ class SchemaStage(object):
                 attrSufficient = ( presentCount / docCount ) > minPresent
                 if not attrSufficient:
                     rReason        = 'Feature is missing in too many instances.'
+                elif presentCount < docCount and attrPath != target and normalization.MISSING_ALWAYS_FEATURE == estVehicle.getMissingStrategy(attrPath):
+                    attrSufficient = False
+                    rReason        = 'Feature is missing in some instances and its missing value strategy is ' + normalization.MISSING_ALWAYS_FEATURE + '.'
             else:
                 rReason        = 'Feature has only one value.'
 
@@ -599,6 +632,73 @@ class SchemaStage(object):
 
 
 
+    #
+    # Return numpy arrays of the finite numeric values counted in `attrVals`
+    # and of their counts.
+    #
+    def parseNumericCounts(self, attrVals):
+
+        valList = []
+        cntList = []
+
+        for valStr, count in attrVals.items():
+
+            value = None
+
+            try:
+                value = float(valStr)
+            except (ValueError, TypeError) as eX:
+                pass
+
+            if None != value and numpy.isfinite(value):
+                valList.append(value)
+                cntList.append(count)
+
+        return numpy.array(valList, dtype=numpy.double), numpy.array(cntList, dtype=numpy.int64)
+
+
+    #
+    # Compute the mean of the numeric values counted in `attrVals`, or None if
+    # no value is numeric.
+    #
+    def calcAttrMean(self, attrVals):
+
+        valArr, cntArr = self.parseNumericCounts(attrVals)
+        if 0 == len(valArr):
+            return None
+
+        return float(numpy.average(valArr, weights=cntArr))
+
+
+    #
+    # Compute the SCHEMA_QUANTILES of the numeric values counted in `attrVals`,
+    # interpolated as numpy.quantile() would for the full list of values.
+    # Returns a list of [quantile, value] pairs, empty if no value is numeric.
+    #
+    def calcAttrQuantiles(self, attrVals):
+
+        valArr, cntArr = self.parseNumericCounts(attrVals)
+        if 0 == len(valArr):
+            return []
+
+        order    = numpy.argsort(valArr)
+        valArr   = valArr[order]
+        cumCnt   = numpy.cumsum(cntArr[order])
+        total    = cumCnt[-1]
+
+        quantPairs = []
+        for quant in type_utils.SCHEMA_QUANTILES:
+            # Position in the sorted, expanded list of values and the values
+            # found at the positions on each side of it.
+            qPos     = quant * (total - 1)
+            loPos    = numpy.floor(qPos)
+            loVal    = valArr[numpy.searchsorted(cumCnt, loPos, side='right')]
+            hiVal    = valArr[numpy.searchsorted(cumCnt, numpy.ceil(qPos), side='right')]
+            quantPairs.append([quant, float(loVal + (qPos - loPos) * (hiVal - loVal))])
+
+        return quantPairs
+
+
     #
     #
     #
@@ -707,8 +807,9 @@ class SchemaStage(object):
     #
     def saveStats(self, schemaTable, estVehicle):
 
-        statsKeyList  = [ type_utils.PRESENT_COUNT, type_utils.UNIQUE_COUNT, type_utils.ATTR_MODE, type_utils.ATTR_INTSTR, type_utils.ATTR_FLOATSTR ]
+        statsKeyList  = [ type_utils.PRESENT_COUNT, type_utils.UNIQUE_COUNT, type_utils.ATTR_MODE, type_utils.ATTR_INTSTR, type_utils.ATTR_FLOATSTR, type_utils.ATTR_MIN, type_utils.ATTR_MAX ]
         allStats      = estVehicle.getAttrStats()
+        valTypes      = estVehicle.getAttrDatatypes()
 
         for attrPath, mData in schemaTable.items():
             
@@ -716,6 +817,10 @@ class SchemaStage(object):
             
             for stat in statsKeyList:
                 pathStats[stat] = mData[stat]
+
+            if valTypes.get(attrPath) in [type_utils.TYPE_INT, type_utils.TYPE_LONG, type_utils.TYPE_FLOAT]:
+                pathStats[type_utils.ATTR_QUANTILES] = self.calcAttrQuantiles(mData[type_utils.ATTR_VALUES])
+                pathStats[type_utils.ATTR_MEAN]      = self.calcAttrMean(mData[type_utils.ATTR_VALUES])
                 
             allStats[attrPath] = pathStats
             
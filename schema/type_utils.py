@@ -21,6 +21,10 @@ ATTR_INTSTR        = 'attr_intstr'
 ATTR_FLOATSTR      = 'attr_floatstr'
 ATTR_MODE          = 'attr_mode'
 UNIQUE_COUNT       = 'unique_count'
+ATTR_MIN           = 'attr_min'
+ATTR_MAX           = 'attr_max'
+ATTR_QUANTILES     = 'attr_quantiles'
+ATTR_MEAN          = 'attr_mean'
 REJECT_REASON      = 'reject_reason'
 
 #
@@ -39,9 +43,45 @@ STATS_ATTR_NAMES       = 'attribute_names'
 STATS_PERMI_MEAN       = 'perm_importance_means'
 STATS_PERMI_STD        = 'perm_importance_stds'
 STATS_PERMI_VALS       = 'perm_importance_values'
+STATS_PERMI_COST       = 'perm_importance_cost'
 STATS_PRECISION_SCORE  = 'precision_score'
 STATS_RECALL_SCORE     = 'recall_score'
 STATS_ROCAUC_SCORE     = 'rocauc_score'
+STATS_FRAME_MEMORY     = 'frame_memory'
+STATS_FLOAT32_CHECK    = 'float32_check'
+STATS_OUTLIER_COUNTS   = 'outlier_counts'
+STATS_BALANCING_RUNS   = 'balancing_runs'
+STATS_STEP_MEMORY      = 'step_memory'
+STATS_WARM_START       = 'warm_start'
+STATS_META_FEATURES    = 'meta_features'
+STATS_META_NEIGHBORS   = 'meta_neighbors'
+STATS_SEARCH_STOP      = 'search_stop'
+STATS_HALVING          = 'successive_halving'
+STATS_RESAMPLING       = 'resampling'
+STATS_REFIT_SECONDS    = 'refit_seconds'
+STATS_EVAL_SECONDS     = 'evaluation_seconds'
+STATS_DEDUP_LOAD       = 'dedup_load'
+STATS_MATRIX_LOAD      = 'matrix_load'
+
+#
+# Field names added by the cleanup stage to cleaned documents.
+#
+CLEANED_STRINGS        = '_ahnung_strings'
+CLEANED_COUNT          = '_ahnung_count'
+CLEANED_FOLD           = '_ahnung_fold'
+CLEANED_HOLDOUT        = '_ahnung_holdout'
+
+#
+# Dictionary keys (constants) used for the state of incremental cleanup.
+#
+CLEANUP_WATERMARK      = 'watermark'
+CLEANUP_FINGERPRINT    = 'fingerprint'
+CLEANUP_RAW_COUNT      = 'raw_count'
+
+#
+# Suffix of the missing-indicator attributes added by the cleanup stage.
+#
+MISSING_SUFFIX         = '__missing'
 
 #
 # Names of types tracked in the schema analysis.
@@ -76,6 +116,18 @@ SENSES_SUFFIX      = '_sense'
 REJECT_SUFFIX      = '_reject'
 FSIDS_SUFFIX       = '_gridfsids'
 STATS_SUFFIX       = '_stats'
+CLEANUP_SUFFIX     = '_cleanup'
+
+#
+# Meta data collection shared by all estimators, holding the meta-features
+# and best configurations of each modeled dataset.
+#
+META_FEATURES_COLL = 'ahnung_meta_features'
+
+#
+# Meta data collection holding the results of the benchmark sweeps.
+#
+BENCHMARK_COLL     = 'ahnung_benchmark'
 
 
 #
@@ -86,6 +138,12 @@ MISSING_FLOAT   = 0.0
 MISSING_STRING  = ''
 MISSING_DATE    = dt.fromtimestamp(0)
 
+#
+# Quantiles of the numeric attribute values recorded by the schema analysis,
+# stored as [quantile, value] pairs under ATTR_QUANTILES.
+#
+SCHEMA_QUANTILES   = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
 
 
 #
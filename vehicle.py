@@ -13,6 +13,10 @@ import mongo_utils
 import config
 from schema import type_utils
 
+# cleanup.normalization is imported by the methods using it, importing it
+# here would import it while schema.type_utils, which imports this module
+# through config, is still loading.
+
 
 
 #
@@ -53,6 +57,8 @@ class AhnungVehicle(object):
 
     fsNameList = [FS_NAME_FLAGS, FS_NAME_TRANSFORMS, FS_NAME_CLASSIFIER, FS_NAME_REGRESSOR]
 
+    PLAN_CLEANED        = 'cleaned'
+
     #
     #
     #
@@ -70,10 +76,13 @@ class AhnungVehicle(object):
         self.attrDatatypes          = None
         self.attrSenses             = None
         self.attrStats              = None
+        self.cleanupState           = None
         self.rejectAttrs            = None
         self.attrTransformDict      = None
+        self.normPlans              = None
         self.autoSklearnClassifier  = None
         self.autoSklearnRegressor   = None
+        self.grantedCPUs            = None
 
 
 
@@ -131,6 +140,61 @@ class AhnungVehicle(object):
 
 
 
+    #
+    # The seed of the model search defaults to the random seed, which also
+    # selects the holdout documents in the `cleanup` stage.
+    #
+    def getSearchSeed(self):
+
+        c_search_seed = self.aConfig.getSearchSeed()
+        if None == c_search_seed:
+            c_search_seed = self.getRandomSeed()
+        estName = self.getEstimatorName()
+        search_seed = self.aConfig.getEstimatorInteger(estName, self.aConfig.SEARCH_SEED, c_search_seed)
+        
+        return search_seed
+
+
+
+    #
+    #
+    #
+    def getNumFolds(self):
+
+        c_num_folds = self.aConfig.getNumFolds()
+        estName = self.getEstimatorName()
+        num_folds = self.aConfig.getEstimatorInteger(estName, self.aConfig.NUM_FOLDS, c_num_folds)
+
+        return max(2, num_folds)
+
+
+
+    #
+    #
+    #
+    def getResamplingStrategy(self):
+
+        c_resampling = self.aConfig.getResamplingStrategy()
+        estName = self.getEstimatorName()
+        resampling = self.aConfig.getEstimatorString(estName, self.aConfig.RESAMPLING_STRATEGY, c_resampling)
+
+        return resampling
+
+
+
+    #
+    #
+    #
+    def getHoldoutFraction(self):
+
+        c_holdout_frac = self.aConfig.getHoldoutFraction()
+        estName = self.getEstimatorName()
+        holdout_frac = self.aConfig.getEstimatorFloat(estName, self.aConfig.HOLDOUT_FRACTION, c_holdout_frac)
+
+        return holdout_frac
+
+
+
     #
     #
     #
@@ -140,9 +204,20 @@ class AhnungVehicle(object):
         estName = self.getEstimatorName()
         allow_cpus = self.aConfig.getEstimatorInteger(estName, self.aConfig.ALLOWED_CPUS, c_allow_cpus)
 
+        if None != self.grantedCPUs:
+            allow_cpus = self.grantedCPUs
+
         return allow_cpus
 
 
+    #
+    # Limit the CPUs used by this estimator to the `cpuCount` cores granted
+    # by the search scheduler, in place of the configured allowed_cpus.
+    #
+    def setGrantedCPUs(self, cpuCount):
+        self.grantedCPUs = cpuCount
+
+
 
     #
     #
@@ -226,6 +301,450 @@ class AhnungVehicle(object):
 
 
 
+    #
+    #
+    #
+    def getKeepCategoryStrings(self):
+
+        c_keep_strings = self.aConfig.getCleanupKeepCategoryStrings()
+        estName = self.getEstimatorName()
+        keep_strings = self.aConfig.getEstimatorBoolean(estName, self.aConfig.KEEP_CAT_STRINGS, c_keep_strings)
+
+        return keep_strings
+
+
+
+    #
+    #
+    #
+    def getDedupMode(self):
+
+        c_dedup_mode = self.aConfig.getCleanupDedupMode()
+        estName = self.getEstimatorName()
+        dedup_mode = self.aConfig.getEstimatorString(estName, self.aConfig.DEDUP_MODE, c_dedup_mode)
+
+        return dedup_mode
+
+
+
+    #
+    #
+    #
+    def getDedupMaxCopies(self):
+
+        c_max_copies = self.aConfig.getCleanupDedupMaxCopies()
+        estName = self.getEstimatorName()
+        max_copies = self.aConfig.getEstimatorInteger(estName, self.aConfig.DEDUP_MAX_COPIES, c_max_copies)
+
+        return max(1, max_copies)
+
+
+
+    #
+    # Return the outlier policy of each numerical attribute other than the
+    # target, keyed by attribute path.  The `outlier_attr_policies` setting
+    # selects the policy of individual attributes, the others use the
+    # `outlier_policy` setting.
+    #
+    def getOutlierPolicies(self):
+
+        estName = self.getEstimatorName()
+        target = self.getEstimatorTarget()
+
+        c_policy = self.aConfig.getCleanupOutlierPolicy()
+        policy = self.aConfig.getEstimatorString(estName, self.aConfig.OUTLIER_POLICY, c_policy)
+        c_attr_policies = self.aConfig.getCleanupOutlierAttrPolicies()
+        attr_policies = self.aConfig.getEstimatorDict(estName, self.aConfig.OUTLIER_ATTR_POLICIES, c_attr_policies)
+
+        policies = {}
+        for path, attrSense in self.getAttrSenses().items():
+            if type_utils.SENSE_NUMERICAL == attrSense and target != path:
+                policies[path] = str(attr_policies.get(path, policy))
+
+        return policies
+
+
+
+    #
+    # Return the missing value strategy of attribute `path`, from the
+    # `missing_attr_values` setting or else the `missing_value` setting.
+    #
+    def getMissingStrategy(self, path):
+
+        estName = self.getEstimatorName()
+
+        c_strategy = self.aConfig.getCleanupMissingValue()
+        strategy = self.aConfig.getEstimatorString(estName, self.aConfig.MISSING_VALUE, c_strategy)
+        c_attr_values = self.aConfig.getCleanupMissingAttrValues()
+        attr_values = self.aConfig.getEstimatorDict(estName, self.aConfig.MISSING_ATTR_VALUES, c_attr_values)
+
+        return str(attr_values.get(path, strategy))
+
+
+
+    #
+    # Return the missing value strategy of each attribute other than the
+    # target, keyed by attribute path.
+    #
+    def getMissingStrategies(self):
+
+        target = self.getEstimatorTarget()
+
+        strategies = {}
+        for path in self.getAttrDatatypes().keys():
+            if target != path:
+                strategies[path] = self.getMissingStrategy(path)
+
+        return strategies
+
+
+
+    #
+    #
+    #
+    def getMissingAllowance(self):
+
+        c_allowance = self.aConfig.getCleanupMissingAllowance()
+        estName = self.getEstimatorName()
+        allowance = self.aConfig.getEstimatorString(estName, self.aConfig.MISSING_ALLOWANCE, c_allowance)
+
+        return str(allowance)
+
+
+
+    #
+    # Return the names of the missing-indicator attributes, keyed by the path
+    # of the attribute they indicate.  With `missing_indicators` enabled, an
+    # indicator is added for each attribute other than the target that was
+    # missing from some instances during the schema analysis, unless its
+    # missing value strategy rejects those instances.
+    #
+    def getIndicatorPaths(self):
+
+        from cleanup import normalization
+
+        estName = self.getEstimatorName()
+        c_indicators = self.aConfig.getCleanupMissingIndicators()
+        if not self.aConfig.getEstimatorBoolean(estName, self.aConfig.MISSING_INDICATORS, c_indicators):
+            return {}
+
+        target      = self.getEstimatorTarget()
+        attrStats   = self.getAttrStats()
+        targetStats = attrStats.get(target)
+        if not isinstance( targetStats, dict ):
+            return {}
+        docCount    = targetStats.get(type_utils.PRESENT_COUNT)
+
+        indicatorPaths = {}
+        for path, strategy in self.getMissingStrategies().items():
+            pathStats = attrStats.get(path)
+            if isinstance( pathStats, dict ) and pathStats.get(type_utils.PRESENT_COUNT, docCount) < docCount:
+                if not strategy in [normalization.MISSING_ALWAYS_INSTANCE, normalization.MISSING_ALWAYS_FEATURE]:
+                    indicatorPaths[path] = path + type_utils.MISSING_SUFFIX
+
+        return indicatorPaths
+
+
+
+    #
+    # Return the senses of the attributes used for modeling, including the
+    # missing-indicator attributes.
+    #
+    def getModelSenses(self):
+
+        modelSenses = dict(self.getAttrSenses())
+        for path, indicatorPath in self.getIndicatorPaths().items():
+            modelSenses[indicatorPath] = type_utils.SENSE_CATEGORICAL
+
+        return modelSenses
+
+
+
+    #
+    #
+    #
+    def getDaskScheduler(self):
+
+        c_scheduler = self.aConfig.getDaskScheduler()
+        estName = self.getEstimatorName()
+        dask_scheduler = self.aConfig.getEstimatorString(estName, self.aConfig.DASK_SCHEDULER, c_scheduler)
+
+        return dask_scheduler
+
+
+
+    #
+    #
+    #
+    def getDaskWorkers(self):
+
+        c_workers = self.aConfig.getDaskWorkers()
+        estName = self.getEstimatorName()
+        dask_workers = self.aConfig.getEstimatorInteger(estName, self.aConfig.DASK_WORKERS, c_workers)
+
+        return dask_workers
+
+
+
+    #
+    #
+    #
+    def getSearchTmpFolder(self):
+
+        c_tmp_folder = self.aConfig.getSearchTmpFolder()
+        estName = self.getEstimatorName()
+        tmp_folder = self.aConfig.getEstimatorString(estName, self.aConfig.SEARCH_TMP_FOLDER, c_tmp_folder)
+
+        return tmp_folder
+
+
+
+    #
+    #
+    #
+    def getIncrementalCleanup(self):
+
+        c_incremental = self.aConfig.getCleanupIncremental()
+        estName = self.getEstimatorName()
+        incremental = self.aConfig.getEstimatorBoolean(estName, self.aConfig.INCREMENTAL_CLEANUP, c_incremental)
+
+        return incremental
+
+
+
+    #
+    #
+    #
+    def getTrustCleaned(self):
+
+        c_trust = self.aConfig.getModelTrustCleaned()
+        estName = self.getEstimatorName()
+        trust_cleaned = self.aConfig.getEstimatorBoolean(estName, self.aConfig.TRUST_CLEANED, c_trust)
+
+        return trust_cleaned
+
+
+
+    #
+    # Return the fingerprint of everything that shapes the documents stored
+    # by the cleanup stage, recorded with the cleanup state.
+    #
+    def getCleanupFingerprint(self):
+
+        foldArgs = (self.getRandomSeed(), self.getNumFolds(), self.getHoldoutFraction())
+
+        return str((self.getNormalizationPlan().getFingerprint(), self.getKeepCategoryStrings(), self.getDedupMode(), foldArgs, self.getEstimatorTarget()))
+
+
+
+    #
+    #
+    #
+    def getCompactDtypes(self):
+
+        c_compact = self.aConfig.getModelCompactDtypes()
+        estName = self.getEstimatorName()
+        compact = self.aConfig.getEstimatorBoolean(estName, self.aConfig.COMPACT_DTYPES, c_compact)
+
+        return compact
+
+
+
+    #
+    #
+    #
+    def getFloat32Training(self):
+
+        c_float32 = self.aConfig.getModelFloat32Training()
+        estName = self.getEstimatorName()
+        use_float32 = self.aConfig.getEstimatorBoolean(estName, self.aConfig.FLOAT32_TRAINING, c_float32)
+
+        return use_float32
+
+
+
+    #
+    #
+    #
+    def getWarmStart(self):
+
+        c_warm_start = self.aConfig.getModelWarmStart()
+        estName = self.getEstimatorName()
+        warm_start = self.aConfig.getEstimatorBoolean(estName, self.aConfig.WARM_START, c_warm_start)
+
+        return warm_start
+
+
+
+    #
+    #
+    #
+    def getWarmStartConfigs(self):
+
+        c_warm_configs = self.aConfig.getModelWarmStartConfigs()
+        estName = self.getEstimatorName()
+        warm_configs = self.aConfig.getEstimatorInteger(estName, self.aConfig.WARM_START_CONFIGS, c_warm_configs)
+
+        return warm_configs
+
+
+
+    #
+    #
+    #
+    def getMetaFeatureStore(self):
+
+        c_meta_store = self.aConfig.getModelMetaFeatureStore()
+        estName = self.getEstimatorName()
+        meta_store = self.aConfig.getEstimatorBoolean(estName, self.aConfig.META_FEATURE_STORE, c_meta_store)
+
+        return meta_store
+
+
+
+    #
+    #
+    #
+    def getMetaNeighbors(self):
+
+        c_meta_neighbors = self.aConfig.getModelMetaNeighbors()
+        estName = self.getEstimatorName()
+        meta_neighbors = self.aConfig.getEstimatorInteger(estName, self.aConfig.META_NEIGHBORS, c_meta_neighbors)
+
+        return meta_neighbors
+
+
+
+    #
+    #
+    #
+    def getPlateauEpsilon(self):
+
+        c_epsilon = self.aConfig.getModelPlateauEpsilon()
+        estName = self.getEstimatorName()
+        epsilon = self.aConfig.getEstimatorFloat(estName, self.aConfig.PLATEAU_EPSILON, c_epsilon)
+
+        return epsilon
+
+
+
+    #
+    #
+    #
+    def getPlateauSeconds(self):
+
+        c_plateau_seconds = self.aConfig.getModelPlateauSeconds()
+        estName = self.getEstimatorName()
+        plateau_seconds = self.aConfig.getEstimatorInteger(estName, self.aConfig.PLATEAU_SECONDS, c_plateau_seconds)
+
+        return plateau_seconds
+
+
+
+    #
+    #
+    #
+    def getPlateauEvaluations(self):
+
+        c_plateau_evals = self.aConfig.getModelPlateauEvaluations()
+        estName = self.getEstimatorName()
+        plateau_evals = self.aConfig.getEstimatorInteger(estName, self.aConfig.PLATEAU_EVALUATIONS, c_plateau_evals)
+
+        return plateau_evals
+
+
+
+    #
+    #
+    #
+    def getSuccessiveHalving(self):
+
+        c_halving = self.aConfig.getModelSuccessiveHalving()
+        estName = self.getEstimatorName()
+        use_halving = self.aConfig.getEstimatorBoolean(estName, self.aConfig.SUCCESSIVE_HALVING, c_halving)
+
+        return use_halving
+
+
+
+    #
+    #
+    #
+    def getHalvingMinSubsample(self):
+
+        c_min_subsample = self.aConfig.getModelHalvingMinSubsample()
+        estName = self.getEstimatorName()
+        min_subsample = self.aConfig.getEstimatorFloat(estName, self.aConfig.HALVING_MIN_SUBSAMPLE, c_min_subsample)
+
+        return min(1.0, max(0.01, min_subsample))
+
+
+
+    #
+    #
+    #
+    def getHalvingEta(self):
+
+        c_halving_eta = self.aConfig.getModelHalvingEta()
+        estName = self.getEstimatorName()
+        halving_eta = self.aConfig.getEstimatorInteger(estName, self.aConfig.HALVING_ETA, c_halving_eta)
+
+        return max(2, halving_eta)
+
+
+
+    #
+    #
+    #
+    def getPermImportanceRows(self):
+
+        c_permi_rows = self.aConfig.getModelPermImportanceRows()
+        estName = self.getEstimatorName()
+        permi_rows = self.aConfig.getEstimatorInteger(estName, self.aConfig.PERMI_ROWS, c_permi_rows)
+
+        return max(0, permi_rows)
+
+
+
+    #
+    #
+    #
+    def getPermImportanceRepeats(self):
+
+        c_permi_repeats = self.aConfig.getModelPermImportanceRepeats()
+        estName = self.getEstimatorName()
+        permi_repeats = self.aConfig.getEstimatorInteger(estName, self.aConfig.PERMI_REPEATS, c_permi_repeats)
+
+        return max(1, permi_repeats)
+
+
+
+    #
+    #
+    #
+    def getPermImportanceCI(self):
+
+        c_permi_ci = self.aConfig.getModelPermImportanceCI()
+        estName = self.getEstimatorName()
+        permi_ci = self.aConfig.getEstimatorFloat(estName, self.aConfig.PERMI_CI, c_permi_ci)
+
+        return max(0.0, permi_ci)
+
+
+
+    #
+    #
+    #
+    def getPermImportanceCheck(self):
+
+        c_permi_check = self.aConfig.getModelPermImportanceCheck()
+        estName = self.getEstimatorName()
+        permi_check = self.aConfig.getEstimatorBoolean(estName, self.aConfig.PERMI_CHECK, c_permi_check)
+
+        return permi_check
+
+
+
     #
     #
     #
@@ -236,6 +755,16 @@ class AhnungVehicle(object):
         return self.mUtils
 
 
+    #
+    # Drop the metadata database connection, and the GridFS bound to it,
+    # inherited from the parent process after a fork, pymongo clients must
+    # not be shared between processes.
+    #
+    def resetMetaClientDB(self):
+        self.metaClientDB = None
+        self.gridFS       = None
+
+
     #
     #
     #
@@ -410,6 +939,7 @@ class AhnungVehicle(object):
     #
     def setAttrDefaults(self, aDefaults, doFlush=False):
         self.attrDefaults = aDefaults
+        self.normPlans = None
         
         if doFlush:
             
@@ -457,6 +987,7 @@ class AhnungVehicle(object):
     #
     def setAttrDatatypes(self, aDatatypes, doFlush=False):
         self.attrDatatypes = aDatatypes
+        self.normPlans = None
         
         if doFlush:
             
@@ -503,6 +1034,7 @@ class AhnungVehicle(object):
     #
     def setAttrSenses(self, aSenses, doFlush=False):
         self.attrSenses = aSenses
+        self.normPlans = None
 
         if doFlush:
             
@@ -549,6 +1081,7 @@ class AhnungVehicle(object):
     #
     def setAttrStats(self, aStats, doFlush=False):
         self.attrStats = aStats
+        self.normPlans = None
 
         if doFlush:
             
@@ -564,6 +1097,51 @@ class AhnungVehicle(object):
                     sAttrsColl.insert({ path: attrData })
 
 
+    #
+    # The cleanup state records the raw `_id` watermark, plan fingerprint and
+    # raw document count of the last cleanup, see CleanupStage.cleanupEst().
+    #
+    def getCleanupState(self, doLoad=False):
+
+        if None == self.cleanupState or doLoad:
+            stateDict = {}
+
+            cCollStr = self.getEstimatorName() + type_utils.CLEANUP_SUFFIX
+            metaClientDB = self.getMetaClientDB()
+            cStateColl = pymongo.collection.Collection( metaClientDB, cCollStr )
+
+            stateQuery = {}
+            for nState in cStateColl.find( stateQuery ):
+        
+                for key, value in nState.items():
+        
+                    if None != key and None != value:
+                        if '_id' != key:
+                            stateDict[key] = value
+
+            self.cleanupState = stateDict
+            
+        return self.cleanupState
+
+
+    #
+    #
+    #
+    def setCleanupState(self, cState, doFlush=False):
+        self.cleanupState = cState
+
+        if doFlush:
+            
+            cCollStr = self.getEstimatorName() + type_utils.CLEANUP_SUFFIX
+            metaClientDB = self.getMetaClientDB()
+            cStateColl = pymongo.collection.Collection( metaClientDB, cCollStr )
+            cStateColl.drop()
+            
+            if None != cState:
+                for key, value in cState.items():
+                    cStateColl.insert_one({ key: value })
+
+
     #
     #
     #
@@ -640,12 +1218,114 @@ class AhnungVehicle(object):
         
         if None != attrName:
             self.attrTransformDict[attrName] = targetEncoder
+            self.normPlans = None
         
         if doFlush:
             self.saveVehicleObject(self.FS_NAME_TRANSFORMS, self.attrTransformDict)
 
 
 
+    #
+    # Return the fitted encoders of the categorical attributes, keyed by path.
+    #
+    def getCategoricalEncoders(self):
+
+        self.getAttrTransform(None)
+
+        encoders = {}
+        for path, attrSense in self.getAttrSenses().items():
+            if type_utils.SENSE_CATEGORICAL == attrSense:
+                attrEncoder = self.attrTransformDict.get(path)
+                if None != attrEncoder:
+                    encoders[path] = attrEncoder
+
+        return encoders
+
+
+    #
+    # Return the NormalizationPlan for this estimator, built once from the
+    # attribute datatypes, defaults, senses, categorical encoders, outlier
+    # policies and missing value strategies.  The plan converts raw flattened
+    # documents, fills in missing values, suppresses outliers, adds the
+    # missing-indicator attributes and encodes the categorical attributes to
+    # integer codes.  With `withTarget` False the target
+    # attribute is left out, as needed for prediction requests.
+    #
+    def getNormalizationPlan(self, withTarget=True):
+
+        from cleanup import normalization
+
+        if None == self.normPlans:
+            self.normPlans = {}
+
+        nPlan = self.normPlans.get(withTarget)
+        if None == nPlan:
+            target    = self.getEstimatorTarget()
+            valTypes  = self.getAttrDatatypes()
+            pathList  = [path for path in valTypes.keys() if withTarget or target != path]
+            bounds    = normalization.computeOutlierBounds(valTypes, self.getAttrStats(), self.getOutlierPolicies())
+            if not withTarget:
+                # A prediction request can not be dropped, so its outliers
+                # are clipped to the same bounds instead.
+                bounds = {path: (normalization.OUTLIER_CLIP if normalization.OUTLIER_DROP == pathBounds[0] else pathBounds[0], pathBounds[1], pathBounds[2]) for path, pathBounds in bounds.items()}
+            strategies = self.getMissingStrategies()
+            impValues = normalization.computeImputeValues(valTypes, self.getAttrDefaults(), self.getAttrStats(), strategies)
+            required  = [path for path, strategy in strategies.items() if normalization.MISSING_ALWAYS_INSTANCE == strategy]
+            nPlan     = normalization.NormalizationPlan(pathList, valTypes, impValues, self.getModelSenses(), target, self.getCategoricalEncoders(), bounds,
+                                                        required, self.getIndicatorPaths(), self.getMissingAllowance())
+            self.normPlans[withTarget] = nPlan
+
+        return nPlan
+
+
+    #
+    # Return the plan for reading documents back from the cleaned collection,
+    # where categorical attributes are already stored as integer codes and the
+    # missing-indicator attributes follow the others.
+    #
+    def getCleanedPlan(self):
+
+        from cleanup import normalization
+
+        if None == self.normPlans:
+            self.normPlans = {}
+
+        nPlan = self.normPlans.get(self.PLAN_CLEANED)
+        if None == nPlan:
+            target    = self.getEstimatorTarget()
+            valTypes  = dict(self.getAttrDatatypes())
+            defValues = dict(self.getAttrDefaults())
+            pathList  = list(valTypes.keys())
+            for path, indicatorPath in self.getIndicatorPaths().items():
+                pathList.append(indicatorPath)
+                valTypes[indicatorPath]  = type_utils.TYPE_INT
+                defValues[indicatorPath] = 0
+            nPlan     = normalization.makeCleanedPlan(pathList, valTypes, defValues, self.getModelSenses(), target, self.getCategoricalEncoders())
+            self.normPlans[self.PLAN_CLEANED] = nPlan
+
+        return nPlan
+
+
+
+    #
+    # Return the compact dtypes of the columns read from the cleaned
+    # collection, selected from the value ranges recorded by the schema stage
+    # and the number of classes of the categorical encoders.
+    #
+    def getColumnDtypes(self):
+
+        from cleanup import normalization
+
+        valTypes = self.getAttrDatatypes()
+        dtypes   = normalization.selectDtypes(list(valTypes.keys()), valTypes, self.getAttrDefaults(), self.getAttrStats(), self.getCategoricalEncoders())
+
+        for path, indicatorPath in self.getIndicatorPaths().items():
+            dtypes[indicatorPath] = normalization.selectIntDtype(0, 1)
+
+        return dtypes
+
+
+
     #
     #
     #
@@ -724,6 +1404,9 @@ class AhnungVehicle(object):
         if None != self.attrStats:
             self.setAttrStats(self.attrStats, True)
 
+        if None != self.cleanupState:
+            self.setCleanupState(self.cleanupState, True)
+
         if None != self.rejectAttrs:
             self.setRejectedAttrs(self.rejectAttrs, True)
 